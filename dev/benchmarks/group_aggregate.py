@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Benchmark segment_aggregate against group_aggregate for the sequence-level loss."""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+
+from art.preprocessing.pack import packed_tensors_from_tokenized_results
+from art.utils.group_aggregate import (
+    group_aggregate,
+    segment_aggregate,
+    segment_ids,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../tests/unit"))
+from packing_helpers import random_tokenized_results  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=400)
+    parser.add_argument("--max-length", type=int, default=2_048)
+    parser.add_argument("--seq-len", type=int, default=8_192)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    results = random_tokenized_results(
+        random.Random(0), num_groups=args.groups, max_length=args.max_length
+    )
+    packed_tensors = packed_tensors_from_tokenized_results(
+        results, seq_len=args.seq_len
+    )
+    group_ids = packed_tensors["group_ids"]
+    mask = packed_tensors["assistant_mask"].float()
+    values = torch.randn(group_ids.shape, requires_grad=True)
+    print(f"{group_ids.shape[0]} sequences of length {group_ids.shape[1]}")
+
+    def group() -> torch.Tensor:
+        return group_aggregate(values, by=group_ids * mask, reduce="mean")
+
+    def segment() -> torch.Tensor:
+        segments, num_segments = segment_ids(group_ids)
+        return segment_aggregate(
+            values,
+            segment_ids=segments,
+            num_segments=num_segments,
+            reduce="mean",
+            mask=mask,
+        )
+
+    for name, aggregate in [("group_aggregate", group), ("segment_aggregate", segment)]:
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            (aggregate() * mask).sum().backward()
+            timings.append(time.perf_counter() - start)
+        print(f"{name:>18}: {min(timings) * 1000:.2f}ms (forward + backward)")
+
+
+if __name__ == "__main__":
+    main()
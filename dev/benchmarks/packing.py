@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Benchmark packed_tensors_from_tokenized_results against the list-based packer."""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from art.preprocessing.pack import packed_tensors_from_tokenized_results
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../tests/unit"))
+from packing_helpers import (  # noqa: E402
+    compact_result,
+    random_tokenized_results,
+    reference_packed_tensors,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=4_000)
+    parser.add_argument("--max-length", type=int, default=1_024)
+    parser.add_argument("--seq-len", type=int, default=4_096)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    results = random_tokenized_results(
+        random.Random(0), num_groups=args.groups, max_length=args.max_length
+    )
+    compact_results = [compact_result(result) for result in results]
+    print(f"{len(results)} results, {sum(len(r.token_ids) for r in results)} tokens")
+
+    for name, pack, inputs in [
+        ("reference", reference_packed_tensors, results),
+        ("vectorized", packed_tensors_from_tokenized_results, results),
+        (
+            "vectorized (compact)",
+            packed_tensors_from_tokenized_results,
+            compact_results,
+        ),
+    ]:
+        timings = []
+        for _ in range(args.repeats):
+            random.seed(0)
+            start = time.perf_counter()
+            packed_tensors = pack(inputs, seq_len=args.seq_len)
+            timings.append(time.perf_counter() - start)
+        print(
+            f"{name:>22}: {min(timings):.3f}s "
+            f"({packed_tensors['tokens'].shape[0]} sequences)"
+        )
+
+
+if __name__ == "__main__":
+    main()
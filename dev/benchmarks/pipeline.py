@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark the training pipeline end to end on the CPU with CpuReferenceService.
+
+Reports the wall time of each stage (gather, log, tokenize + pack, train,
+checkpoint, reload) per step, and the sampled and trained tokens per second.
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from collections import defaultdict
+from functools import wraps
+from typing import Any, Callable
+
+import art
+from art.cpu.tokenizer import reference_tokenizer
+from art.local import LocalBackend
+from art.preprocessing.pack import packed_tensors_from_dir
+
+
+def timed(timings: dict[str, float], stage: str, fn: Callable) -> Callable:
+    """Wraps `fn` to add its wall time to `timings[stage]`."""
+
+    @wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage] += time.perf_counter() - start
+
+    @wraps(fn)
+    async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            timings[stage] += time.perf_counter() - start
+
+    return async_wrapper if asyncio.iscoroutinefunction(fn) else wrapper
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--groups", type=int, default=8)
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--micro-batch-size", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8123)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        reference_tokenizer().save_pretrained(f"{tmp}/tokenizer")
+        backend = LocalBackend(in_process=True, path=f"{tmp}/art")
+        model = art.TrainableModel(
+            name="pipeline-benchmark",
+            project="benchmarks",
+            base_model=f"{tmp}/tokenizer",
+            _internal_config={"_cpu_reference_service": True},
+        )
+        await model.register(
+            backend,
+            _openai_client_config={
+                "server_args": {"host": "127.0.0.1", "port": args.port}
+            },
+        )
+        client = model.openai_client()
+        service = await backend._get_service(model)
+
+        timings: dict[str, float] = defaultdict(float)
+        tokens: dict[str, int] = defaultdict(int)
+        get_packed_tensors = timed(
+            timings, "tokenize + pack", backend._get_packed_tensors
+        )
+
+        def count_trained_tokens(*args: Any, **kwargs: Any) -> Any:
+            packed = get_packed_tensors(*args, **kwargs)
+            for bucket in packed[0] if packed is not None else []:
+                group_ids = packed_tensors_from_dir(**bucket)["group_ids"]
+                tokens["trained"] += int((group_ids != -1).sum())
+            return packed
+
+        backend._get_packed_tensors = count_trained_tokens  # type: ignore
+        backend._log = timed(timings, "log", backend._log)  # type: ignore
+        service._train_step = timed(timings, "train", service._train_step)  # type: ignore
+        service._save_checkpoint = timed(  # type: ignore
+            timings, "checkpoint", service._save_checkpoint
+        )
+        service._load_checkpoint = timed(  # type: ignore
+            timings, "reload", service._load_checkpoint
+        )
+
+        async def rollout(prompt: int) -> art.Trajectory:
+            messages: art.Messages = [
+                {"role": "user", "content": f"Count from {prompt}:"}
+            ]
+            chat_completion = await client.chat.completions.create(
+                model=model.name,
+                messages=messages,
+                max_tokens=args.max_tokens,
+                logprobs=True,
+            )
+            choice = chat_completion.choices[0]
+            tokens["sampled"] += chat_completion.usage.completion_tokens  # type: ignore
+            return art.Trajectory(
+                messages_and_choices=[*messages, choice], reward=random.random()
+            )
+
+        for _ in range(args.steps):
+            start = time.perf_counter()
+            groups = await art.gather_trajectory_groups(
+                (
+                    art.TrajectoryGroup(rollout(prompt) for _ in range(args.group_size))
+                    for prompt in range(args.groups)
+                ),
+                pbar_desc=None,
+            )
+            timings["gather"] += time.perf_counter() - start
+            async for _ in backend._train_model(
+                model,
+                groups,
+                art.TrainConfig(learning_rate=1e-4),
+                {"micro_batch_size": args.micro_batch_size},
+            ):
+                pass
+            timings["total"] += time.perf_counter() - start
+
+        await service.stop_openai_server()
+
+    print(f"{args.steps} steps of {args.groups} groups x {args.group_size}")
+    for stage in ["gather", "log", "tokenize + pack", "train", "checkpoint", "reload"]:
+        print(f"{stage:>16}: {timings[stage] / args.steps * 1000:8.1f}ms/step")
+    print(f"{'total':>16}: {timings['total'] / args.steps * 1000:8.1f}ms/step")
+    print(f"{'sampled':>16}: {tokens['sampled'] / timings['gather']:8.1f} tokens/s")
+    print(f"{'trained':>16}: {tokens['trained'] / timings['train']:8.1f} tokens/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
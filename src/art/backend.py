@@ -93,6 +93,18 @@ class Backend:
         )
         response.raise_for_status()
 
+    def _pretokenize_trajectory_group(
+        self,
+        model: "TrainableModel",
+        group: TrajectoryGroup,
+        dev_config: dev.TrainConfig,
+    ) -> None:
+        """
+        Starts tokenizing a gathered group in the background so that training can
+        reuse the results. Remote backends tokenize at training time instead.
+        """
+        pass
+
     async def _train_model(
         self,
         model: "TrainableModel",
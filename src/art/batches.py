@@ -1,11 +1,15 @@
 import asyncio
-from typing import AsyncIterator, Awaitable, Iterable
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Iterable
 
 from tqdm import auto as tqdm
 
+from . import dev
 from .gather import GatherContext, set_gather_context, wrap_group_awaitable
 from .trajectories import TrajectoryGroup
 
+if TYPE_CHECKING:
+    from .model import TrainableModel
+
 
 async def trajectory_group_batches(
     groups: Iterable[Awaitable[TrajectoryGroup]],
@@ -16,6 +20,8 @@ async def trajectory_group_batches(
     skip_batches: int = 0,
     pbar_desc: str | None = "batches",
     pbar_total_completion_tokens: bool = True,
+    pretokenize_for: "TrainableModel | None" = None,
+    pretokenize_config: dev.TrainConfig | None = None,
 ) -> AsyncIterator[list[TrajectoryGroup]]:
     unstarted = list(groups)[batch_size * skip_batches :]
     pending = set[asyncio.Task[TrajectoryGroup | None]]()
@@ -30,7 +36,13 @@ async def trajectory_group_batches(
             if context.pbar is None:
                 context.pbar = tqdm.tqdm(desc=pbar_desc, total=batch_size)
             while len(pending) < batch_size * max_concurrent_batches and unstarted:
-                pending.add(asyncio.create_task(wrap_group_awaitable(unstarted.pop(0))))
+                pending.add(
+                    asyncio.create_task(
+                        wrap_group_awaitable(
+                            unstarted.pop(0), pretokenize_for, pretokenize_config
+                        )
+                    )
+                )
             done, pending = await asyncio.wait(
                 pending, return_when=asyncio.FIRST_COMPLETED
             )
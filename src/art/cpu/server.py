@@ -0,0 +1,149 @@
+import asyncio
+import time
+import uuid
+from typing import TYPE_CHECKING, Any
+
+from aiohttp import web
+
+if TYPE_CHECKING:
+    from .service import CpuReferenceService
+
+
+def create_app(service: "CpuReferenceService") -> web.Application:
+    """
+    Returns a minimal OpenAI-compatible server for a `CpuReferenceService`.
+
+    It supports what the training pipeline uses: chat completions with
+    sampled token logprobs (as "token_id:<id>" tokens, like vLLM's
+    `return_tokens_as_token_ids`), completions for health checks, and the
+    vLLM request metrics that `LocalBackend` monitors.
+    """
+    tokenizer = service.tokenizer
+    num_requests_running = 0
+
+    async def generate(
+        prompt_token_ids: list[int], body: dict[str, Any]
+    ) -> list[tuple[list[int], list[float]]]:
+        nonlocal num_requests_running
+        num_requests_running += 1
+        try:
+            async with service._lock:
+                return await asyncio.to_thread(
+                    service.generate,
+                    prompt_token_ids,
+                    body.get("max_completion_tokens") or body.get("max_tokens") or 16,
+                    body.get("n") or 1,
+                    body.get("temperature", 1.0),
+                )
+        finally:
+            num_requests_running -= 1
+
+    def finish_reason(token_ids: list[int]) -> str:
+        return "stop" if token_ids[-1:] == [tokenizer.eos_token_id] else "length"
+
+    def usage(prompt_tokens: int, completions: list[tuple[list[int], list[float]]]):
+        completion_tokens = sum(len(token_ids) for token_ids, _ in completions)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt_token_ids = tokenizer.apply_chat_template(
+            body["messages"], tools=body.get("tools"), add_generation_prompt=True
+        )
+        completions = await generate(prompt_token_ids, body)  # type: ignore
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": index,
+                        "message": {
+                            "role": "assistant",
+                            "content": tokenizer.decode(
+                                token_ids, skip_special_tokens=True
+                            ),
+                        },
+                        "logprobs": (
+                            {
+                                "content": [
+                                    {
+                                        "token": f"token_id:{token_id}",
+                                        "logprob": logprob,
+                                        "bytes": list(
+                                            tokenizer.decode(token_id).encode()
+                                        ),
+                                        "top_logprobs": [],
+                                    }
+                                    for token_id, logprob in zip(token_ids, logprobs)
+                                ]
+                            }
+                            if body.get("logprobs")
+                            else None
+                        ),
+                        "finish_reason": finish_reason(token_ids),
+                    }
+                    for index, (token_ids, logprobs) in enumerate(completions)
+                ],
+                "usage": usage(len(prompt_token_ids), completions),  # type: ignore
+            }
+        )
+
+    async def completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt_token_ids = tokenizer.encode(body["prompt"], add_special_tokens=False)
+        completions = await generate(prompt_token_ids, body)
+        return web.json_response(
+            {
+                "id": f"cmpl-{uuid.uuid4().hex}",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": index,
+                        "text": tokenizer.decode(token_ids, skip_special_tokens=True),
+                        "logprobs": None,
+                        "finish_reason": finish_reason(token_ids),
+                    }
+                    for index, (token_ids, _) in enumerate(completions)
+                ],
+                "usage": usage(len(prompt_token_ids), completions),
+            }
+        )
+
+    async def models(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "id": service.model_name,
+                        "object": "model",
+                        "created": 0,
+                        "owned_by": "art",
+                    }
+                ],
+            }
+        )
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            text=(
+                f"vllm:num_requests_running {num_requests_running}\n"
+                "vllm:num_requests_waiting 0\n"
+            )
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_get("/v1/models", models)
+    app.router.add_get("/metrics", metrics)
+    return app
@@ -0,0 +1,260 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import TYPE_CHECKING, AsyncIterator
+
+import torch
+from transformers.models.auto.tokenization_auto import AutoTokenizer
+from transformers.models.llama.configuration_llama import LlamaConfig
+from transformers.models.llama.modeling_llama import LlamaForCausalLM
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+
+from .. import dev, types
+from ..preprocessing.pack import (
+    DiskPackedTensors,
+    micro_batches,
+    packed_tensors_from_dir,
+    upcast_packed_tensors,
+)
+from ..utils.get_model_step import get_step_from_dir
+from ..utils.output_dirs import get_step_checkpoint_dir
+from ..utils.segment_mask import SegmentMask
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+# Size of the randomly initialized reference model
+MODEL_CONFIG = dict(
+    hidden_size=64,
+    intermediate_size=128,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=4,
+    max_position_embeddings=32_768,
+)
+
+
+@dataclass
+class CpuReferenceService:
+    """
+    A `ModelService` that trains a tiny, randomly initialized causal LM on the
+    CPU and serves it with a minimal OpenAI-compatible server.
+
+    It exercises the rest of the pipeline (gathering, logging, tokenizing,
+    packing, the training loop, checkpointing and reloading) without a GPU or
+    vLLM, for benchmarks and regression tests. `base_model` must be the path or
+    name of a tokenizer, e.g. a saved `art.cpu.tokenizer.reference_tokenizer()`.
+    """
+
+    model_name: str
+    base_model: str
+    config: dev.InternalModelConfig
+    output_dir: str
+    _runner: "web.AppRunner | None" = None
+    # Serializes generation requests
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @cached_property
+    def tokenizer(self) -> PreTrainedTokenizerBase:
+        return AutoTokenizer.from_pretrained(self.base_model)
+
+    @cached_property
+    def model(self) -> LlamaForCausalLM:
+        """The model that is trained."""
+        checkpoint_dir = self._checkpoint_dir()
+        if checkpoint_dir is not None:
+            return LlamaForCausalLM.from_pretrained(checkpoint_dir)
+        torch.manual_seed(0)
+        model = LlamaForCausalLM(
+            LlamaConfig(
+                vocab_size=len(self.tokenizer),
+                bos_token_id=None,
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **MODEL_CONFIG,
+            )
+        )
+        self._save_checkpoint(model, get_step_checkpoint_dir(self.output_dir, 0))
+        return model
+
+    @cached_property
+    def inference_model(self) -> LlamaForCausalLM:
+        """The model that is served, reloaded from the latest checkpoint."""
+        self.model
+        return self._load_checkpoint(self._checkpoint_dir())
+
+    @cached_property
+    def optimizer(self) -> torch.optim.Optimizer:
+        return torch.optim.AdamW(self.model.parameters())
+
+    async def start_openai_server(self, config: dev.OpenAIServerConfig | None) -> None:
+        from aiohttp import web
+
+        from .server import create_app
+
+        await self.stop_openai_server()
+        server_args = (config or {}).get("server_args", {})
+        self.inference_model
+        self._runner = web.AppRunner(create_app(self))
+        await self._runner.setup()
+        await web.TCPSite(
+            self._runner,
+            server_args.get("host", "0.0.0.0"),
+            server_args.get("port", 8000),
+        ).start()
+
+    async def stop_openai_server(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def vllm_engine_is_sleeping(self) -> bool:
+        return False
+
+    async def train(
+        self,
+        disk_packed_tensors: list[DiskPackedTensors],
+        config: types.TrainConfig,
+        _config: dev.TrainConfig,
+        verbose: bool = False,
+    ) -> AsyncIterator[dict[str, float]]:
+        gradient_accumulation_steps = self.config.get("trainer_args", {}).get(
+            "gradient_accumulation_steps", 1
+        )
+        self.model.train()
+        for param_group in self.optimizer.param_groups:
+            param_group["lr"] = config.learning_rate
+        for bucket in disk_packed_tensors:
+            packed_tensors = packed_tensors_from_dir(**bucket)
+            for step in micro_batches(
+                packed_tensors,
+                _config.get("micro_batch_size", 1),
+                gradient_accumulation_steps,
+            ):
+                result = await asyncio.to_thread(
+                    self._train_step, step, _config, gradient_accumulation_steps
+                )
+                yield result
+        if verbose:
+            print("Saving new checkpoint...")
+        checkpoint_dir = get_step_checkpoint_dir(
+            self.output_dir, get_step_from_dir(self.output_dir) + 1
+        )
+        self._save_checkpoint(self.model, checkpoint_dir)
+        self.inference_model = self._load_checkpoint(checkpoint_dir)
+        if verbose:
+            print("CpuReferenceService.train complete")
+
+    def _train_step(
+        self,
+        step: list[dict[str, torch.Tensor]],
+        _config: dev.TrainConfig,
+        gradient_accumulation_steps: int,
+    ) -> dict[str, float]:
+        policy_losses = []
+        for micro_batch in step:
+            inputs = dict(micro_batch)
+            upcast_packed_tensors(inputs)  # type: ignore
+            policy_loss = self._policy_loss(inputs, _config)
+            # See `micro_batches`
+            loss_scale = inputs.pop("loss_scale")
+            (policy_loss * loss_scale / gradient_accumulation_steps).backward()
+            if inputs["assistant_mask"].any():
+                policy_losses.append(policy_loss.item())
+        grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        return {
+            "loss": sum(policy_losses) / max(len(policy_losses), 1),
+            "grad_norm": grad_norm.item(),
+        }
+
+    def _policy_loss(
+        self, inputs: dict[str, torch.Tensor], _config: dev.TrainConfig
+    ) -> torch.Tensor:
+        attn_bias = SegmentMask.from_ids(
+            inputs["group_ids"], inputs["parent_ids"]
+        ).to_attn_bias(torch.float32)
+        logits = self.model(
+            input_ids=inputs["tokens"],
+            attention_mask=attn_bias.unsqueeze(1),
+            position_ids=inputs["input_pos"],
+        ).logits[:, :-1]
+        new_logprobs = torch.log_softmax(logits.float(), dim=-1).gather(
+            -1, inputs["tokens"][:, 1:].unsqueeze(-1)
+        )[..., 0]
+        old_logprobs = inputs["logprobs"][:, 1:]
+        # Assume missing old logprobs were sampled under the current policy
+        old_logprobs = torch.where(
+            torch.isnan(old_logprobs), new_logprobs.detach(), old_logprobs
+        )
+        prob_ratio = torch.exp(new_logprobs - old_logprobs)
+        epsilon = _config.get("epsilon", 0.2)
+        epsilon_high = _config.get("epsilon_high", epsilon) or epsilon
+        advantages = inputs["advantages"][:, 1:]
+        policy_loss = -torch.min(
+            prob_ratio * advantages,
+            torch.clip(prob_ratio, 1 - epsilon, 1 + epsilon_high) * advantages,
+        )
+        assistant_mask = inputs["assistant_mask"][:, 1:].float()
+        return (policy_loss * inputs["weights"][:, 1:] * assistant_mask).sum() / (
+            assistant_mask.sum() + 1e-6
+        )
+
+    @torch.no_grad()
+    def generate(
+        self, prompt_token_ids: list[int], max_tokens: int, n: int, temperature: float
+    ) -> list[tuple[list[int], list[float]]]:
+        """
+        Samples `n` completions of up to `max_tokens` tokens and returns their
+        token ids and logprobs. Called by the server, one request at a time.
+        """
+        model = self.inference_model
+        input_ids = torch.tensor([prompt_token_ids] * n)
+        outputs = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_tokens,
+            do_sample=temperature > 0,
+            temperature=temperature or None,
+            top_k=None,
+            top_p=None,
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            output_logits=True,
+            return_dict_in_generate=True,
+        )
+        token_ids = outputs.sequences[:, len(prompt_token_ids) :]
+        logprobs = (
+            torch.log_softmax(torch.stack(outputs.logits, dim=1).float(), dim=-1)
+            .gather(-1, token_ids.unsqueeze(-1))[..., 0]
+            .tolist()
+        )
+        completions = []
+        for completion_token_ids, completion_logprobs in zip(
+            token_ids.tolist(), logprobs
+        ):
+            # Drop padding after the end of sequence token
+            if self.tokenizer.eos_token_id in completion_token_ids:
+                length = completion_token_ids.index(self.tokenizer.eos_token_id) + 1
+                completion_token_ids = completion_token_ids[:length]
+                completion_logprobs = completion_logprobs[:length]
+            completions.append((completion_token_ids, completion_logprobs))
+        return completions
+
+    def _checkpoint_dir(self) -> str | None:
+        checkpoint_dir = get_step_checkpoint_dir(
+            self.output_dir, get_step_from_dir(self.output_dir)
+        )
+        return checkpoint_dir if os.path.exists(checkpoint_dir) else None
+
+    def _save_checkpoint(self, model: LlamaForCausalLM, checkpoint_dir: str) -> None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        model.save_pretrained(checkpoint_dir)
+
+    def _load_checkpoint(self, checkpoint_dir: str | None) -> LlamaForCausalLM:
+        assert checkpoint_dir is not None, "No checkpoint to load"
+        model = LlamaForCausalLM.from_pretrained(checkpoint_dir)
+        model.eval()
+        return model
@@ -0,0 +1,38 @@
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+from transformers.tokenization_utils_fast import PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\\n' + message['content'] + '<|im_end|>\\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\\n' }}{% endif %}"
+)
+
+
+def reference_tokenizer() -> PreTrainedTokenizerFast:
+    """
+    Returns a byte-level tokenizer with a ChatML chat template that needs no
+    download. Every byte is a token, so any text round-trips.
+
+    Save it with `save_pretrained` and use the directory as the base model of a
+    model trained with `CpuReferenceService`.
+    """
+    # Printable ASCII bytes get the highest ids, so the sentinel that tokenization
+    # picks from the end of the vocabulary decodes to a character on its own
+    byte_chars = sorted(
+        bytes_to_unicode().items(), key=lambda item: 33 <= item[0] < 127
+    )
+    vocab = {char: token_id for token_id, (_, char) in enumerate(byte_chars)}
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.add_special_tokens(SPECIAL_TOKENS)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        chat_template=CHAT_TEMPLATE,
+    )
@@ -43,6 +43,7 @@ def get_model_config(
             16
             if config.get("torchtune_args") is None
             and not config.get("_decouple_vllm_and_unsloth", False)
+            and torch.cuda.is_available()
             and torch.cuda.get_device_capability()[0] >= 8
             else 1
         ),
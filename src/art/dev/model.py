@@ -122,6 +122,7 @@ class InternalModelConfig(TypedDict, total=False):
     trainer_args: "TrainerArgs"
     torchtune_args: TorchtuneArgs | None
     _decouple_vllm_and_unsloth: bool
+    _cpu_reference_service: bool
 
 
 class InitArgs(TypedDict, total=False):
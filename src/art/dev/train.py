@@ -14,11 +14,68 @@ positive advantages. Defaults to 0.0 (perfectly balanced)."""
         float | None
     )  # asymmetric clip upper bound. Defaults to epsilon when None
     importance_sampling_level: Literal["token", "sequence"]
+    incremental_tokenization: bool
+    """Tokenize each distinct chat template segment once per trajectory group \
+and reuse the token ids across trajectories. Output is identical to the default \
+path. Defaults to False."""
     logprob_calculation_chunk_size: int
+    logprob_calculation_vocab_chunk_size: int
+    """Also split the vocabulary into chunks of this size when calculating \
+logprobs and entropies, combining them with an online logsumexp, so that the \
+full [batch, chunk, vocabulary] logits are never materialized. Gradients are \
+recomputed chunk by chunk in the backward pass. Defaults to 0 (whole \
+vocabulary at once)."""
     max_negative_advantage_importance_sampling_weight: float
+    micro_batch_size: int
+    """Number of packed sequences per forward pass when training. Gradients are \
+accumulated over the trainer's `gradient_accumulation_steps` forward passes per \
+optimizer step. Defaults to 1."""
     num_trajectories_learning_rate_multiplier_power: float
+    packed_tensors_bf16: bool
+    """Store advantages and weights of packed batches as bfloat16 on disk, \
+halving their size. They are cast back to float32 on the training device. \
+Defaults to False."""
+    packing_strategy: Literal["greedy", "first_fit_decreasing"]
+    """How tokenized trajectories are packed into sequences. "greedy" packs them \
+in order. "first_fit_decreasing" keeps trajectories that share a prompt together \
+and fills sequences largest first, which usually needs fewer sequences and thus \
+fewer gradient steps. Defaults to "greedy"."""
     plot_tensors: bool
     precalculate_logprobs: bool
+    precalculation_batch_size: int
+    """Number of sequences per forward pass when calculating logprobs before \
+training on a batch, i.e. the reference model logprobs cached once per batch when \
+beta > 0 and the policy logprobs with `precalculate_logprobs`. Defaults to 1."""
     scale_learning_rate_by_reward_std_dev: bool
     scale_rewards: bool
+    sequence_length_buckets: list[int]
+    """Sequence lengths to pack trajectories into, e.g. [2048, 8192, 32768]. Each \
+trajectory goes to the shortest bucket it fits into and every bucket is packed \
+and trained on separately, so a few long trajectories do not pad the whole batch \
+to their length. Lengths are rounded up to a multiple of \
+logprob_calculation_chunk_size and capped at the model's max_seq_length. \
+Defaults to a single bucket of max_seq_length."""
+    staging_buffers: int
+    """Number of reusable buffers packed batches are written to. A batch's buffer \
+is only reused once training on it finished, so with two or more buffers the \
+next batch can be packed while the previous one is still being trained on. \
+Read when the model is first trained. Defaults to 2."""
+    staging_dir: str
+    """Directory for the packed tensor buffers. Read when the model is first \
+trained. Defaults to /dev/shm if it exists, otherwise the model directory."""
+    tokenization_cache_size: int
+    """Maximum size in bytes of the on-disk tokenization cache in the model \
+directory. Histories that were already tokenized, e.g. when resuming a run or \
+retrying a step, are loaded from the cache instead. Least recently used entries \
+are evicted first. Defaults to 0 (disabled)."""
+    tokenize_workers: int
+    """Number of worker processes used to tokenize trajectory groups. Each worker \
+loads the tokenizer once and results do not depend on the number of workers. \
+Defaults to 0 (tokenize in the backend process)."""
     truncated_importance_sampling: float | None
+    warmup: Literal["auto", "always", "never"]
+    """Whether a service's first training call starts with a throwaway step at a \
+negligible learning rate that compiles and autotunes kernels. "auto" skips it if a \
+previous service already warmed up the compile cache in the model's output \
+directory. The time it takes is reported as the "warmup_time" metric. Defaults to \
+"auto"."""
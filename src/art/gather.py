@@ -3,13 +3,25 @@ import contextlib
 import contextvars
 from collections import Counter
 from dataclasses import dataclass, field
-from typing import Awaitable, Callable, Iterable, Iterator, Literal, overload
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    Literal,
+    overload,
+)
 
 from openai.types.chat.chat_completion import Choice
 from tqdm import auto as tqdm
 
+from . import dev
 from .trajectories import Trajectory, TrajectoryGroup
 
+if TYPE_CHECKING:
+    from .model import TrainableModel
+
 
 async def gather_trajectory_groups(
     groups: Iterable[Awaitable[TrajectoryGroup]],
@@ -22,7 +34,17 @@ async def gather_trajectory_groups(
         [TrajectoryGroup], Awaitable[TrajectoryGroup | None | list[TrajectoryGroup]]
     ]
     | None = None,
+    pretokenize_for: "TrainableModel | None" = None,
+    pretokenize_config: dev.TrainConfig | None = None,
 ) -> list[TrajectoryGroup]:
+    """
+    Gathers trajectory groups concurrently.
+
+    If `pretokenize_for` is provided, each group is tokenized for that model in
+    the background as soon as it completes, so that `model.train()` can skip
+    most of its tokenization. Pass the same `_config` you will train with as
+    `pretokenize_config`.
+    """
     groups = list(groups)
     context = GatherContext(
         pbar=None,
@@ -31,7 +53,12 @@ async def gather_trajectory_groups(
         max_metrics=max_metrics,
     )
     with set_gather_context(context):
-        future = asyncio.gather(*[wrap_group_awaitable(g) for g in groups])
+        future = asyncio.gather(
+            *[
+                wrap_group_awaitable(g, pretokenize_for, pretokenize_config)
+                for g in groups
+            ]
+        )
         total = sum(getattr(g, "_num_trajectories", 1) for g in groups)
         context.pbar = tqdm.tqdm(desc=pbar_desc, total=total)
         result_groups = await future
@@ -132,21 +159,27 @@ async def gather_trajectories(
 
 async def wrap_group_awaitable(
     awaitable: Awaitable[TrajectoryGroup],
+    pretokenize_for: "TrainableModel | None" = None,
+    pretokenize_config: dev.TrainConfig | None = None,
 ) -> TrajectoryGroup | None:
     if hasattr(awaitable, "_num_trajectories"):
-        return await awaitable
+        group = await awaitable
+        pretokenize(group, pretokenize_for, pretokenize_config)
+        return group
     context = get_gather_context()
     try:
         group = await awaitable
         for trajectory in group:
             record_metrics(context, trajectory)
         context.update_pbar(n=len(group))
-        return group
     except BaseException:
         context.metric_sums["exceptions"] += 1
         context.update_pbar(n=0)
         if context.too_many_exceptions():
             raise
+        return None
+    pretokenize(group, pretokenize_for, pretokenize_config)
+    return group
 
 
 async def wrap_trajectories_awaitable(
@@ -173,6 +206,16 @@ async def wrap_trajectories_awaitable(
             return e
 
 
+def pretokenize(
+    group: TrajectoryGroup,
+    model: "TrainableModel | None",
+    config: dev.TrainConfig | None,
+) -> None:
+    if model is None or not group:
+        return
+    model.backend()._pretokenize_trajectory_group(model, group, config or {})
+
+
 def record_metrics(context: "GatherContext", trajectory: Trajectory) -> None:
     logprobs = [
         message_or_choice.logprobs
@@ -3,6 +3,8 @@ import json
 import math
 import os
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from types import TracebackType
 from typing import AsyncIterator, Literal, cast
@@ -46,12 +48,28 @@ from .. import dev
 from ..backend import Backend
 from ..model import Model, TrainableModel
 from ..preprocessing.pack import (
-    PackedTensors,
-    packed_tensors_from_tokenized_results,
-    packed_tensors_to_dir,
+    DiskPackedTensors,
+    PackingStats,
+    PackingStrategy,
+    StagingBuffers,
+    bucketed_disk_packed_tensors_from_tokenized_results,
+    count_gradient_steps,
+    packed_tensors_from_dir,
+    packing_stats,
     plot_packed_tensors,
 )
-from ..preprocessing.tokenize import tokenize_trajectory_groups
+from ..preprocessing.tokenize import (
+    CompactTokenizedResult,
+    DiskTokenizationCache,
+    TokenizedResult,
+    TokenizerCache,
+    get_tokenize_executor,
+    pretokenize_trajectory_group,
+    submit_trajectory_histories,
+    tokenize_trajectory_groups,
+    tokenize_trajectory_groups_in_parallel,
+    tokenize_trajectory_histories,
+)
 from ..trajectories import Trajectory, TrajectoryGroup
 from ..types import Message, TrainConfig
 from ..utils import format_message, get_model_step
@@ -81,6 +99,10 @@ class LocalBackend(Backend):
         # Other initialization
         self._services: dict[str, ModelService] = {}
         self._tokenizers: dict[str, "PreTrainedTokenizerBase"] = {}
+        self._tokenizer_caches: dict[str, TokenizerCache] = {}
+        self._tokenize_executors: dict[str, tuple[int, ProcessPoolExecutor]] = {}
+        self._staging_buffers: dict[str, StagingBuffers] = {}
+        self._pretokenize_executor = ThreadPoolExecutor(max_workers=1)
         self._wandb_runs: dict[str, Run] = {}
         self._weave_clients: dict[str, WeaveClient] = {}
 
@@ -104,6 +126,13 @@ class LocalBackend(Backend):
     def _close(self) -> None:
         for _, service in self._services.items():
             close_proxy(service)
+        for _, executor in self._tokenize_executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._tokenize_executors.clear()
+        self._pretokenize_executor.shutdown(wait=False, cancel_futures=True)
+        for staging_buffers in self._staging_buffers.values():
+            staging_buffers.remove()
+        self._staging_buffers.clear()
 
     async def register(
         self,
@@ -125,6 +154,7 @@ class LocalBackend(Backend):
             _ = self._get_wandb_run(model)
 
     async def _get_service(self, model: TrainableModel) -> ModelService:
+        from ..cpu.service import CpuReferenceService
         from ..dev.get_model_config import get_model_config
         from ..torchtune.service import TorchtuneService
         from ..unsloth.decoupled_service import DecoupledUnslothService
@@ -136,7 +166,9 @@ class LocalBackend(Backend):
                 output_dir=get_model_dir(model=model, art_path=self._path),
                 config=model._internal_config,
             )
-            if config.get("torchtune_args") is not None:
+            if config.get("_cpu_reference_service", False):
+                service_class = CpuReferenceService
+            elif config.get("torchtune_args") is not None:
                 service_class = TorchtuneService
             elif config.get("_decouple_vllm_and_unsloth", False):
                 service_class = DecoupledUnslothService
@@ -176,55 +208,224 @@ class LocalBackend(Backend):
         allow_training_without_logprobs: bool,
         scale_rewards: bool,
         plot_tensors: bool,
-    ) -> PackedTensors | None:
-        if model.base_model not in self._tokenizers:
-            self._tokenizers[model.base_model] = AutoTokenizer.from_pretrained(
-                model.base_model
-            )
-        tokenizer = self._tokenizers[model.base_model]
-        tokenized_results = list(
-            tokenize_trajectory_groups(
-                tokenizer,
+        incremental_tokenization: bool = False,
+        tokenize_workers: int = 0,
+        tokenization_cache_size: int = 0,
+        packing_strategy: PackingStrategy = "greedy",
+        packed_tensors_bf16: bool = False,
+        sequence_length_buckets: list[int] | None = None,
+        chunk_size: int = 1024,
+        tensors_dir: str | None = None,
+    ) -> tuple[list[DiskPackedTensors], PackingStats] | None:
+        """
+        Tokenizes and packs trajectory groups into buckets on disk. Returns the
+        buckets and their packing statistics, or `None` if there is nothing to
+        train on.
+        """
+        tokenizer_cache = self._pretokenize_executor.submit(
+            self._get_tokenizer_cache, model
+        ).result()
+        tokenizer = tokenizer_cache.tokenizer
+        disk_cache = self._get_disk_tokenization_cache(model, tokenization_cache_size)
+        timings: dict[str, float] = {}
+        if tokenize_workers > 0:
+            tokenized_results, timings = tokenize_trajectory_groups_in_parallel(
+                self._pretokenize_executor.submit(
+                    self._get_tokenize_executor, model, tokenize_workers
+                ).result(),
                 trajectory_groups,
                 allow_training_without_logprobs,
                 scale_rewards,
+                incremental=incremental_tokenization,
+                # Finishes groups that were pretokenized while gathering
+                tokenizer_cache=tokenizer_cache,
+                disk_cache=disk_cache,
+                compact=True,
             )
-        )
+        else:
+            tokenized_results = list(
+                tokenize_trajectory_groups(
+                    tokenizer,
+                    trajectory_groups,
+                    allow_training_without_logprobs,
+                    scale_rewards,
+                    tokenizer_cache=tokenizer_cache,
+                    incremental=incremental_tokenization,
+                    disk_cache=disk_cache,
+                    compact=True,
+                )
+            )
+        if disk_cache is not None:
+            disk_cache.evict()
         if not tokenized_results:
             return None
-        max_tokens = max(len(result.tokens) for result in tokenized_results)
-        # Round up max_tokens to the nearest multiple of 2048
-        sequence_length = math.ceil(max_tokens / 2048) * 2048
-        # Cap sequence length at the model's max sequence length
-        sequence_length = min(
-            sequence_length,
+        max_seq_length = (
             (model._internal_config or dev.InternalModelConfig())
             .get("init_args", {})
-            .get("max_seq_length", 32_768),
+            .get("max_seq_length", 32_768)
         )
-        packed_tensors = packed_tensors_from_tokenized_results(
+        # Bucket lengths must be divisible by the logprob calculation chunk size
+        bucket_lengths = sorted(
+            {
+                min(math.ceil(length / chunk_size) * chunk_size, max_seq_length)
+                for length in sequence_length_buckets or [max_seq_length]
+            }
+        )
+        pack_start = time.perf_counter()
+        disk_packed_tensors = bucketed_disk_packed_tensors_from_tokenized_results(
             tokenized_results,
-            sequence_length,
+            tensors_dir or f"{get_model_dir(model=model, art_path=self._path)}/tensors",
+            bucket_lengths,
+            # Round sequence lengths up to the nearest multiple of 2048
+            length_multiple=math.lcm(2048, chunk_size),
             pad_token_id=tokenizer.eos_token_id,  # type: ignore
             advantage_balance=advantage_balance,
+            packing_strategy=packing_strategy,
+            bf16=packed_tensors_bf16,
         )
-        if (
-            not allow_training_without_logprobs
-            and np.isnan(packed_tensors["logprobs"]).all()
+        timings["pack"] = time.perf_counter() - pack_start
+        if not disk_packed_tensors:
+            return None
+        buckets = [packed_tensors_from_dir(**bucket) for bucket in disk_packed_tensors]
+        if not allow_training_without_logprobs and all(
+            packed_tensors["logprobs"].isnan().all() for packed_tensors in buckets
         ):
             print(
                 "There are no assistant logprobs to train on. Did you forget to include at least one Choice in Trajectory.messages_and_choices?"
             )
             return None
+        stats = packing_stats(buckets)
         if plot_tensors:
-            plot_packed_tensors(
-                packed_tensors, get_model_dir(model=model, art_path=self._path)
-            )
+            for packed_tensors in buckets:
+                plot_packed_tensors(
+                    packed_tensors, get_model_dir(model=model, art_path=self._path)
+                )
         else:
             print(
-                f"Packed {len(tokenized_results)} trajectories into {packed_tensors['tokens'].shape[0]} sequences of length {packed_tensors['tokens'].shape[1]}"
+                f"Packed {len(tokenized_results)} trajectories into "
+                + ", ".join(
+                    f"{bucket['num_sequences']} sequences of length {bucket['sequence_length']}"
+                    for bucket in disk_packed_tensors
+                )
+                + f" ({stats['padding_fraction']:.1%} padding, {stats['duplicated_prompt_tokens']} duplicated prompt tokens)"
             )
-        return packed_tensors
+        if tokenize_workers > 0:
+            print(
+                f"Tokenized with {tokenize_workers} workers in {timings['tokenize']:.2f}s "
+                f"({timings['tokenize_worker']:.2f}s of worker time), "
+                f"packed in {timings['pack']:.2f}s"
+            )
+        return disk_packed_tensors, stats
+
+    def _get_staging_buffers(
+        self, model: TrainableModel, dev_config: dev.TrainConfig
+    ) -> StagingBuffers:
+        if model.name not in self._staging_buffers:
+            staging_dir = dev_config.get("staging_dir") or (
+                "/dev/shm"
+                if os.path.isdir("/dev/shm")
+                else get_model_dir(model=model, art_path=self._path)
+            )
+            self._staging_buffers[model.name] = StagingBuffers(
+                f"{staging_dir}/art-tensors/{model.project}/{model.name}",
+                num_buffers=dev_config.get("staging_buffers", 2),
+            )
+        return self._staging_buffers[model.name]
+
+    def _get_tokenizer(self, model: TrainableModel) -> "PreTrainedTokenizerBase":
+        """
+        Loads the model's tokenizer once. Like `_get_tokenizer_cache` and
+        `_get_tokenize_executor`, only call this on `self._pretokenize_executor`,
+        so loading never blocks the event loop and only one thread mutates the
+        tokenizer dicts.
+        """
+        if model.base_model not in self._tokenizers:
+            self._tokenizers[model.base_model] = AutoTokenizer.from_pretrained(
+                model.base_model
+            )
+        return self._tokenizers[model.base_model]
+
+    def _get_tokenizer_cache(self, model: TrainableModel) -> TokenizerCache:
+        if model.base_model not in self._tokenizer_caches:
+            self._tokenizer_caches[model.base_model] = TokenizerCache.from_tokenizer(
+                self._get_tokenizer(model)
+            )
+        return self._tokenizer_caches[model.base_model]
+
+    def _pretokenize_trajectory_group(
+        self,
+        model: TrainableModel,
+        group: TrajectoryGroup,
+        dev_config: dev.TrainConfig,
+    ) -> None:
+        allow_training_without_logprobs = dev_config.get(
+            "allow_training_without_logprobs", False
+        )
+        incremental = dev_config.get("incremental_tokenization", False)
+        disk_cache = self._get_disk_tokenization_cache(
+            model, dev_config.get("tokenization_cache_size", 0)
+        )
+        trajectories = list(group.trajectories)
+        tokenize_workers = dev_config.get("tokenize_workers", 0)
+
+        # Runs on the pretokenize thread, so the event loop never waits for a
+        # tokenizer to load
+        def tokenize_histories() -> list[
+            list[TokenizedResult | CompactTokenizedResult | None]
+        ]:
+            if tokenize_workers > 0:
+                return submit_trajectory_histories(
+                    self._get_tokenize_executor(model, tokenize_workers),
+                    trajectories,
+                    allow_training_without_logprobs,
+                    incremental,
+                    disk_cache,
+                    compact=True,
+                ).result()
+            tokenizer_cache = self._get_tokenizer_cache(model)
+            return tokenize_trajectory_histories(
+                tokenizer_cache.tokenizer,
+                trajectories,
+                allow_training_without_logprobs,
+                tokenizer_cache,
+                incremental,
+                disk_cache,
+                compact=True,
+            )
+
+        histories = self._pretokenize_executor.submit(tokenize_histories)
+        pretokenize_trajectory_group(
+            group,
+            # The name the tokenizer is loaded with, see _get_tokenizer
+            model.base_model,
+            allow_training_without_logprobs,
+            histories,
+            compact=True,
+        )
+
+    def _get_disk_tokenization_cache(
+        self, model: TrainableModel, max_size: int
+    ) -> DiskTokenizationCache | None:
+        if max_size <= 0:
+            return None
+        return DiskTokenizationCache(
+            os.path.join(
+                get_model_dir(model=model, art_path=self._path), "tokenization_cache"
+            ),
+            max_size,
+        )
+
+    def _get_tokenize_executor(
+        self, model: TrainableModel, num_workers: int
+    ) -> ProcessPoolExecutor:
+        if model.base_model in self._tokenize_executors:
+            executor_workers, executor = self._tokenize_executors[model.base_model]
+            if executor_workers == num_workers:
+                return executor
+            executor.shutdown(wait=False, cancel_futures=True)
+        executor = get_tokenize_executor(self._get_tokenizer(model), num_workers)
+        self._tokenize_executors[model.base_model] = (num_workers, executor)
+        return executor
 
     async def _get_step(self, model: TrainableModel) -> int:
         return self.__get_step(model)
@@ -414,100 +615,125 @@ class LocalBackend(Backend):
             if group and len(set(trajectory.reward for trajectory in group)) > 1
         )
 
-        packed_tensors = self._get_packed_tensors(
-            model,
-            trajectory_groups,
-            advantage_balance=dev_config.get("advantage_balance", 0.0),
-            allow_training_without_logprobs=dev_config.get(
-                "allow_training_without_logprobs", False
-            ),
-            scale_rewards=dev_config.get("scale_rewards", True),
-            plot_tensors=dev_config.get("plot_tensors", False),
-        )
-        if packed_tensors is None:
-            print(
-                "Skipping tuning as there is no suitable data. "
-                "This can happen when all the trajectories in the same group "
-                "have the same reward and thus no advantage to train on."
-            )
-
-            # Still advance the step by renaming the checkpoint directory
-            current_step = self.__get_step(model)
-            next_step = current_step + 1
-            current_checkpoint_dir = get_step_checkpoint_dir(
-                get_model_dir(model=model, art_path=self._path), current_step
-            )
-            next_checkpoint_dir = get_step_checkpoint_dir(
-                get_model_dir(model=model, art_path=self._path), next_step
+        # Packed tensors are written to a staging buffer that is handed to the
+        # service and only returned to the ring once training on it finished
+        async with self._get_staging_buffers(model, dev_config).buffer() as tensors_dir:
+            packed = self._get_packed_tensors(
+                model,
+                trajectory_groups,
+                advantage_balance=dev_config.get("advantage_balance", 0.0),
+                allow_training_without_logprobs=dev_config.get(
+                    "allow_training_without_logprobs", False
+                ),
+                scale_rewards=dev_config.get("scale_rewards", True),
+                plot_tensors=dev_config.get("plot_tensors", False),
+                incremental_tokenization=dev_config.get(
+                    "incremental_tokenization", False
+                ),
+                tokenize_workers=dev_config.get("tokenize_workers", 0),
+                tokenization_cache_size=dev_config.get("tokenization_cache_size", 0),
+                packing_strategy=dev_config.get("packing_strategy", "greedy"),
+                packed_tensors_bf16=dev_config.get("packed_tensors_bf16", False),
+                sequence_length_buckets=dev_config.get("sequence_length_buckets"),
+                chunk_size=dev_config.get("logprob_calculation_chunk_size", 1024),
+                tensors_dir=tensors_dir,
             )
-
-            # If the current checkpoint exists, rename it to the next step
-            if os.path.exists(current_checkpoint_dir):
-                os.rename(current_checkpoint_dir, next_checkpoint_dir)
+            if packed is None:
                 print(
-                    f"Advanced step from {current_step} to {next_step} (no training occurred)"
+                    "Skipping tuning as there is no suitable data. "
+                    "This can happen when all the trajectories in the same group "
+                    "have the same reward and thus no advantage to train on."
                 )
 
-            # Log metrics showing no groups were trainable
-            self._log_metrics(
-                model,
-                {
-                    "num_groups_submitted": num_groups_submitted,
-                    "num_groups_trainable": 0,
-                },
-                "train",
-                step=next_step,
-            )
-            return
-        disk_packed_tensors = packed_tensors_to_dir(
-            packed_tensors, f"{get_model_dir(model=model, art_path=self._path)}/tensors"
-        )
-        if dev_config.get("scale_learning_rate_by_reward_std_dev", False):
-            config = config.model_copy(
-                update={
-                    "learning_rate": config.learning_rate
-                    * self._get_reward_std_dev_learning_rate_multiplier(model)
-                }
-            )
-        results: list[dict[str, float]] = []
-        estimated_gradient_steps = disk_packed_tensors["num_sequences"]
-        if torchtune_args := (model._internal_config or dev.InternalModelConfig()).get(
-            "torchtune_args"
-        ):
-            tp = torchtune_args.get("tensor_parallel_dim", 1)
-            cp = torchtune_args.get("context_parallel_dim", 1)
-            world_size = torch.cuda.device_count()
-            dp = world_size // (tp * cp)
-            estimated_gradient_steps = math.ceil(estimated_gradient_steps / dp)
-        pbar = tqdm.tqdm(total=estimated_gradient_steps, desc="train")
-        async for result in service.train(
-            disk_packed_tensors, config, dev_config, verbose
-        ):
-            num_gradient_steps = int(
-                result.pop("num_gradient_steps", estimated_gradient_steps)
-            )
-            assert num_gradient_steps == estimated_gradient_steps, (
-                f"num_gradient_steps {num_gradient_steps} != estimated_gradient_steps {estimated_gradient_steps}"
+                # Still advance the step by renaming the checkpoint directory
+                current_step = self.__get_step(model)
+                next_step = current_step + 1
+                current_checkpoint_dir = get_step_checkpoint_dir(
+                    get_model_dir(model=model, art_path=self._path), current_step
+                )
+                next_checkpoint_dir = get_step_checkpoint_dir(
+                    get_model_dir(model=model, art_path=self._path), next_step
+                )
+
+                # If the current checkpoint exists, rename it to the next step
+                if os.path.exists(current_checkpoint_dir):
+                    os.rename(current_checkpoint_dir, next_checkpoint_dir)
+                    print(
+                        f"Advanced step from {current_step} to {next_step} (no training occurred)"
+                    )
+
+                # Log metrics showing no groups were trainable
+                self._log_metrics(
+                    model,
+                    {
+                        "num_groups_submitted": num_groups_submitted,
+                        "num_groups_trainable": 0,
+                    },
+                    "train",
+                    step=next_step,
+                )
+                return
+            disk_packed_tensors, stats = packed
+            if dev_config.get("scale_learning_rate_by_reward_std_dev", False):
+                config = config.model_copy(
+                    update={
+                        "learning_rate": config.learning_rate
+                        * self._get_reward_std_dev_learning_rate_multiplier(model)
+                    }
+                )
+            results: list[dict[str, float]] = []
+            internal_config = model._internal_config or dev.InternalModelConfig()
+            estimated_gradient_steps = sum(
+                count_gradient_steps(
+                    bucket["num_sequences"],
+                    dev_config.get("micro_batch_size", 1),
+                    internal_config.get("trainer_args", {}).get(
+                        "gradient_accumulation_steps", 1
+                    ),
+                )
+                for bucket in disk_packed_tensors
             )
-            results.append(result)
-            yield {**result, "num_gradient_steps": num_gradient_steps}
-            pbar.update(1)
-            pbar.set_postfix(result)
-        pbar.close()
-        if verbose:
-            print("Logging metrics...")
-        data = {
-            k: sum(d.get(k, 0) for d in results) / sum(1 for d in results if k in d)
-            for k in {k for d in results for k in d}
-        }
-        # Add group counting metrics
-        data["num_groups_submitted"] = num_groups_submitted
-        data["num_groups_trainable"] = num_groups_trainable
-        # Get the current step after training
-        current_step = self.__get_step(model)
-        self._log_metrics(model, data, "train", step=current_step)
-        if verbose:
-            print("_train_model complete")
+            if torchtune_args := internal_config.get("torchtune_args"):
+                tp = torchtune_args.get("tensor_parallel_dim", 1)
+                cp = torchtune_args.get("context_parallel_dim", 1)
+                world_size = torch.cuda.device_count()
+                dp = world_size // (tp * cp)
+                estimated_gradient_steps = sum(
+                    math.ceil(bucket["num_sequences"] / dp)
+                    for bucket in disk_packed_tensors
+                )
+            pbar = tqdm.tqdm(total=estimated_gradient_steps, desc="train")
+            async for result in service.train(
+                disk_packed_tensors, config, dev_config, verbose
+            ):
+                num_gradient_steps = int(
+                    result.pop("num_gradient_steps", estimated_gradient_steps)
+                )
+                assert num_gradient_steps == estimated_gradient_steps, (
+                    f"num_gradient_steps {num_gradient_steps} != estimated_gradient_steps {estimated_gradient_steps}"
+                )
+                results.append(result)
+                yield {**result, "num_gradient_steps": num_gradient_steps}
+                pbar.update(1)
+                pbar.set_postfix(result)
+            pbar.close()
+            if verbose:
+                print("Logging metrics...")
+            data = {
+                k: sum(d.get(k, 0) for d in results) / sum(1 for d in results if k in d)
+                for k in {k for d in results for k in d}
+            }
+            # Add group counting metrics
+            data["num_groups_submitted"] = num_groups_submitted
+            data["num_groups_trainable"] = num_groups_trainable
+            # Add packing efficiency metrics
+            data["packing_padding_fraction"] = stats["padding_fraction"]
+            data["packing_duplicated_prompt_tokens"] = stats["duplicated_prompt_tokens"]
+            # Get the current step after training
+            current_step = self.__get_step(model)
+            self._log_metrics(model, data, "train", step=current_step)
+            if verbose:
+                print("_train_model complete")
 
     def _get_reward_std_dev_learning_rate_multiplier(
         self, model: TrainableModel
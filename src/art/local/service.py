@@ -23,7 +23,7 @@ class ModelService(Protocol):
 
     def train(
         self,
-        disk_packed_tensors: DiskPackedTensors,
+        disk_packed_tensors: list[DiskPackedTensors],
         config: types.TrainConfig,
         _config: dev.TrainConfig,
         verbose: bool = False,
@@ -1,15 +1,35 @@
+import asyncio
+import bisect
+import math
 import os
 import random
+import shutil
 import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator, Literal, Sequence
 
+import numpy as np
 import torch
-from typing_extensions import TypedDict, Unpack
+from typing_extensions import NotRequired, TypedDict, Unpack
 
 from ..types import Verbosity
-from .tokenize import TokenizedResult
+from .tokenize import CompactTokenizedResult, TokenizedResult
 
 
 class PackedTensors(TypedDict):
+    """
+    Trajectories packed into sequences of equal length.
+
+    Every prompt and every completion in a batch gets a unique pre-order id,
+    such that the ids of a prompt's nested prompts and completions follow it
+    contiguously. `group_ids` holds the id of each token's prompt or
+    completion and `parent_ids` the last id of its subtree, so a token may
+    attend to an earlier token if
+    `group_ids[kv] <= group_ids[q] <= parent_ids[kv]`. Completion tokens have
+    `group_ids == parent_ids` and padding is -1.
+    """
+
     tokens: torch.Tensor
     group_ids: torch.Tensor
     parent_ids: torch.Tensor
@@ -18,142 +38,788 @@ class PackedTensors(TypedDict):
     logprobs: torch.Tensor
     advantages: torch.Tensor
     weights: torch.Tensor
+    ref_logprobs: NotRequired[torch.Tensor]
+    """Reference model logprobs, filled in by the model service."""
 
 
 class DiskPackedTensors(TypedDict):
     dir: str
     num_sequences: int
     sequence_length: int
+    version: NotRequired[int]
+    """Version of the on-disk format, see `packed_tensors_from_dir`. Defaults to 1."""
+    bf16: NotRequired[bool]
+    """Whether advantages and weights are stored as bfloat16 (version 2 only)."""
+    ref_logprobs: NotRequired[bool]
+    """Whether to map a float32 `ref_logprobs` column. Its contents are only
+    meaningful once the model service has filled them in for this batch."""
+
+
+DISK_PACKED_TENSORS_VERSION = 2
+# The dtypes of each on-disk format version. Version 1 matches `PackedTensors`.
+# Version 2 stores ids and positions as int32, which is lossless because group
+# and parent ids are dense pre-order ids.
+_DTYPES: dict[int, dict[str, torch.dtype]] = {
+    1: {
+        "tokens": torch.long,
+        "group_ids": torch.long,
+        "parent_ids": torch.long,
+        "input_pos": torch.long,
+        "assistant_mask": torch.bool,
+        "logprobs": torch.float32,
+        "advantages": torch.float32,
+        "weights": torch.float32,
+    },
+    2: {
+        "tokens": torch.int32,
+        "group_ids": torch.int32,
+        "parent_ids": torch.int32,
+        "input_pos": torch.int32,
+        "assistant_mask": torch.bool,
+        "logprobs": torch.float32,
+        "advantages": torch.float32,
+        "weights": torch.float32,
+    },
+}
+
+
+class VarlenPackedTensors(TypedDict):
+    """
+    Trajectories packed into sequences of variable length without padding.
+
+    Holds the same keys as `PackedTensors`, but every tensor is a flat stream of
+    all sequences' tokens and sequence `i` spans
+    `cu_seqlens[i]:cu_seqlens[i + 1]`.
+    """
+
+    tokens: torch.Tensor
+    group_ids: torch.Tensor
+    parent_ids: torch.Tensor
+    input_pos: torch.Tensor
+    assistant_mask: torch.Tensor
+    logprobs: torch.Tensor
+    advantages: torch.Tensor
+    weights: torch.Tensor
+    cu_seqlens: torch.Tensor
+
+
+PackingStrategy = Literal["greedy", "first_fit_decreasing"]
+
+
+class PackingStats(TypedDict):
+    num_sequences: int
+    padding_fraction: float
+    duplicated_prompt_tokens: int
 
 
 def packed_tensors_from_tokenized_results(
-    tokenized_results: list[TokenizedResult],
+    tokenized_results: Sequence[TokenizedResult | CompactTokenizedResult],
     seq_len: int,
     pad_token_id: int = -100,
     truncate_long_results: bool = True,
     advantage_balance: float = 0.0,
     verbosity: Verbosity = 1,
+    packing_strategy: PackingStrategy = "greedy",
 ) -> PackedTensors:
-    # TODO: This function could potentially be optimized with vectorized operations
-    token_ids: list[list[int]] = [[]]
-    group_ids: list[list[int]] = [[]]
-    parent_ids: list[list[int]] = [[]]
-    input_pos: list[list[int]] = [[]]
-    assistant_mask: list[list[int]] = [[]]
-    logprobs: list[list[float]] = [[]]
-    advantages: list[list[float]] = [[]]
-    weights: list[list[float]] = [[]]
+    """
+    Packs tokenized results into sequences of length `seq_len`.
+
+    The "greedy" strategy packs results in order and starts a new sequence
+    whenever the next result does not fit. "first_fit_decreasing" keeps results
+    that share an outermost prompt together, so their prompt is packed once, and
+    places these units largest first into the first sequence with room left,
+    which usually needs fewer sequences.
+    """
+    plan = _plan_packing(
+        tokenized_results, seq_len, truncate_long_results, verbosity, packing_strategy
+    )
+    num_sequences = len(plan.sequence_lengths)
+    tensors = _empty_packed_tensors(num_sequences * seq_len, pad_token_id)
+    _fill_packed_tensors(
+        tensors,
+        plan,
+        _shuffled_sequence_order(num_sequences) * seq_len,
+        *_piece_advantages_and_weights(plan),
+    )
+    packed_tensors = {
+        key: tensor.view(num_sequences, seq_len) for key, tensor in tensors.items()
+    }
+    _normalize_advantages_and_weights(packed_tensors, advantage_balance)  # type: ignore
+    return packed_tensors  # type: ignore
+
+
+def varlen_packed_tensors_from_tokenized_results(
+    tokenized_results: Sequence[TokenizedResult | CompactTokenizedResult],
+    seq_len: int,
+    pad_token_id: int = -100,
+    truncate_long_results: bool = True,
+    advantage_balance: float = 0.0,
+    verbosity: Verbosity = 1,
+    packing_strategy: PackingStrategy = "greedy",
+) -> VarlenPackedTensors:
+    """
+    Packs tokenized results like `packed_tensors_from_tokenized_results`, but
+    without padding sequences to `seq_len`, which only bounds their length.
+
+    With the same random state, `pad_varlen_packed_tensors(tensors, seq_len,
+    pad_token_id)` equals the output of `packed_tensors_from_tokenized_results`.
+    """
+    plan = _plan_packing(
+        tokenized_results, seq_len, truncate_long_results, verbosity, packing_strategy
+    )
+    sequence_order = _shuffled_sequence_order(len(plan.sequence_lengths))
+    sequence_lengths = np.empty(len(sequence_order), dtype=np.int64)
+    sequence_lengths[sequence_order] = plan.sequence_lengths
+    cu_seqlens = np.concatenate([[0], np.cumsum(sequence_lengths)])
+    varlen_packed_tensors = _empty_packed_tensors(int(cu_seqlens[-1]), pad_token_id)
+    _fill_packed_tensors(
+        varlen_packed_tensors,
+        plan,
+        cu_seqlens[sequence_order],
+        *_piece_advantages_and_weights(plan),
+    )
+    _normalize_advantages_and_weights(varlen_packed_tensors, advantage_balance)  # type: ignore
+    varlen_packed_tensors["cu_seqlens"] = torch.from_numpy(cu_seqlens.astype(np.int32))
+    return varlen_packed_tensors  # type: ignore
+
+
+def disk_packed_tensors_from_tokenized_results(
+    tokenized_results: Sequence[TokenizedResult | CompactTokenizedResult],
+    dir: str,
+    seq_len: int,
+    pad_token_id: int = -100,
+    truncate_long_results: bool = True,
+    advantage_balance: float = 0.0,
+    verbosity: Verbosity = 1,
+    packing_strategy: PackingStrategy = "greedy",
+    bf16: bool = False,
+) -> DiskPackedTensors:
+    """
+    Packs tokenized results like `packed_tensors_from_tokenized_results`, but
+    writes the sequences straight into the memory-mapped tensor files in `dir`
+    instead of building the batch in memory first.
+
+    Advantages and weights are normalized per result before they are written,
+    so they may differ from the in-memory packer in the last bit. They are
+    stored as bfloat16 if `bf16` is set.
+    """
+    plan = _plan_packing(
+        tokenized_results, seq_len, truncate_long_results, verbosity, packing_strategy
+    )
+    ((advantages, weights),) = _normalized_piece_advantages_and_weights(
+        [plan], advantage_balance
+    )
+    return _write_packing_plan(
+        plan, dir, seq_len, pad_token_id, bf16, advantages, weights
+    )
+
+
+def bucketed_disk_packed_tensors_from_tokenized_results(
+    tokenized_results: Sequence[TokenizedResult | CompactTokenizedResult],
+    dir: str,
+    bucket_lengths: Sequence[int],
+    length_multiple: int = 1,
+    pad_token_id: int = -100,
+    truncate_long_results: bool = True,
+    advantage_balance: float = 0.0,
+    verbosity: Verbosity = 1,
+    packing_strategy: PackingStrategy = "greedy",
+    bf16: bool = False,
+) -> list[DiskPackedTensors]:
+    """
+    Packs tokenized results into buckets of different sequence lengths and
+    writes each bucket like `disk_packed_tensors_from_tokenized_results` into
+    `{dir}/{bucket_length}`. Directories are keyed by bucket length rather than
+    sequence length, so repeated calls reuse (and only grow) one set of tensor
+    files per bucket.
 
+    Every result goes to the shortest bucket it fits into and longer results
+    to the longest one. A bucket's sequences are as long as its longest result
+    rounded up to a multiple of `length_multiple`, but at most its bucket
+    length. Advantages and weights are normalized across all buckets. Returns
+    the non-empty buckets from shortest to longest.
+    """
+    bucket_lengths = sorted(bucket_lengths)
+    buckets: list[list[TokenizedResult | CompactTokenizedResult]] = [
+        [] for _ in bucket_lengths
+    ]
     for result in tokenized_results:
+        index = bisect.bisect_left(bucket_lengths, len(result.token_ids))
+        buckets[min(index, len(buckets) - 1)].append(result)
+    # (plan, bucket length, sequence length) of every non-empty bucket
+    plans: list[tuple[_PackingPlan, int, int]] = []
+    for bucket_length, results in zip(bucket_lengths, buckets):
+        if not results:
+            continue
+        max_length = max(len(result.token_ids) for result in results)
+        seq_len = min(
+            math.ceil(max_length / length_multiple) * length_multiple, bucket_length
+        )
+        plan = _plan_packing(
+            results, seq_len, truncate_long_results, verbosity, packing_strategy
+        )
+        if plan.pieces:
+            plans.append((plan, bucket_length, seq_len))
+    return [
+        _write_packing_plan(
+            plan,
+            f"{dir}/{bucket_length}",
+            seq_len,
+            pad_token_id,
+            bf16,
+            advantages,
+            weights,
+        )
+        for (plan, bucket_length, seq_len), (advantages, weights) in zip(
+            plans,
+            _normalized_piece_advantages_and_weights(
+                [plan for plan, _, _ in plans], advantage_balance
+            ),
+        )
+    ]
+
+
+def pad_varlen_packed_tensors(
+    tensors: VarlenPackedTensors,
+    seq_len: int | None = None,
+    pad_token_id: int = -100,
+) -> PackedTensors:
+    """
+    Views variable length sequences as rows padded to `seq_len`, which defaults
+    to the length of the longest sequence.
+    """
+    cu_seqlens = tensors["cu_seqlens"].long()
+    sequence_lengths = cu_seqlens.diff()
+    num_sequences = len(sequence_lengths)
+    if seq_len is None:
+        seq_len = int(sequence_lengths.max()) if num_sequences else 0
+    rows = torch.repeat_interleave(torch.arange(num_sequences), sequence_lengths)
+    columns = torch.arange(int(cu_seqlens[-1])) - cu_seqlens[:-1][rows]
+    packed_tensors = {}
+    for key, pad_value in _pad_values(pad_token_id).items():
+        tensor = tensors[key]
+        packed_tensors[key] = torch.full(
+            (num_sequences, seq_len), pad_value, dtype=tensor.dtype
+        )
+        packed_tensors[key][rows, columns] = tensor
+    return packed_tensors  # type: ignore
+
+
+def unpad_packed_tensors(packed_tensors: PackedTensors) -> VarlenPackedTensors:
+    """Drops the padding at the end of every packed sequence."""
+    valid = packed_tensors["group_ids"] >= 0
+    cu_seqlens = torch.zeros(valid.shape[0] + 1, dtype=torch.int32)
+    cu_seqlens[1:] = valid.sum(dim=1).cumsum(dim=0)
+    varlen_packed_tensors = {key: packed_tensors[key][valid] for key in _pad_values(0)}
+    varlen_packed_tensors["cu_seqlens"] = cu_seqlens
+    return varlen_packed_tensors  # type: ignore
+
+
+@dataclass
+class _PackingPlan:
+    # (result, offset, length) of every packed slice of a result
+    pieces: list[tuple[TokenizedResult | CompactTokenizedResult, int, int]]
+    piece_rows: list[int]
+    piece_starts: list[int]
+    # (group id, parent id, length) of each run of equal ids, in token order
+    id_runs: list[tuple[int, int, int]]
+    # Number of id runs up to and including each piece
+    piece_run_ends: list[int]
+    sequence_lengths: list[int]
+
+
+def _plan_packing(
+    tokenized_results: Sequence[TokenizedResult | CompactTokenizedResult],
+    seq_len: int,
+    truncate_long_results: bool,
+    verbosity: Verbosity,
+    packing_strategy: PackingStrategy,
+) -> _PackingPlan:
+    """Decides where every result goes before any tokens are copied."""
+    prompt_intervals, result_ids = _prompt_intervals(tokenized_results)
+    pieces: list[tuple[TokenizedResult | CompactTokenizedResult, int, int]] = []
+    piece_rows: list[int] = []
+    piece_starts: list[int] = []
+    # (group id, parent id, length) of each run of equal ids, in token order
+    id_runs: list[tuple[int, int, int]] = []
+    piece_run_ends: list[int] = []
+    sequence_lengths = [0]
+    # Prompts already packed into each sequence
+    prompt_ids: list[set[int]] = [set()]
+
+    def pack(
+        result: TokenizedResult | CompactTokenizedResult,
+        result_id: int,
+        prompts: list[tuple[int, int]],
+        row: int,
+    ) -> None:
+        offset = _packed_prompt_length(prompts, prompt_ids[row])
+        # Truncate results that do not fit into an empty sequence
+        length = min(len(result.token_ids) - offset, seq_len - sequence_lengths[row])
+        pieces.append((result, offset, length))
+        piece_rows.append(row)
+        piece_starts.append(sequence_lengths[row])
+        sequence_lengths[row] += length
+        # Each prompt's tokens get the ids of its interval, see `PackedTensors`
+        start = offset
+        for prompt_id, prompt_length in prompts:
+            if prompt_length <= offset:
+                continue
+            first_id, last_id = prompt_intervals[prompt_id]
+            id_runs.append(
+                (first_id, last_id, max(min(prompt_length, offset + length) - start, 0))
+            )
+            prompt_ids[row].add(prompt_id)
+            start = prompt_length
+        id_runs.append((result_id, result_id, max(offset + length - start, 0)))
+        piece_run_ends.append(len(id_runs))
+
+    packable: list[
+        tuple[TokenizedResult | CompactTokenizedResult, int, list[tuple[int, int]]]
+    ] = []
+    for result, result_id in zip(tokenized_results, result_ids):
         if len(result.token_ids) > seq_len and not truncate_long_results:
             if verbosity > 1:
                 print("Result is too long, skipping")
             continue
-        result_without_prompt = result.without_prompt()
-        if sum(result_without_prompt.assistant_mask) == 0:
+        if not np.any(result.assistant_mask[result.prompt_length :]):
             if verbosity > 1:
                 print("Result has no unique completion tokens, skipping")
             continue
-        if (
-            len(token_ids[-1])
-            + (
-                len(result_without_prompt.token_ids)
-                if result.prompt_id in group_ids[-1]
-                else len(result.token_ids)
-            )
-            > seq_len
-        ):
-            token_ids.append([])
-            group_ids.append([])
-            parent_ids.append([])
-            input_pos.append([])
-            assistant_mask.append([])
-            logprobs.append([])
-            advantages.append([])
-            weights.append([])
-        group_id = random.randint(-(2**63), 2**63 - 1)
-        if result.prompt_id in group_ids[-1]:
-            result = result_without_prompt
-        token_ids[-1].extend(result.token_ids)
-        group_ids[-1].extend(
-            [result.prompt_id] * result.prompt_length
-            + [group_id] * (len(result.token_ids) - result.prompt_length)
-        )
-        parent_ids[-1].extend([result.prompt_id] * len(result.token_ids))
-        input_pos[-1].extend(result.input_pos)
-        assistant_mask[-1].extend(result.assistant_mask)
-        logprobs[-1].extend(result.logprobs)
-        advantages[-1].extend([result.advantage] * len(result.token_ids))
-        weights[-1].extend([result.weight] * len(result.token_ids))
-        if truncate_long_results:
-            token_ids[-1] = token_ids[-1][:seq_len]
-            group_ids[-1] = group_ids[-1][:seq_len]
-            parent_ids[-1] = parent_ids[-1][:seq_len]
-            input_pos[-1] = input_pos[-1][:seq_len]
-            assistant_mask[-1] = assistant_mask[-1][:seq_len]
-            logprobs[-1] = logprobs[-1][:seq_len]
-            advantages[-1] = advantages[-1][:seq_len]
-            weights[-1] = weights[-1][:seq_len]
-
-    permutation = list(range(len(token_ids)))
+        packable.append((result, result_id, result.prompts()))
+
+    if packing_strategy == "greedy":
+        for result, result_id, prompts in packable:
+            offset = _packed_prompt_length(prompts, prompt_ids[-1])
+            if sequence_lengths[-1] + len(result.token_ids) - offset > seq_len:
+                sequence_lengths.append(0)
+                prompt_ids.append(set())
+            pack(result, result_id, prompts, len(sequence_lengths) - 1)
+    elif packing_strategy == "first_fit_decreasing":
+        # Split the results of each outermost prompt into units that fit a sequence
+        groups: dict[int, list] = {}
+        units: list[tuple[int, list]] = []
+        for item in packable:
+            if prompts := item[2]:
+                groups.setdefault(prompts[0][0], []).append(item)
+            else:
+                units.append((len(item[0].token_ids), [item]))
+        for group in groups.values():
+            unit, unit_prompt_ids, unit_length = [], set(), 0
+            for item in group:
+                result, _, prompts = item
+                length = len(result.token_ids) - _packed_prompt_length(
+                    prompts, unit_prompt_ids
+                )
+                if unit and unit_length + length > seq_len:
+                    units.append((unit_length, unit))
+                    unit, unit_prompt_ids, unit_length = [], set(), 0
+                    length = len(result.token_ids)
+                unit.append(item)
+                unit_prompt_ids.update(prompt_id for prompt_id, _ in prompts)
+                unit_length += length
+            units.append((unit_length, unit))
+        units.sort(key=lambda unit: unit[0], reverse=True)
+        free = np.zeros(len(units) + 1, dtype=np.int64)
+        free[0] = seq_len
+        for unit_length, unit in units:
+            rows = np.flatnonzero(free[: len(sequence_lengths)] >= unit_length)
+            if rows.size:
+                row = int(rows[0])
+            else:
+                row = len(sequence_lengths)
+                sequence_lengths.append(0)
+                prompt_ids.append(set())
+            for result, result_id, prompts in unit:
+                pack(result, result_id, prompts, row)
+            free[row] = seq_len - sequence_lengths[row]
+    else:
+        raise ValueError(f"Unknown packing strategy: {packing_strategy}")
+
+    return _PackingPlan(
+        pieces, piece_rows, piece_starts, id_runs, piece_run_ends, sequence_lengths
+    )
+
+
+def _shuffled_sequence_order(num_sequences: int) -> np.ndarray:
+    """Returns the shuffled position of every planned sequence."""
+    permutation = list(range(num_sequences))
     random.shuffle(permutation)
-    token_ids = [token_ids[i] for i in permutation]
-    group_ids = [group_ids[i] for i in permutation]
-    parent_ids = [parent_ids[i] for i in permutation]
-    input_pos = [input_pos[i] for i in permutation]
-    assistant_mask = [assistant_mask[i] for i in permutation]
-    logprobs = [logprobs[i] for i in permutation]
-    advantages = [advantages[i] for i in permutation]
-    weights = [weights[i] for i in permutation]
-
-    def pad(values: list[list], pad_value) -> list[list]:
-        max_len = seq_len
-        for value in values:
-            value.extend([pad_value] * (max_len - len(value)))
-        return values
-
-    assistant_mask_tensor = torch.tensor(pad(assistant_mask, 0), dtype=torch.bool)
-    weights_tensor = torch.tensor(pad(weights, 0.0))
-    weights_tensor = torch.where(
-        assistant_mask_tensor, weights_tensor, torch.zeros_like(weights_tensor)
+    sequence_order = np.empty(num_sequences, dtype=np.int64)
+    sequence_order[permutation] = np.arange(num_sequences)
+    return sequence_order
+
+
+def _pad_values(pad_token_id: int) -> dict[str, int | float | bool]:
+    return {
+        "tokens": pad_token_id,
+        "group_ids": -1,
+        "parent_ids": -1,
+        "input_pos": 0,
+        "assistant_mask": False,
+        "logprobs": float("nan"),
+        "advantages": 0.0,
+        "weights": 0.0,
+    }
+
+
+def _empty_packed_tensors(size: int, pad_token_id: int) -> dict[str, torch.Tensor]:
+    return {
+        key: torch.full((size,), pad_value, dtype=_DTYPES[1][key])
+        for key, pad_value in _pad_values(pad_token_id).items()
+    }
+
+
+def _fill_packed_tensors(
+    tensors: dict[str, torch.Tensor],
+    plan: _PackingPlan,
+    row_starts: np.ndarray,
+    advantages: np.ndarray,
+    weights: np.ndarray,
+    chunk_size: int = 1 << 22,
+) -> None:
+    """
+    Copies the planned pieces into flat tensors, where sequence `i` of the plan
+    starts at `row_starts[i]`. `advantages` and `weights` hold one value per
+    piece and are only written to assistant tokens.
+
+    Pieces are copied in chunks of about `chunk_size` tokens, so the tensors may
+    be memory-mapped files without the batch ever being held in memory. Values
+    are cast to the dtype of each tensor.
+    """
+    if not plan.pieces:
+        return
+    lengths = np.array([length for _, _, length in plan.pieces], dtype=np.int64)
+    piece_ends = np.cumsum(lengths)
+    destinations = row_starts[plan.piece_rows] + plan.piece_starts
+    run_group_ids, run_parent_ids, run_lengths = map(np.array, zip(*plan.id_runs))
+    start = 0
+    while start < len(plan.pieces):
+        end = max(
+            int(np.searchsorted(piece_ends, piece_ends[start] + chunk_size)),
+            start + 1,
+        )
+        pieces = plan.pieces[start:end]
+        chunk_lengths = lengths[start:end]
+        # Flat destination index of every packed token, in packing order
+        index = torch.from_numpy(
+            np.repeat(
+                destinations[start:end] - (piece_ends[start:end] - chunk_lengths),
+                chunk_lengths,
+            )
+            + np.arange(piece_ends[start] - lengths[start], piece_ends[end - 1])
+        )
+
+        def put(key: str, values: np.ndarray) -> None:
+            tensors[key][index] = torch.from_numpy(values).to(tensors[key].dtype)
+
+        def values(key: str) -> np.ndarray:
+            return np.concatenate(
+                [
+                    np.asarray(getattr(result, key)[offset : offset + length])
+                    for result, offset, length in pieces
+                ]
+            )
+
+        assistant_mask = values("assistant_mask").astype(np.bool_)
+        put("tokens", values("token_ids"))
+        put("input_pos", values("input_pos"))
+        put("assistant_mask", assistant_mask)
+        put("logprobs", values("logprobs"))
+        put(
+            "advantages",
+            np.where(
+                assistant_mask, np.repeat(advantages[start:end], chunk_lengths), 0.0
+            ),
+        )
+        put(
+            "weights",
+            np.where(assistant_mask, np.repeat(weights[start:end], chunk_lengths), 0.0),
+        )
+        runs = slice(
+            plan.piece_run_ends[start - 1] if start else 0, plan.piece_run_ends[end - 1]
+        )
+        put("group_ids", np.repeat(run_group_ids[runs], run_lengths[runs]))
+        put("parent_ids", np.repeat(run_parent_ids[runs], run_lengths[runs]))
+        start = end
+
+
+def _write_packing_plan(
+    plan: _PackingPlan,
+    dir: str,
+    seq_len: int,
+    pad_token_id: int,
+    bf16: bool,
+    advantages: np.ndarray,
+    weights: np.ndarray,
+) -> DiskPackedTensors:
+    disk_packed_tensors: DiskPackedTensors = {
+        "dir": dir,
+        "num_sequences": len(plan.sequence_lengths),
+        "sequence_length": seq_len,
+        "version": DISK_PACKED_TENSORS_VERSION,
+        "bf16": bf16,
+    }
+    _reserve_packed_tensor_files(disk_packed_tensors)
+    tensors = packed_tensors_from_dir(**disk_packed_tensors)
+    sequence_order = _shuffled_sequence_order(len(plan.sequence_lengths))
+    sequence_lengths = np.empty(len(sequence_order), dtype=np.int64)
+    sequence_lengths[sequence_order] = plan.sequence_lengths
+    # The files are reused across batches, so only the padding is overwritten here
+    for key, pad_value in _pad_values(pad_token_id).items():
+        for row, length in enumerate(sequence_lengths):
+            tensors[key][row, length:] = pad_value
+    _fill_packed_tensors(
+        {key: tensor.view(-1) for key, tensor in tensors.items()},
+        plan,
+        sequence_order * seq_len,
+        advantages,
+        weights,
     )
-    weights_tensor[assistant_mask_tensor] /= weights_tensor[
-        assistant_mask_tensor
-    ].mean()
-    advantages_tensor = torch.tensor(pad(advantages, 0.0))
-    advantages_tensor = torch.where(
-        assistant_mask_tensor, advantages_tensor, torch.zeros_like(advantages_tensor)
+    return disk_packed_tensors
+
+
+def _piece_advantages_and_weights(
+    plan: _PackingPlan,
+) -> tuple[np.ndarray, np.ndarray]:
+    return (
+        np.array([result.advantage for result, _, _ in plan.pieces], dtype=np.float32),
+        np.array([result.weight for result, _, _ in plan.pieces], dtype=np.float32),
+    )
+
+
+def _normalized_piece_advantages_and_weights(
+    plans: list[_PackingPlan], advantage_balance: float
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Normalizes the advantages and weights of every piece of the plans together
+    like `_normalize_advantages_and_weights` does for packed tensors.
+    """
+    if not plans:
+        return []
+    advantages, weights = map(
+        np.concatenate, zip(*map(_piece_advantages_and_weights, plans))
     )
+    # Number of assistant tokens of every piece
+    counts = np.array(
+        [
+            np.count_nonzero(result.assistant_mask[offset : offset + length])
+            for plan in plans
+            for result, offset, length in plan.pieces
+        ],
+        dtype=np.float64,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = weights / np.float32(counts @ weights / counts.sum())
+        if advantage_balance > 0.0:
+            advantages = np.where(
+                advantages > 0,
+                advantages,
+                advantages * np.float32(1 - advantage_balance),
+            )
+        elif advantage_balance < 0.0:
+            advantages = np.where(
+                advantages < 0,
+                advantages,
+                advantages * np.float32(1 + advantage_balance),
+            )
+        advantages = advantages / np.float32(
+            counts @ (np.abs(advantages) * weights) / counts.sum()
+        )
+    splits = np.cumsum([len(plan.pieces) for plan in plans])[:-1]
+    return list(zip(np.split(advantages, splits), np.split(weights, splits)))
+
+
+def _normalize_advantages_and_weights(
+    tensors: PackedTensors | VarlenPackedTensors, advantage_balance: float
+) -> None:
+    """Balances and normalizes the advantages and weights in place."""
+    assistant_mask = tensors["assistant_mask"]
+    weights = torch.where(assistant_mask, tensors["weights"], 0.0)
+    weights = torch.where(assistant_mask, weights / weights[assistant_mask].mean(), 0.0)
+    advantages = torch.where(assistant_mask, tensors["advantages"], 0.0)
     if advantage_balance > 0.0:
-        advantages_tensor = torch.where(
-            advantages_tensor > 0,
-            advantages_tensor,
-            advantages_tensor * (1 - advantage_balance),
+        advantages = torch.where(
+            advantages > 0, advantages, advantages * (1 - advantage_balance)
         )
     elif advantage_balance < 0.0:
-        advantages_tensor = torch.where(
-            advantages_tensor < 0,
-            advantages_tensor,
-            advantages_tensor * (1 + advantage_balance),
+        advantages = torch.where(
+            advantages < 0, advantages, advantages * (1 + advantage_balance)
         )
-    advantages_tensor[assistant_mask_tensor] /= (
-        advantages_tensor[assistant_mask_tensor].abs()
-        * weights_tensor[assistant_mask_tensor]
-    ).mean()
+    advantages = torch.where(
+        assistant_mask,
+        advantages
+        / (advantages[assistant_mask].abs() * weights[assistant_mask]).mean(),
+        0.0,
+    )
+    tensors["weights"].copy_(weights)
+    tensors["advantages"].copy_(advantages)
+
 
+def _packed_prompt_length(
+    prompts: list[tuple[int, int]], packed_prompt_ids: set[int]
+) -> int:
+    """Returns the length of the result's prefix that is already packed."""
+    offset = 0
+    for prompt_id, prompt_length in prompts:
+        if prompt_id not in packed_prompt_ids:
+            break
+        offset = prompt_length
+    return offset
+
+
+def packing_stats(
+    packed_tensors: PackedTensors | Sequence[PackedTensors],
+) -> PackingStats:
+    """
+    Summarizes how efficiently tokenized results were packed, across all buckets
+    if given a sequence of packed tensors.
+
+    Duplicated prompt tokens are prompt tokens packed again in another sequence
+    because not all results sharing the prompt fit into one sequence.
+    """
+    num_sequences = num_tokens = num_padding_tokens = duplicated_prompt_tokens = 0
+    for tensors in (
+        [packed_tensors] if isinstance(packed_tensors, dict) else packed_tensors
+    ):
+        group_ids = tensors["group_ids"]
+        prompt_mask = (group_ids != tensors["parent_ids"]) & (group_ids >= 0)
+        rows = prompt_mask.nonzero()[:, 0]
+        # Count each prompt's tokens per sequence it was packed into
+        keys, counts = torch.unique(
+            group_ids[prompt_mask].long() * group_ids.shape[0] + rows,
+            return_counts=True,
+        )
+        prompt_index = torch.unique(keys // group_ids.shape[0], return_inverse=True)[1]
+        max_counts = torch.zeros(
+            int(prompt_index.max()) + 1 if prompt_index.numel() else 0,
+            dtype=counts.dtype,
+        ).scatter_reduce(0, prompt_index, counts, reduce="amax")
+        num_sequences += group_ids.shape[0]
+        num_tokens += group_ids.numel()
+        num_padding_tokens += int((group_ids < 0).sum())
+        duplicated_prompt_tokens += int(counts.sum() - max_counts.sum())
     return {
-        "tokens": torch.tensor(pad(token_ids, pad_token_id)),
-        "group_ids": torch.tensor(pad(group_ids, -1)),
-        "parent_ids": torch.tensor(pad(parent_ids, -1)),
-        "input_pos": torch.tensor(pad(input_pos, 0)),
-        "assistant_mask": assistant_mask_tensor,
-        "logprobs": torch.tensor(pad(logprobs, float("nan"))),
-        "advantages": advantages_tensor,
-        "weights": weights_tensor,
+        "num_sequences": num_sequences,
+        "padding_fraction": num_padding_tokens / num_tokens if num_tokens else 0.0,
+        "duplicated_prompt_tokens": duplicated_prompt_tokens,
     }
 
 
+def count_gradient_steps(
+    num_sequences: int, micro_batch_size: int = 1, gradient_accumulation_steps: int = 1
+) -> int:
+    """Returns the number of optimizer steps `micro_batches` splits sequences into."""
+    return math.ceil(num_sequences / (micro_batch_size * gradient_accumulation_steps))
+
+
+def micro_batches(
+    packed_tensors: PackedTensors,
+    micro_batch_size: int = 1,
+    gradient_accumulation_steps: int = 1,
+) -> Iterator[list[dict[str, torch.Tensor]]]:
+    """
+    Yields the micro-batches of every optimizer step, each a dict of up to
+    `micro_batch_size` rows of the packed tensors.
+
+    Every step has exactly `gradient_accumulation_steps` micro-batches, as the
+    trainer expects. The sequences of the last step are spread evenly over its
+    micro-batches and, if there are fewer sequences than micro-batches, the
+    rest are filled with a copy of a sequence without any trainable tokens.
+
+    The trainer divides every micro-batch's loss by the number of micro-batches,
+    padding included, so each micro-batch also has a 0-d `loss_scale` tensor:
+    `gradient_accumulation_steps` divided by the number of micro-batches with
+    sequences. Multiplying the loss by it keeps the gradient of a padded step at
+    the scale of a full one.
+    """
+    tensors = {
+        key: tensor
+        for key, tensor in packed_tensors.items()
+        if isinstance(tensor, torch.Tensor)
+    }
+    num_sequences = tensors["tokens"].shape[0]
+    step_size = micro_batch_size * gradient_accumulation_steps
+    for step_start in range(0, num_sequences, step_size):
+        step_end = min(step_start + step_size, num_sequences)
+        bounds = [
+            step_start + (step_end - step_start) * i // gradient_accumulation_steps
+            for i in range(gradient_accumulation_steps + 1)
+        ]
+        batches = [
+            {key: tensor[start:end] for key, tensor in tensors.items()}
+            for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start
+        ]
+        padding = {
+            key: tensor[step_start : step_start + 1] for key, tensor in tensors.items()
+        }
+        padding["assistant_mask"] = torch.zeros_like(padding["assistant_mask"])
+        padding["weights"] = torch.zeros_like(padding["weights"])
+        loss_scale = torch.tensor(gradient_accumulation_steps / len(batches))
+        yield [
+            {**batch, "loss_scale": loss_scale}
+            for batch in batches
+            + [padding] * (gradient_accumulation_steps - len(batches))
+        ]
+
+
+def _prompt_intervals(
+    tokenized_results: Sequence[TokenizedResult | CompactTokenizedResult],
+) -> tuple[dict[int, tuple[int, int]], list[int]]:
+    """
+    Numbers the prompt trie of the tokenized results in pre-order.
+
+    Returns the first and last id of every prompt's subtree and the id of each
+    result's completion.
+    """
+    children: dict[int | None, list[int]] = {None: []}
+    leaves: dict[int | None, list[int]] = {None: []}
+    for i, result in enumerate(tokenized_results):
+        parent: int | None = None
+        for prompt_id, _ in result.prompts():
+            if prompt_id not in children:
+                children[prompt_id] = []
+                leaves[prompt_id] = []
+                children[parent].append(prompt_id)
+            parent = prompt_id
+        leaves[parent].append(i)
+    # Parents are always inserted before their children
+    sizes: dict[int, int] = {}
+    for prompt_id in reversed(children):
+        if prompt_id is not None:
+            sizes[prompt_id] = (
+                1
+                + len(leaves[prompt_id])
+                + sum(sizes[child] for child in children[prompt_id])
+            )
+    prompt_intervals: dict[int, tuple[int, int]] = {}
+    result_ids = [0] * len(tokenized_results)
+    next_id = 0
+    for i in leaves[None]:
+        result_ids[i] = next_id
+        next_id += 1
+    stack = list(reversed(children[None]))
+    while stack:
+        prompt_id = stack.pop()
+        prompt_intervals[prompt_id] = (next_id, next_id + sizes[prompt_id] - 1)
+        next_id += 1
+        for i in leaves[prompt_id]:
+            result_ids[i] = next_id
+            next_id += 1
+        stack.extend(reversed(children[prompt_id]))
+    return prompt_intervals, result_ids
+
+
 def packed_tensors_from_dir(**kwargs: Unpack[DiskPackedTensors]) -> PackedTensors:
+    """
+    Maps the tensor files of a batch into memory.
+
+    Tensors keep their on-disk dtypes, which may be narrower than those of
+    `PackedTensors`; consumers restore them with `upcast_packed_tensors`,
+    ideally after moving the tensors to their device.
+    """
+    dtypes = _packed_tensor_dtypes(kwargs)
     os.makedirs(kwargs["dir"], exist_ok=True)
     return {
         key: torch.from_file(
@@ -162,31 +828,110 @@ def packed_tensors_from_dir(**kwargs: Unpack[DiskPackedTensors]) -> PackedTensor
             size=kwargs["num_sequences"] * kwargs["sequence_length"],
             dtype=dtype,
         ).view(kwargs["num_sequences"], kwargs["sequence_length"])
-        for key, dtype in {
-            "tokens": torch.long,
-            "group_ids": torch.long,
-            "parent_ids": torch.long,
-            "input_pos": torch.long,
-            "assistant_mask": torch.bool,
-            "logprobs": torch.float32,
-            "advantages": torch.float32,
-            "weights": torch.float32,
-        }.items()
+        for key, dtype in dtypes.items()
     }  # type: ignore
 
 
-def packed_tensors_to_dir(tensors: PackedTensors, dir: str) -> DiskPackedTensors:
-    os.makedirs(dir, exist_ok=True)
+def packed_tensors_to_dir(
+    tensors: PackedTensors, dir: str, bf16: bool = False
+) -> DiskPackedTensors:
     disk_packed_tensors: DiskPackedTensors = {
         "dir": dir,
         "num_sequences": tensors["tokens"].shape[0],
         "sequence_length": tensors["tokens"].shape[1],
+        "version": DISK_PACKED_TENSORS_VERSION,
+        "bf16": bf16,
     }
+    _reserve_packed_tensor_files(disk_packed_tensors)
     for key, tensor in packed_tensors_from_dir(**disk_packed_tensors).items():
         tensor.copy_(tensors[key])  # type: ignore
     return disk_packed_tensors
 
 
+def _packed_tensor_dtypes(
+    disk_packed_tensors: DiskPackedTensors,
+) -> dict[str, torch.dtype]:
+    version = disk_packed_tensors.get("version", 1)
+    if version not in _DTYPES:
+        raise ValueError(f"Unsupported packed tensors version: {version}")
+    dtypes = _DTYPES[version].copy()
+    if disk_packed_tensors.get("bf16", False):
+        dtypes["advantages"] = dtypes["weights"] = torch.bfloat16
+    if disk_packed_tensors.get("ref_logprobs", False):
+        dtypes["ref_logprobs"] = torch.float32
+    return dtypes
+
+
+def _reserve_packed_tensor_files(disk_packed_tensors: DiskPackedTensors) -> None:
+    """
+    Grows the tensor files of a batch to the next power of two of sequences.
+
+    Files are only ever grown, so a directory that is written to repeatedly
+    settles on a few size classes instead of being resized for every batch.
+    """
+    os.makedirs(disk_packed_tensors["dir"], exist_ok=True)
+    capacity = (
+        1 << max(disk_packed_tensors["num_sequences"] - 1, 0).bit_length()
+    ) * disk_packed_tensors["sequence_length"]
+    for key, dtype in _packed_tensor_dtypes(disk_packed_tensors).items():
+        path = f"{disk_packed_tensors['dir']}/{key}.pt"
+        with open(path, "ab") as f:
+            if f.tell() < capacity * dtype.itemsize:
+                f.truncate(capacity * dtype.itemsize)
+
+
+class StagingBuffers:
+    """
+    A ring of reusable directories to write packed tensors to.
+
+    Each batch is written to a buffer acquired from the ring and the buffer
+    is only returned once the model service is done reading it, so the next
+    batch can be packed into another buffer while the previous one is still
+    being trained on. Tensor files are kept between batches and only grow,
+    so their (shared) memory is allocated once instead of for every step.
+    """
+
+    def __init__(self, dir: str, num_buffers: int = 2) -> None:
+        if num_buffers < 1:
+            raise ValueError("num_buffers must be at least 1")
+        self.dir = dir
+        self._free = [f"{dir}/{i}" for i in range(num_buffers)]
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> str:
+        """Waits for a free buffer and returns its directory."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: bool(self._free))
+            return self._free.pop(0)
+
+    async def release(self, dir: str) -> None:
+        """Returns a buffer acquired with `acquire` to the ring."""
+        async with self._condition:
+            self._free.append(dir)
+            self._condition.notify()
+
+    @asynccontextmanager
+    async def buffer(self) -> AsyncIterator[str]:
+        dir = await self.acquire()
+        try:
+            yield dir
+        finally:
+            await self.release(dir)
+
+    def remove(self) -> None:
+        """Deletes all buffers, freeing their memory."""
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def upcast_packed_tensors(tensors: PackedTensors) -> None:
+    """Restores the `PackedTensors` dtypes of tensors read from disk in place."""
+    for key, tensor in tensors.items():
+        if tensor.dtype == torch.int32:
+            tensors[key] = tensor.long()  # type: ignore
+        elif tensor.dtype == torch.bfloat16:
+            tensors[key] = tensor.float()  # type: ignore
+
+
 def plot_packed_tensors(
     packed_tensors: PackedTensors, output_dir: str | None = None
 ) -> None:
@@ -199,6 +944,8 @@ def plot_packed_tensors(
             "pip install openpipe-art[plotting]"
         )
 
+    packed_tensors = packed_tensors.copy()
+    upcast_packed_tensors(packed_tensors)
     plt.figure(figsize=(15, 24))
 
     for tensor, label, title, subplot_idx in (
@@ -227,7 +974,11 @@ def plot_packed_tensors(
 
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
-        plot_path = f"{output_dir}/packed_tensors_plot_{int(time.time())}.png"
+        # Include the sequence length, so each bucket of a step gets its own plot
+        sequence_length = packed_tensors["tokens"].shape[1]
+        plot_path = (
+            f"{output_dir}/packed_tensors_plot_{int(time.time())}_{sequence_length}.png"
+        )
         plt.savefig(plot_path)
         print(f"Plot saved to: {plot_path}")
     else:
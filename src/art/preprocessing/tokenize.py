@@ -1,12 +1,26 @@
+import hashlib
+import json
 import math
+import multiprocessing as mp
+import os
 import random
-from dataclasses import dataclass
-from itertools import takewhile
-from typing import Generator, cast
+import re
+import struct
+import tempfile
+import time
+import weakref
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from functools import cached_property
+from itertools import repeat
+from typing import Generator, Iterable, cast
 
+import numpy as np
+import pydantic
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 
-from ..trajectories import History, TrajectoryGroup, get_messages
+from ..trajectories import History, Trajectory, TrajectoryGroup, get_messages
 
 
 @dataclass
@@ -21,21 +35,478 @@ class TokenizedResult:
     weight: float = 0.0
     prompt_id: int = 0
     prompt_length: int = 0
+    # (prompt id, prompt length) of each shared prefix enclosing this result's
+    # prompt, outermost first. Each is a prefix of the next.
+    parent_prompts: list[tuple[int, int]] = field(default_factory=list)
 
-    def without_prompt(self) -> "TokenizedResult":
+    def prompts(self) -> list[tuple[int, int]]:
+        """
+        Returns the (prompt id, prompt length) of every non-empty shared prefix,
+        outermost first.
+        """
+        return _prompts(self)
+
+    def without_prompt(self, prompt_length: int | None = None) -> "TokenizedResult":
+        """
+        Returns the result without its first `prompt_length` tokens, by default
+        without its whole prompt.
+        """
+        if prompt_length is None:
+            prompt_length = self.prompt_length
         return TokenizedResult(
             advantage=self.advantage,
             chat=self.chat,
-            tokens=self.tokens[self.prompt_length :],
-            token_ids=self.token_ids[self.prompt_length :],
-            input_pos=self.input_pos[self.prompt_length :],
-            assistant_mask=self.assistant_mask[self.prompt_length :],
-            logprobs=self.logprobs[self.prompt_length :],
+            tokens=self.tokens[prompt_length:],
+            token_ids=self.token_ids[prompt_length:],
+            input_pos=self.input_pos[prompt_length:],
+            assistant_mask=self.assistant_mask[prompt_length:],
+            logprobs=self.logprobs[prompt_length:],
+            weight=self.weight,
+            prompt_id=self.prompt_id,
+            prompt_length=0,
+        )
+
+
+@dataclass
+class CompactTokenizedResult:
+    """
+    Array-backed variant of `TokenizedResult` for packing large batches.
+
+    Token ids and positions are int32, the assistant mask is bool and the
+    logprobs are float32, the precision they are packed in. `without_prompt`
+    returns views instead of copies, and decoded tokens are only built by
+    `to_tokenized_result`, e.g. for plotting or debugging.
+    """
+
+    advantage: float
+    chat: str
+    token_ids: np.ndarray
+    input_pos: np.ndarray
+    assistant_mask: np.ndarray
+    logprobs: np.ndarray
+    weight: float = 0.0
+    prompt_id: int = 0
+    prompt_length: int = 0
+    parent_prompts: list[tuple[int, int]] = field(default_factory=list)
+
+    @classmethod
+    def from_lists(
+        cls,
+        advantage: float,
+        chat: str,
+        token_ids: list[int],
+        assistant_mask: list[int],
+        logprobs: list[float],
+    ) -> "CompactTokenizedResult":
+        return cls(
+            advantage=advantage,
+            chat=chat,
+            token_ids=np.asarray(token_ids, dtype=np.int32),
+            input_pos=_input_pos(len(token_ids)),
+            assistant_mask=np.asarray(assistant_mask, dtype=np.bool_),
+            logprobs=np.asarray(logprobs, dtype=np.float32),
+        )
+
+    def prompts(self) -> list[tuple[int, int]]:
+        """
+        Returns the (prompt id, prompt length) of every non-empty shared prefix,
+        outermost first.
+        """
+        return _prompts(self)
+
+    def without_prompt(
+        self, prompt_length: int | None = None
+    ) -> "CompactTokenizedResult":
+        """
+        Returns the result without its first `prompt_length` tokens, by default
+        without its whole prompt. The arrays are views of this result's arrays.
+        """
+        if prompt_length is None:
+            prompt_length = self.prompt_length
+        return CompactTokenizedResult(
+            advantage=self.advantage,
+            chat=self.chat,
+            token_ids=self.token_ids[prompt_length:],
+            input_pos=self.input_pos[prompt_length:],
+            assistant_mask=self.assistant_mask[prompt_length:],
+            logprobs=self.logprobs[prompt_length:],
             weight=self.weight,
             prompt_id=self.prompt_id,
             prompt_length=0,
         )
 
+    def to_tokenized_result(self, tokenizer_cache: "TokenizerCache") -> TokenizedResult:
+        token_ids = self.token_ids.tolist()
+        return TokenizedResult(
+            advantage=self.advantage,
+            chat=self.chat,
+            tokens=[tokenizer_cache.decode(token_id) for token_id in token_ids],
+            token_ids=token_ids,
+            input_pos=self.input_pos.tolist(),
+            assistant_mask=self.assistant_mask.astype(int).tolist(),
+            logprobs=self.logprobs.tolist(),
+            weight=self.weight,
+            prompt_id=self.prompt_id,
+            prompt_length=self.prompt_length,
+            parent_prompts=list(self.parent_prompts),
+        )
+
+
+_positions = np.arange(0, dtype=np.int32)
+
+
+def _input_pos(length: int) -> np.ndarray:
+    """
+    Returns a read-only view of positions `0..length-1`, shared between
+    results instead of allocating new positions for each one.
+    """
+    global _positions
+    if len(_positions) < length:
+        _positions = np.arange(max(length, 2 * len(_positions)), dtype=np.int32)
+        _positions.flags.writeable = False
+    return _positions[:length]
+
+
+def _prompts(
+    result: TokenizedResult | CompactTokenizedResult,
+) -> list[tuple[int, int]]:
+    return [
+        (prompt_id, prompt_length)
+        for prompt_id, prompt_length in (
+            *result.parent_prompts,
+            (result.prompt_id, result.prompt_length),
+        )
+        if prompt_length > 0
+    ]
+
+
+# Decoded vocabulary and segment pattern of each tokenizer. The values must not
+# reference the tokenizer, or it would never be garbage collected.
+_tokenizer_lookups: weakref.WeakKeyDictionary[
+    PreTrainedTokenizerBase, tuple[list[str], re.Pattern[str] | None]
+] = weakref.WeakKeyDictionary()
+
+
+@dataclass
+class TokenizerCache:
+    """
+    Per-tokenizer lookups that are expensive to rebuild for every trajectory.
+
+    Build once per tokenizer with `TokenizerCache.from_tokenizer` and reuse it
+    across calls to `tokenize_trajectory_groups`. The decoded vocabulary and
+    segment pattern are memoized per tokenizer, so building another cache for
+    the same tokenizer is cheap.
+    """
+
+    name: str
+    revision: str | None
+    vocab_size: int
+    decoded_tokens: list[str] = field(repr=False)
+    tokenizer: "PreTrainedTokenizerBase" = field(repr=False)
+    segment_pattern: re.Pattern[str] | None = field(default=None, repr=False)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer: "PreTrainedTokenizerBase") -> "TokenizerCache":
+        vocab_size = cast(int, tokenizer.vocab_size)
+        num_tokens = max(len(tokenizer), vocab_size)
+        lookups = _tokenizer_lookups.get(tokenizer)
+        # Rebuild if tokens were added since the lookups were memoized
+        if lookups is None or len(lookups[0]) != num_tokens:
+            lookups = _tokenizer_lookups[tokenizer] = (
+                tokenizer.batch_decode([[token_id] for token_id in range(num_tokens)]),
+                _get_segment_pattern(tokenizer),
+            )
+        decoded_tokens, segment_pattern = lookups
+        return cls(
+            name=tokenizer.name_or_path,
+            revision=tokenizer.init_kwargs.get("revision"),
+            vocab_size=vocab_size,
+            decoded_tokens=decoded_tokens,
+            tokenizer=tokenizer,
+            segment_pattern=segment_pattern,
+        )
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """
+        Hash of everything about the tokenizer that affects tokenization.
+        """
+        return hashlib.sha256(
+            json.dumps(
+                [
+                    self.name,
+                    self.revision,
+                    self.vocab_size,
+                    len(self.tokenizer),
+                    self.tokenizer.chat_template,
+                    self.tokenizer.special_tokens_map,
+                    self.tokenizer.backend_tokenizer.to_str()
+                    if self.tokenizer.is_fast
+                    else None,
+                ],
+                default=repr,
+            ).encode()
+        ).hexdigest()
+
+    def segment_encoder(self) -> "SegmentEncoder | None":
+        """
+        Returns a new `SegmentEncoder` if this tokenizer can be encoded segment
+        by segment without changing its output, otherwise `None`.
+        """
+        if self.segment_pattern is None:
+            return None
+        return SegmentEncoder(self.tokenizer, self.segment_pattern)
+
+    def sentinel_token_id(self, token_ids: Iterable[int]) -> int:
+        """
+        Returns the largest vocabulary id that does not appear in `token_ids`.
+        """
+        used_token_ids = set(token_ids)
+        for token_id in range(self.vocab_size - 1, -1, -1):
+            if token_id not in used_token_ids:
+                return token_id
+        raise ValueError("Every vocabulary token is used, no sentinel available")
+
+    def decode(self, token_id: int) -> str:
+        if 0 <= token_id < len(self.decoded_tokens):
+            return self.decoded_tokens[token_id]
+        return self.tokenizer.decode(token_id)
+
+
+class SegmentEncoder:
+    """
+    Encodes text by splitting it at added tokens (e.g. `<|im_start|>`) and
+    memoizing the token ids of every distinct segment.
+
+    Fast tokenizers already encode the text between added tokens independently,
+    so concatenating the ids of each segment is identical to encoding the whole
+    string. Reusing one encoder across a trajectory group means shared system
+    prompts, user prompts and earlier turns are only tokenized once.
+    """
+
+    def __init__(
+        self, tokenizer: "PreTrainedTokenizerBase", pattern: re.Pattern[str]
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.pattern = pattern
+        self.segment_token_ids: dict[str, list[int]] = {}
+
+    def encode(self, text: str) -> list[int]:
+        segments = [segment for segment in self.pattern.split(text) if segment]
+        if new_segments := list(
+            dict.fromkeys(
+                segment for segment in segments if segment not in self.segment_token_ids
+            )
+        ):
+            for segment, token_ids in zip(
+                new_segments,
+                self.tokenizer(new_segments, add_special_tokens=False)["input_ids"],
+            ):
+                self.segment_token_ids[segment] = cast(list[int], token_ids)
+        return [
+            token_id
+            for segment in segments
+            for token_id in self.segment_token_ids[segment]
+        ]
+
+
+def _get_segment_pattern(
+    tokenizer: "PreTrainedTokenizerBase",
+) -> re.Pattern[str] | None:
+    if not tokenizer.is_fast:
+        return None
+    # Only split at added tokens that are matched verbatim, without stripping
+    # surrounding whitespace or normalization
+    added_tokens = sorted(
+        (
+            added_token.content
+            for added_token in tokenizer.added_tokens_decoder.values()
+            if not (
+                added_token.lstrip
+                or added_token.rstrip
+                or added_token.single_word
+                or added_token.normalized
+            )
+        ),
+        key=len,
+        reverse=True,
+    )
+    if not added_tokens:
+        return None
+    pattern = re.compile(f"({'|'.join(map(re.escape, added_tokens))})")
+    # Verify that segment-wise encoding matches whole-string encoding, which
+    # does not hold for e.g. pre-tokenizers that prepend a space to each input
+    probe = "".join(
+        f"Hello{added_token}\nuser\n  Hello, world!{added_token} 123"
+        for added_token in added_tokens
+    )
+    if SegmentEncoder(tokenizer, pattern).encode(probe) != tokenizer.encode(
+        probe, add_special_tokens=False
+    ):
+        return None
+    return pattern
+
+
+class DiskTokenizationCache:
+    """
+    Content-addressed on-disk cache of tokenized histories.
+
+    Entries are keyed by a hash of the history's messages, choices and tools,
+    the tokenizer identity and the tokenization settings, so resumed runs,
+    retried training steps and re-training on logged trajectories skip
+    tokenization. Each entry stores the token ids (int32), the assistant mask
+    (bit-packed), the logprobs (float32, the precision they are packed in) and
+    the rendered chat, compressed with zlib. The least recently used entries
+    are evicted once the cache exceeds `max_size` bytes.
+    """
+
+    _magic = b"ART1"
+    _header = struct.Struct("<4sII")
+
+    def __init__(self, dir: str, max_size: int) -> None:
+        self.dir = dir
+        self.max_size = max_size
+        # Bytes written since the last `evict`. Workers write with their own
+        # copies of the cache, so the total size is only known after a scan.
+        self._written = 0
+
+    def key(
+        self,
+        history: History,
+        tokenizer_cache: TokenizerCache,
+        allow_training_without_logprobs: bool,
+    ) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                [
+                    tokenizer_cache.fingerprint,
+                    allow_training_without_logprobs,
+                    history.messages_and_choices,
+                    history.tools,
+                ],
+                default=_json_default,
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+
+    def get(
+        self,
+        key: str,
+        advantage: float,
+        tokenizer_cache: TokenizerCache,
+        compact: bool = False,
+    ) -> TokenizedResult | CompactTokenizedResult | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, num_tokens, chat_length = self._header.unpack_from(data)
+            if magic != self._magic:
+                raise ValueError(f"Invalid tokenization cache entry {path}")
+            body = zlib.decompress(data[self._header.size :])
+            mask_offset = num_tokens * 4
+            logprobs_offset = mask_offset + (num_tokens + 7) // 8
+            chat_offset = logprobs_offset + num_tokens * 4
+            if len(body) != chat_offset + chat_length:
+                raise ValueError(f"Truncated tokenization cache entry {path}")
+            token_ids = np.frombuffer(body, "<i4", num_tokens)
+            assistant_mask = np.unpackbits(
+                np.frombuffer(
+                    body, np.uint8, logprobs_offset - mask_offset, mask_offset
+                ),
+                count=num_tokens,
+            ).view(np.bool_)
+            logprobs = np.frombuffer(body, "<f4", num_tokens, logprobs_offset)
+            chat = body[chat_offset:].decode()
+        except (OSError, ValueError, struct.error, zlib.error):
+            # Missing or unreadable entries are misses, `put` overwrites them
+            return None
+        # Mark as recently used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        result = CompactTokenizedResult(
+            advantage=advantage,
+            chat=chat,
+            token_ids=token_ids,
+            input_pos=_input_pos(num_tokens),
+            assistant_mask=assistant_mask,
+            logprobs=logprobs,
+        )
+        return result if compact else result.to_tokenized_result(tokenizer_cache)
+
+    def put(self, key: str, result: TokenizedResult | CompactTokenizedResult) -> None:
+        chat = result.chat.encode()
+        data = self._header.pack(self._magic, len(result.token_ids), len(chat)) + (
+            zlib.compress(
+                b"".join(
+                    (
+                        np.asarray(result.token_ids, "<i4").tobytes(),
+                        np.packbits(np.asarray(result.assistant_mask, bool)).tobytes(),
+                        np.asarray(result.logprobs, "<f4").tobytes(),
+                        chat,
+                    )
+                ),
+                1,
+            )
+        )
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write atomically, other threads and processes may read or write the
+        # same entry
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        self._written += len(data)
+        if self._written > self.max_size // 4:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        If the cache is larger than `max_size` bytes, removes the least recently
+        used entries until it is below 80% of `max_size`.
+        """
+        self._written = 0
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        if size <= self.max_size:
+            return
+        for _, path, entry_size in entries:
+            if size <= self.max_size * 0.8:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, key[:2], key)
+
+    def _entries(self) -> list[tuple[float, str, int]]:
+        entries: list[tuple[float, str, int]] = []
+        for root, _, files in os.walk(self.dir):
+            for file in files:
+                # Skip entries that are still being written
+                if file.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+
+def _json_default(obj: object) -> object:
+    if isinstance(obj, pydantic.BaseModel):
+        return obj.model_dump(mode="json")
+    return repr(obj)
+
 
 def tokenize_trajectory_groups(
     tokenizer: "PreTrainedTokenizerBase",
@@ -43,67 +514,560 @@ def tokenize_trajectory_groups(
     allow_training_without_logprobs: bool,
     scale_rewards: bool,
     shuffle_group_trajectories: bool = True,
-) -> Generator["TokenizedResult", None, None]:
-    for group in trajectory_groups:
-        if not group:
-            continue
-        results: list[TokenizedResult] = []
-        # Calculate GRPO group mean and standard deviation
-        reward_mean = sum(trajectory.reward for trajectory in group) / len(group)
-        reward_std = math.sqrt(
-            sum((trajectory.reward - reward_mean) ** 2 for trajectory in group)
-            / len(group)
+    tokenizer_cache: TokenizerCache | None = None,
+    incremental: bool = False,
+    disk_cache: DiskTokenizationCache | None = None,
+    compact: bool = False,
+) -> Generator[TokenizedResult | CompactTokenizedResult, None, None]:
+    """
+    Tokenizes trajectory groups in this process. Each group is seeded like in
+    `tokenize_trajectory_groups_in_parallel`, so the results are the same.
+    """
+    if tokenizer_cache is None:
+        tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+    seeds = [random.getrandbits(64) for _ in trajectory_groups]
+    for group, seed in zip(trajectory_groups, seeds):
+        yield from tokenize_trajectory_group(
+            tokenizer,
+            group,
+            allow_training_without_logprobs,
+            scale_rewards,
+            shuffle_group_trajectories,
+            tokenizer_cache,
+            incremental,
+            rng=random.Random(seed),
+            disk_cache=disk_cache,
+            compact=compact,
         )
-        for trajectory in group:
-            # Calculate GRPO advantage for this trajectory
-            advantage = trajectory.reward - reward_mean
-            if scale_rewards:
-                advantage /= reward_std + 1e-6
-            # Skip trajectories with no advantage
-            if advantage == 0:
-                continue
-            trajectory_results: list[TokenizedResult] = []
-            for history in [
-                History(
-                    messages_and_choices=trajectory.messages_and_choices,
-                    tools=trajectory.tools,
-                ),
-                *trajectory.additional_histories,
-            ]:
-                if result := tokenize_trajectory(
+
+
+def tokenize_trajectory_group(
+    tokenizer: "PreTrainedTokenizerBase",
+    group: TrajectoryGroup,
+    allow_training_without_logprobs: bool,
+    scale_rewards: bool,
+    shuffle_group_trajectories: bool,
+    tokenizer_cache: TokenizerCache,
+    incremental: bool = False,
+    rng: random.Random | None = None,
+    disk_cache: DiskTokenizationCache | None = None,
+    compact: bool = False,
+) -> list[TokenizedResult | CompactTokenizedResult]:
+    """
+    Tokenizes a single trajectory group. Uses the global random state for the
+    prompt id and shuffling unless `rng` is provided. Returns
+    `CompactTokenizedResult`s if `compact` is set.
+    """
+    if not group:
+        return []
+    rng = rng or cast(random.Random, random)
+    results: list[TokenizedResult | CompactTokenizedResult] = []
+    # Reuse histories tokenized while the batch was still being gathered
+    pretokenized_histories = get_pretokenized_histories(
+        group, tokenizer_cache, allow_training_without_logprobs, compact
+    )
+    # Share tokenized segments across the group's trajectories and histories
+    segment_encoder = tokenizer_cache.segment_encoder() if incremental else None
+    # Calculate GRPO group mean and standard deviation
+    reward_mean = sum(trajectory.reward for trajectory in group) / len(group)
+    reward_std = math.sqrt(
+        sum((trajectory.reward - reward_mean) ** 2 for trajectory in group) / len(group)
+    )
+    for i, trajectory in enumerate(group):
+        # Calculate GRPO advantage for this trajectory
+        advantage = trajectory.reward - reward_mean
+        if scale_rewards:
+            advantage /= reward_std + 1e-6
+        # Skip trajectories with no advantage
+        if advantage == 0:
+            continue
+        trajectory_results: list[TokenizedResult | CompactTokenizedResult] = []
+        if pretokenized_histories is not None:
+            trajectory_results = [
+                replace(result, advantage=advantage)
+                for result in pretokenized_histories[i]
+                if result
+            ]
+        else:
+            for history in get_histories(trajectory):
+                if result := tokenize_history(
                     tokenizer,
                     history,
                     advantage,
                     allow_training_without_logprobs,
+                    tokenizer_cache,
+                    segment_encoder,
+                    disk_cache,
+                    compact,
                 ):
                     trajectory_results.append(result)
-            weight = 1 / (
-                sum(sum(result.assistant_mask) for result in trajectory_results) + 1e-6
+        # Prompts never cover assistant tokens, so every history's assistant
+        # tokens are trained on, including those it shares with other histories
+        weight = 1 / (
+            sum(
+                int(np.count_nonzero(result.assistant_mask))
+                for result in trajectory_results
             )
-            for result in trajectory_results:
-                result.weight = weight
-            results.extend(trajectory_results)
-        # Choose a random prompt id
-        prompt_id = random.randint(-(2**63), 2**63 - 1)
-        # Find the longest shared prefix
-        # TODO: Potentially support multiple prompts per group
-        # Initial thought is to sort the results by token_ids and then
-        # successively group prompts with the same prefix.
-        prompt_length = len(
-            list(
-                takewhile(
-                    lambda x: len(set(x)) == 1,
-                    zip(*(r.token_ids for r in results)),
-                )
+            + 1e-6
+        )
+        for result in trajectory_results:
+            result.weight = weight
+        results.extend(trajectory_results)
+    assign_prompts(results, rng)
+    if shuffle_group_trajectories:
+        _shuffle_prompt_tree(results, rng)
+    return results
+
+
+def _shuffle_prompt_tree(
+    results: list[TokenizedResult | CompactTokenizedResult], rng: random.Random
+) -> None:
+    """
+    Shuffles a group's results in place, keeping the results below each nested
+    prompt contiguous so they tend to be packed into the same sequence, where
+    the prompt is only packed once.
+    """
+    # Children of every prompt, as (is prompt, prompt id or result index)
+    children: dict[int | None, list[tuple[bool, int]]] = {None: []}
+    for i, result in enumerate(results):
+        parent: int | None = None
+        for prompt_id, _ in result.prompts():
+            if prompt_id not in children:
+                children[prompt_id] = []
+                children[parent].append((True, prompt_id))
+            parent = prompt_id
+        children[parent].append((False, i))
+    shuffled: list[TokenizedResult | CompactTokenizedResult] = []
+    stack: list[tuple[bool, int | None]] = [(True, None)]
+    while stack:
+        is_prompt, key = stack.pop()
+        if not is_prompt:
+            shuffled.append(results[cast(int, key)])
+            continue
+        rng.shuffle(children[key])
+        stack.extend(reversed(children[key]))
+    results[:] = shuffled
+
+
+def assign_prompts(
+    results: "list[TokenizedResult] | list[CompactTokenizedResult] | list[TokenizedResult | CompactTokenizedResult]",
+    rng: random.Random,
+) -> None:
+    """
+    Assigns nested prompts to a group's results by building a prefix trie over
+    their token ids, so the packer can deduplicate every shared prefix and not
+    just the one shared by the whole group.
+
+    The outermost prompt is the longest prefix shared by all results. Below it,
+    each set of results sharing a longer prefix gets a nested prompt. Like the
+    outermost prompt, nested prompts are packed once per sequence.
+
+    Prompts end before the first assistant token and the last token of every
+    result they cover, so each result keeps its own completion tokens and is
+    trained with its own advantage, even if its completion equals or is a
+    prefix of a sibling's.
+    """
+    # Choose a random id for the outermost prompt
+    group_prompt_id = rng.randint(-(2**63), 2**63 - 1)
+    for result in results:
+        result.prompt_id = group_prompt_id
+        result.prompt_length = 0
+        result.parent_prompts = []
+    if not results:
+        return
+    token_ids = [np.asarray(result.token_ids) for result in results]
+    # The longest prompt each result may have
+    max_prompt_lengths = [
+        _max_prompt_length(result.assistant_mask, len(ids))
+        for result, ids in zip(results, token_ids)
+    ]
+    # Each entry is a set of results sharing `token_ids[:start]`, covered by `prompts`
+    stack: list[tuple[list[int], int, list[tuple[int, int]]]] = [
+        (list(range(len(results))), 0, [])
+    ]
+    while stack:
+        indices, start, prompts = stack.pop()
+        end = min(max_prompt_lengths[i] for i in indices)
+        for i in indices[1:]:
+            end = _common_prefix_length(token_ids[indices[0]], token_ids[i], start, end)
+        if len(indices) == len(results) and end > start:
+            prompts = [(group_prompt_id, end)]
+        elif len(indices) > 1 and end > start:
+            prompts = [*prompts, (rng.randint(-(2**63), 2**63 - 1), end)]
+        if len(indices) == 1:
+            _set_prompts(results[indices[0]], prompts)
+            continue
+        # Split the remaining results by their next token
+        buckets: dict[int, list[int]] = {}
+        for i in indices:
+            if max_prompt_lengths[i] > end:
+                buckets.setdefault(int(token_ids[i][end]), []).append(i)
+            else:
+                _set_prompts(results[i], prompts)
+        stack.extend((bucket, end, prompts) for bucket in reversed(buckets.values()))
+
+
+def _max_prompt_length(assistant_mask: "list[int] | np.ndarray", length: int) -> int:
+    """
+    Returns the index of a result's first assistant token, or of its last token
+    if that comes first.
+    """
+    assistant_mask = np.asarray(assistant_mask, dtype=np.bool_)
+    if assistant_mask.any():
+        return min(int(assistant_mask.argmax()), length - 1)
+    return max(length - 1, 0)
+
+
+def _common_prefix_length(a: np.ndarray, b: np.ndarray, start: int, end: int) -> int:
+    mismatches = a[start:end] != b[start:end]
+    if mismatches.any():
+        return start + int(mismatches.argmax())
+    return end
+
+
+def _set_prompts(
+    result: TokenizedResult | CompactTokenizedResult, prompts: list[tuple[int, int]]
+) -> None:
+    if prompts:
+        *result.parent_prompts, (result.prompt_id, result.prompt_length) = prompts
+
+
+def get_histories(trajectory: Trajectory) -> list[History]:
+    return [
+        History(
+            messages_and_choices=trajectory.messages_and_choices,
+            tools=trajectory.tools,
+        ),
+        *trajectory.additional_histories,
+    ]
+
+
+def tokenize_history(
+    tokenizer: "PreTrainedTokenizerBase",
+    history: History,
+    advantage: float,
+    allow_training_without_logprobs: bool,
+    tokenizer_cache: TokenizerCache,
+    segment_encoder: SegmentEncoder | None = None,
+    disk_cache: DiskTokenizationCache | None = None,
+    compact: bool = False,
+) -> TokenizedResult | CompactTokenizedResult | None:
+    """
+    Tokenizes a history with `tokenize_trajectory`, consulting `disk_cache` first.
+    """
+    if disk_cache is None:
+        return tokenize_trajectory(
+            tokenizer,
+            history,
+            advantage,
+            allow_training_without_logprobs,
+            tokenizer_cache,
+            segment_encoder,
+            compact,
+        )
+    key = disk_cache.key(history, tokenizer_cache, allow_training_without_logprobs)
+    if result := disk_cache.get(key, advantage, tokenizer_cache, compact):
+        return result
+    if result := tokenize_trajectory(
+        tokenizer,
+        history,
+        advantage,
+        allow_training_without_logprobs,
+        tokenizer_cache,
+        segment_encoder,
+        compact,
+    ):
+        disk_cache.put(key, result)
+    return result
+
+
+def tokenize_trajectory_histories(
+    tokenizer: "PreTrainedTokenizerBase",
+    trajectories: list[Trajectory],
+    allow_training_without_logprobs: bool,
+    tokenizer_cache: TokenizerCache,
+    incremental: bool = False,
+    disk_cache: DiskTokenizationCache | None = None,
+    compact: bool = False,
+) -> list[list[TokenizedResult | CompactTokenizedResult | None]]:
+    """
+    Tokenizes every history of each trajectory with a placeholder advantage.
+
+    Tokenization does not depend on rewards, so this can run while a batch is
+    still being gathered or scored. `tokenize_trajectory_group` fills in the
+    advantages, weights and prompt ids once the rewards are final.
+    """
+    segment_encoder = tokenizer_cache.segment_encoder() if incremental else None
+    return [
+        [
+            tokenize_history(
+                tokenizer,
+                history,
+                0.0,
+                allow_training_without_logprobs,
+                tokenizer_cache,
+                segment_encoder,
+                disk_cache,
+                compact,
             )
+            for history in get_histories(trajectory)
+        ]
+        for trajectory in trajectories
+    ]
+
+
+@dataclass
+class PretokenizedGroup:
+    """
+    Histories of a trajectory group tokenized in the background, attached to
+    the group by `Backend._pretokenize_trajectory_group`.
+    """
+
+    tokenizer_name: str
+    allow_training_without_logprobs: bool
+    trajectory_ids: list[int]
+    content_hashes: list[str]
+    histories: "Future[list[list[TokenizedResult | CompactTokenizedResult | None]]]"
+    compact: bool = False
+
+    @staticmethod
+    def fingerprint(group: TrajectoryGroup) -> tuple[list[int], list[str]]:
+        """
+        Returns the ids of the group's trajectories and a hash of the messages,
+        choices and tools of each, so edits after pretokenization are detected.
+        """
+        return [id(trajectory) for trajectory in group], [
+            hashlib.sha256(
+                json.dumps(
+                    [
+                        [history.messages_and_choices, history.tools]
+                        for history in get_histories(trajectory)
+                    ],
+                    default=_json_default,
+                    sort_keys=True,
+                ).encode()
+            ).hexdigest()
+            for trajectory in group
+        ]
+
+
+def pretokenize_trajectory_group(
+    group: TrajectoryGroup,
+    tokenizer_name: str,
+    allow_training_without_logprobs: bool,
+    histories: "Future[list[list[TokenizedResult | CompactTokenizedResult | None]]]",
+    compact: bool = False,
+) -> None:
+    trajectory_ids, content_hashes = PretokenizedGroup.fingerprint(group)
+    group._pretokenized = PretokenizedGroup(
+        tokenizer_name=tokenizer_name,
+        allow_training_without_logprobs=allow_training_without_logprobs,
+        trajectory_ids=trajectory_ids,
+        content_hashes=content_hashes,
+        histories=histories,
+        compact=compact,
+    )
+
+
+def get_pretokenized_histories(
+    group: TrajectoryGroup,
+    tokenizer_cache: TokenizerCache,
+    allow_training_without_logprobs: bool,
+    compact: bool = False,
+) -> list[list[TokenizedResult | CompactTokenizedResult | None]] | None:
+    """
+    Returns the group's pretokenized histories if they are still valid for the
+    group's trajectories and the current tokenization settings.
+    """
+    pretokenized = cast(PretokenizedGroup | None, group._pretokenized)
+    if (
+        pretokenized is None
+        or pretokenized.tokenizer_name != tokenizer_cache.name
+        or pretokenized.allow_training_without_logprobs
+        != allow_training_without_logprobs
+        or pretokenized.compact != compact
+        or (pretokenized.trajectory_ids, pretokenized.content_hashes)
+        != PretokenizedGroup.fingerprint(group)
+    ):
+        return None
+    try:
+        return pretokenized.histories.result()
+    except Exception:
+        return None
+
+
+def get_tokenize_executor(
+    tokenizer: "PreTrainedTokenizerBase", num_workers: int
+) -> ProcessPoolExecutor:
+    """
+    Returns a process pool whose workers each load `tokenizer` (and build its
+    `TokenizerCache`) once, for use with `tokenize_trajectory_groups_in_parallel`.
+    """
+    return ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_tokenize_worker,
+        initargs=(tokenizer,),
+    )
+
+
+def tokenize_trajectory_groups_in_parallel(
+    executor: ProcessPoolExecutor,
+    trajectory_groups: list[TrajectoryGroup],
+    allow_training_without_logprobs: bool,
+    scale_rewards: bool,
+    shuffle_group_trajectories: bool = True,
+    incremental: bool = False,
+    tokenizer_cache: TokenizerCache | None = None,
+    disk_cache: DiskTokenizationCache | None = None,
+    compact: bool = False,
+) -> tuple[list[TokenizedResult | CompactTokenizedResult], dict[str, float]]:
+    """
+    Tokenizes trajectory groups across the executor's worker processes.
+
+    Each group gets its own random seed drawn up front, and results are merged
+    in group order, so the output does not depend on the number of workers.
+    If `tokenizer_cache` is provided, groups with valid pretokenized histories
+    are finished in this process instead.
+
+    Returns the tokenized results and per-stage timings in seconds.
+    """
+    start = time.perf_counter()
+    seeds = [random.getrandbits(64) for _ in trajectory_groups]
+    pretokenized = [
+        tokenizer_cache is not None
+        and get_pretokenized_histories(
+            group, tokenizer_cache, allow_training_without_logprobs, compact
         )
-        # Set the prompt id and length
-        for result in results:
-            result.prompt_id = prompt_id
-            result.prompt_length = prompt_length
-        if shuffle_group_trajectories:
-            random.shuffle(results)
-        yield from results
+        is not None
+        for group in trajectory_groups
+    ]
+    worker_results = executor.map(
+        _tokenize_trajectory_group_in_worker,
+        # TrajectoryGroup does not support pickling, so send the trajectories
+        (
+            group.trajectories
+            for group, is_pretokenized in zip(trajectory_groups, pretokenized)
+            if not is_pretokenized
+        ),
+        (
+            seed
+            for seed, is_pretokenized in zip(seeds, pretokenized)
+            if not is_pretokenized
+        ),
+        repeat(allow_training_without_logprobs),
+        repeat(scale_rewards),
+        repeat(shuffle_group_trajectories),
+        repeat(incremental),
+        repeat(disk_cache),
+        repeat(compact),
+    )
+    group_results: list[
+        tuple[list[TokenizedResult | CompactTokenizedResult], float]
+    ] = []
+    for group, seed, is_pretokenized in zip(trajectory_groups, seeds, pretokenized):
+        if is_pretokenized:
+            assert tokenizer_cache is not None
+            group_start = time.perf_counter()
+            group_results.append(
+                (
+                    tokenize_trajectory_group(
+                        tokenizer_cache.tokenizer,
+                        group,
+                        allow_training_without_logprobs,
+                        scale_rewards,
+                        shuffle_group_trajectories,
+                        tokenizer_cache,
+                        incremental,
+                        rng=random.Random(seed),
+                        disk_cache=disk_cache,
+                        compact=compact,
+                    ),
+                    time.perf_counter() - group_start,
+                )
+            )
+        else:
+            group_results.append(next(worker_results))
+    results = [result for results, _ in group_results for result in results]
+    return results, {
+        "tokenize": time.perf_counter() - start,
+        "tokenize_worker": sum(seconds for _, seconds in group_results),
+    }
+
+
+def submit_trajectory_histories(
+    executor: ProcessPoolExecutor,
+    trajectories: list[Trajectory],
+    allow_training_without_logprobs: bool,
+    incremental: bool = False,
+    disk_cache: DiskTokenizationCache | None = None,
+    compact: bool = False,
+) -> "Future[list[list[TokenizedResult | CompactTokenizedResult | None]]]":
+    """
+    Runs `tokenize_trajectory_histories` on an executor from `get_tokenize_executor`.
+    """
+    return executor.submit(
+        _tokenize_trajectory_histories_in_worker,
+        trajectories,
+        allow_training_without_logprobs,
+        incremental,
+        disk_cache,
+        compact,
+    )
+
+
+_worker_tokenizer_cache: TokenizerCache | None = None
+
+
+def _init_tokenize_worker(tokenizer: "PreTrainedTokenizerBase") -> None:
+    global _worker_tokenizer_cache
+    _worker_tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+
+
+def _tokenize_trajectory_histories_in_worker(
+    trajectories: list[Trajectory],
+    allow_training_without_logprobs: bool,
+    incremental: bool,
+    disk_cache: DiskTokenizationCache | None,
+    compact: bool,
+) -> list[list[TokenizedResult | CompactTokenizedResult | None]]:
+    assert _worker_tokenizer_cache is not None, "Tokenize worker not initialized"
+    return tokenize_trajectory_histories(
+        _worker_tokenizer_cache.tokenizer,
+        trajectories,
+        allow_training_without_logprobs,
+        _worker_tokenizer_cache,
+        incremental,
+        disk_cache,
+        compact,
+    )
+
+
+def _tokenize_trajectory_group_in_worker(
+    trajectories: list[Trajectory],
+    seed: int,
+    allow_training_without_logprobs: bool,
+    scale_rewards: bool,
+    shuffle_group_trajectories: bool,
+    incremental: bool,
+    disk_cache: DiskTokenizationCache | None,
+    compact: bool,
+) -> tuple[list[TokenizedResult | CompactTokenizedResult], float]:
+    assert _worker_tokenizer_cache is not None, "Tokenize worker not initialized"
+    start = time.perf_counter()
+    results = tokenize_trajectory_group(
+        _worker_tokenizer_cache.tokenizer,
+        TrajectoryGroup(trajectories),
+        allow_training_without_logprobs,
+        scale_rewards,
+        shuffle_group_trajectories,
+        _worker_tokenizer_cache,
+        incremental,
+        rng=random.Random(seed),
+        disk_cache=disk_cache,
+        compact=compact,
+    )
+    return results, time.perf_counter() - start
 
 
 def tokenize_trajectory(
@@ -111,10 +1075,22 @@ def tokenize_trajectory(
     history: History,
     advantage: float,
     allow_training_without_logprobs: bool,
-) -> TokenizedResult | None:
+    tokenizer_cache: TokenizerCache | None = None,
+    segment_encoder: SegmentEncoder | None = None,
+    compact: bool = False,
+) -> TokenizedResult | CompactTokenizedResult | None:
     """
-    Tokenizes a trajectory and returns a TokenizedResult.
+    Tokenizes a trajectory and returns a TokenizedResult, or a
+    CompactTokenizedResult if `compact` is set.
     """
+    if tokenizer_cache is None:
+        tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+
+    def encode(text: str) -> list[int]:
+        if segment_encoder is not None:
+            return segment_encoder.encode(text)
+        return tokenizer.encode(text, add_special_tokens=False)
+
     # Find the index of the last assistant message
     last_assistant_index = -1
     for i, message_or_choice in enumerate(history.messages_and_choices):
@@ -141,37 +1117,33 @@ def tokenize_trajectory(
             tokenize=False,
         ),
     )
-    original_token_ids = cast(
-        list[int],
-        tokenizer.apply_chat_template(
-            cast(list[dict], messages),
-            tools=history.tools,  # type: ignore
-        ),
-    )
-    sentinal_token_id = max(
-        set(range(cast(int, tokenizer.vocab_size))) - set(original_token_ids)
-    )
-    sentinal_token = tokenizer.decode(sentinal_token_id)
-    token_ids = cast(
-        list[int],
-        tokenizer.apply_chat_template(
-            cast(
-                list[dict],
-                [
-                    (
-                        message_or_choice
-                        if isinstance(message_or_choice, dict)
-                        and not message_or_choice["role"] == "assistant"
-                        else {
-                            "role": "assistant",
-                            "content": sentinal_token,
-                        }
-                    )
-                    for message_or_choice in messages_and_choices
-                ],
+    # Equivalent to apply_chat_template(..., tokenize=True) without re-rendering
+    original_token_ids = encode(chat)
+    sentinal_token_id = tokenizer_cache.sentinel_token_id(original_token_ids)
+    sentinal_token = tokenizer_cache.decode(sentinal_token_id)
+    token_ids = encode(
+        cast(
+            str,
+            tokenizer.apply_chat_template(
+                cast(
+                    list[dict],
+                    [
+                        (
+                            message_or_choice
+                            if isinstance(message_or_choice, dict)
+                            and not message_or_choice["role"] == "assistant"
+                            else {
+                                "role": "assistant",
+                                "content": sentinal_token,
+                            }
+                        )
+                        for message_or_choice in messages_and_choices
+                    ],
+                ),
+                tools=history.tools,  # type: ignore
+                tokenize=False,
             ),
-            tools=history.tools,  # type: ignore
-        ),
+        )
     )
     assistant_mask: list[int] = [0] * len(token_ids)
     logprobs = [float("nan")] * len(token_ids)
@@ -186,10 +1158,7 @@ def tokenize_trajectory(
         if isinstance(message_or_choice, dict):
             content = message_or_choice.get("content")
             assert isinstance(content, str)
-            content_token_ids = tokenizer.encode(
-                content,
-                add_special_tokens=False,
-            )
+            content_token_ids = encode(content)
             token_ids[start:end] = content_token_ids
             logprobs[start:end] = [float("nan")] * len(content_token_ids)
             assistant_mask[start:end] = [1] * len(content_token_ids)
@@ -204,7 +1173,7 @@ def tokenize_trajectory(
             if (
                 bytes(token_logprobs[0].bytes or []).decode("utf-8")
                 == "<think>"
-                == tokenizer.decode(token_ids[start - 4])
+                == tokenizer_cache.decode(token_ids[start - 4])
             ):
                 start -= 4
             token_ids[start:end] = (
@@ -215,10 +1184,14 @@ def tokenize_trajectory(
                 token_logprob.logprob for token_logprob in token_logprobs
             )
             assistant_mask[start:end] = [1] * len(token_logprobs)
+    if compact:
+        return CompactTokenizedResult.from_lists(
+            advantage, chat, token_ids, assistant_mask, logprobs
+        )
     return TokenizedResult(
         advantage=advantage,
         chat=chat,
-        tokens=[tokenizer.decode(token_id) for token_id in token_ids],
+        tokens=[tokenizer_cache.decode(token_id) for token_id in token_ids],
         token_ids=token_ids,
         input_pos=list(range(len(token_ids))),
         assistant_mask=assistant_mask,
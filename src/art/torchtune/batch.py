@@ -5,6 +5,6 @@ from ..preprocessing.pack import DiskPackedTensors
 
 
 class Batch(BaseModel):
-    disk_packed_tensors: DiskPackedTensors
+    disk_packed_tensors: list[DiskPackedTensors]
     config: types.TrainConfig
     dev_config: dev.TrainConfig
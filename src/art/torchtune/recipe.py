@@ -47,7 +47,11 @@ from torchtune.training.quantization import (
 from tqdm import tqdm
 
 from .. import dev, types
-from ..preprocessing.pack import PackedTensors, packed_tensors_from_dir
+from ..preprocessing.pack import (
+    PackedTensors,
+    packed_tensors_from_dir,
+    upcast_packed_tensors,
+)
 from ..unsloth.train import gc_and_empty_cuda_cache
 from .batch import Batch
 from .config import (
@@ -705,9 +709,10 @@ class FullFinetuneRecipeDistributed(FTRecipeInterface):
         return_new_logprobs: bool = False,
     ) -> torch.Tensor:
         import torch
-        from torch.nn.attention.flex_attention import BlockMask, create_block_mask
+        from torch.nn.attention.flex_attention import BlockMask
 
         from ..unsloth.train import shift_tensor
+        from ..utils.segment_mask import SegmentMask
 
         def make_block_mask(
             group_ids: torch.Tensor,  # [B, S]  int32/64
@@ -717,31 +722,16 @@ class FullFinetuneRecipeDistributed(FTRecipeInterface):
             """
             FlexAttention equivalent of
 
-                causal_mask & (group_ids[q]==group_ids[kv]  |  parent_ids[kv]==group_ids[q])
+                causal_mask & (group_ids[kv] <= group_ids[q] <= parent_ids[kv])
 
-            * group_ids : id shared by all tokens of the same sampled trajectory
-            * parent_ids: id identifying the prompt that produced each token
+            * group_ids : pre-order id of each token's prompt or completion
+            * parent_ids: last id of the subtree under each token's prompt or completion
             """
-            B, S = group_ids.shape  # batch, sequence length
-
-            # the closure captures the two id tensors; that's fine for torch.compile
-            def mask_mod(b, h, q_idx, kv_idx):
-                # causal constraint
-                causal = kv_idx <= q_idx
-
-                same_group = group_ids[b, q_idx] == group_ids[b, kv_idx]
-                prompt_link = parent_ids[b, q_idx] == group_ids[b, kv_idx]
-
-                return causal & (same_group | prompt_link)
-
-            return create_block_mask(
-                mask_mod,
-                B=B,
-                H=None,
-                Q_LEN=S,
-                KV_LEN=S,
-                BLOCK_SIZE=block_size,
-            )
+            # Tiles are classified from per-block id bounds, so the mask is not
+            # evaluated for every query and key
+            return SegmentMask.from_ids(
+                group_ids, parent_ids, block_size
+            ).to_block_mask()
 
         # mask = calculate_mask(
         #     batch_size=batch["tokens"].shape[0],
@@ -918,6 +908,7 @@ class FullFinetuneRecipeDistributed(FTRecipeInterface):
                     torch.cuda.memory._record_memory_history()
 
                 utils.batch_to_device(micro_batch, self._device)  # type: ignore
+                upcast_packed_tensors(micro_batch)
 
                 # Calculate the number of unmasked tokens in the current batch
                 # and increment the total number of tokens seen in the step
@@ -1188,27 +1179,32 @@ class FullFinetuneRecipeDistributed(FTRecipeInterface):
                             )
                     time.sleep(0.5)
                     continue
-            packed_tensors = packed_tensors_from_dir(**batch.disk_packed_tensors)
             if self._current_device != self._device:
                 self._move_to(self._device)
-            n = batch.disk_packed_tensors["num_sequences"]
-            micro_batches = [
-                cast(
-                    PackedTensors,
-                    {
-                        k: cast(torch.Tensor, v)[i % n : i % n + 1]
-                        for k, v in packed_tensors.items()
-                    },
-                )
-                for i in range(
-                    self.dp_rank,
-                    math.ceil(n / self.dp_degree) * self.dp_degree,
-                    self.dp_degree,
+            # Sequence length buckets are trained on in order, each padded to a
+            # multiple of the data parallel degree so ranks stay in lockstep
+            micro_batches = []
+            for disk_packed_tensors in batch.disk_packed_tensors:
+                packed_tensors = packed_tensors_from_dir(**disk_packed_tensors)
+                n = disk_packed_tensors["num_sequences"]
+                micro_batches.extend(
+                    cast(
+                        PackedTensors,
+                        {
+                            k: cast(torch.Tensor, v)[i % n : i % n + 1]
+                            for k, v in packed_tensors.items()
+                        },
+                    )
+                    for i in range(
+                        self.dp_rank,
+                        math.ceil(n / self.dp_degree) * self.dp_degree,
+                        self.dp_degree,
+                    )
                 )
-            ]
             if batch.dev_config.get("precalculate_logprobs", False):
                 for micro_batch in micro_batches:
                     utils.batch_to_device(micro_batch, self._device)  # type: ignore
+                    upcast_packed_tensors(micro_batch)
 
                     # Disable gradient tracking for logprob calculation to save memory
                     with torch.no_grad():
@@ -45,7 +45,7 @@ class TorchtuneService:
 
     async def train(
         self,
-        disk_packed_tensors: DiskPackedTensors,
+        disk_packed_tensors: list[DiskPackedTensors],
         config: types.TrainConfig,
         _config: dev.TrainConfig,
         verbose: bool = False,
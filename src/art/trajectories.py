@@ -125,6 +125,8 @@ def get_messages(messages_and_choices: MessagesAndChoices) -> Messages:
 class TrajectoryGroup(pydantic.BaseModel):
     trajectories: list[Trajectory]
     exceptions: list[PydanticException] = []
+    # Set by Backend._pretokenize_trajectory_group, see art.preprocessing.tokenize
+    _pretokenized: Any = pydantic.PrivateAttr(default=None)
 
     def __init__(
         self,
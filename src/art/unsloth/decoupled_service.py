@@ -5,10 +5,9 @@ import time
 from collections import Counter
 from dataclasses import dataclass
 from functools import cached_property
-from typing import Any, AsyncIterator, cast
+from typing import AsyncIterator, cast
 
 import peft
-import torch
 from datasets import Dataset
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 from transformers.utils.dummy_pt_objects import GenerationMixin, PreTrainedModel
@@ -24,12 +23,21 @@ from ..local.checkpoints import get_last_checkpoint_dir
 from ..preprocessing.pack import (
     DiskPackedTensors,
     PackedTensors,
+    micro_batches,
     packed_tensors_from_dir,
 )
 from ..utils.get_model_step import get_step_from_dir
 from ..utils.output_dirs import get_step_checkpoint_dir
+from ..utils.trainer_channel import TrainerChannel
 from ..vllm import get_llm, get_worker, openai_server_task, run_on_workers
-from .train import gc_and_empty_cuda_cache, train
+from .train import (
+    calculate_logprobs_in_place,
+    gc_and_empty_cuda_cache,
+    mark_warm,
+    needs_warmup,
+    train,
+    use_compile_cache,
+)
 
 
 class CausalLM(PreTrainedModel, GenerationMixin):
@@ -50,8 +58,7 @@ class UnslothState:
     tokenizer: PreTrainedTokenizerBase
     peft_model: peft.peft_model.PeftModelForCausalLM
     trainer: GRPOTrainer
-    inputs_queue: asyncio.Queue[TrainInputs]
-    results_queue: asyncio.Queue[dict[str, float]]
+    trainer_channel: TrainerChannel[TrainInputs]
 
 
 @dataclass
@@ -85,7 +92,7 @@ class DecoupledUnslothService:
 
     async def train(
         self,
-        disk_packed_tensors: DiskPackedTensors,
+        disk_packed_tensors: list[DiskPackedTensors],
         config: types.TrainConfig,
         _config: dev.TrainConfig,
         verbose: bool = False,
@@ -117,93 +124,107 @@ class DecoupledUnslothService:
         # Free memory after vLLM workers are asleep
         gc_and_empty_cuda_cache()
 
-        # Load packed tensors
-        packed_tensors = packed_tensors_from_dir(**disk_packed_tensors)
+        # Load the packed tensors of every sequence length bucket, with a column for
+        # reference logprobs if the loss needs them
+        buckets = [
+            packed_tensors_from_dir(**bucket, ref_logprobs=config.beta > 0.0)
+            for bucket in disk_packed_tensors
+        ]
 
+        channel = self._state.trainer_channel
         # Wait for existing batches to finish
-        await self._state.results_queue.join()
+        await channel.results.join()
 
         # If we haven't already, start the training task
         if not hasattr(self, "_train_task") or self._train_task is None:
             self._train_task = asyncio.create_task(
-                train(
-                    trainer=self._state.trainer,
-                    results_queue=self._state.results_queue,
-                )
+                train(trainer=self._state.trainer, channel=channel)
             )
-            warmup = True
+            warmup = needs_warmup(self.output_dir, _config.get("warmup", "auto"))
         else:
             warmup = False
-        precalculate_logprobs = _config.get("precalculate_logprobs", False)
+        warmup_metrics: dict[str, float] = {}
         # Train on the batch
-        for offset in range(0, packed_tensors["tokens"].shape[0]):
-            for _ in range(2 if warmup else 1):
-                if precalculate_logprobs and not warmup:
-                    packed_tensors["logprobs"] = torch.cat(
-                        [
-                            self._state.trainer.compute_loss(
-                                self._state.peft_model,
-                                TrainInputs(
-                                    **{
-                                        k: v[_offset : _offset + 1]
-                                        for k, v in packed_tensors.items()
-                                        if isinstance(v, torch.Tensor)
-                                    },
-                                    config=config,
-                                    _config=_config,
-                                    return_new_logprobs=True,
-                                ),  # type: ignore
-                            )
-                            for _offset in range(0, packed_tensors["tokens"].shape[0])
-                        ]
-                    ).to("cpu")
-                    precalculate_logprobs = False
-                self._state.inputs_queue.put_nowait(
-                    TrainInputs(
-                        **{
-                            k: (
-                                v[offset : offset + 1, :1024]
-                                if warmup and v.dim() > 1
-                                else v[offset : offset + 1]
-                            )
-                            for k, v in packed_tensors.items()
-                            if isinstance(v, torch.Tensor)
-                        },
-                        config=(
-                            config.model_copy(
+        micro_batch_size = _config.get("micro_batch_size", 1)
+        gradient_accumulation_steps = (
+            self._state.trainer.args.gradient_accumulation_steps
+        )
+        for packed_tensors in buckets:
+            if warmup:
+                # Warm up on a truncated first step with a negligible learning rate
+                warmup_start = time.monotonic()
+                for micro_batch in next(
+                    micro_batches(
+                        packed_tensors, micro_batch_size, gradient_accumulation_steps
+                    )
+                ):
+                    await channel.put(
+                        TrainInputs(
+                            **{
+                                k: v[:1, :1024] if v.dim() > 1 else v
+                                for k, v in micro_batch.items()
+                            },
+                            config=config.model_copy(
                                 update={"lr": 1e-9, "beta": 0.0, "kl_coef": 0.0}
-                            )
-                            if warmup
-                            else config
-                        ),
-                        _config=_config,
-                        return_new_logprobs=False,
+                            ),
+                            _config=_config,
+                            return_new_logprobs=False,
+                        )
                     )
+                await channel.get_result(self._train_task)
+                gc_and_empty_cuda_cache()
+                await asyncio.sleep(0.1)
+                warmup = False
+                mark_warm(self.output_dir)
+                warmup_metrics["warmup_time"] = time.monotonic() - warmup_start
+            if "ref_logprobs" in packed_tensors or _config.get(
+                "precalculate_logprobs", False
+            ):
+                # The trainer thread may still be finishing the last step
+                await channel.wait_idle(self._train_task)
+            if "ref_logprobs" in packed_tensors:
+                calculate_logprobs_in_place(
+                    self._state.trainer,
+                    self._state.peft_model,
+                    packed_tensors,
+                    "ref_logprobs",
+                    config,
+                    _config,
                 )
-                # Wait for a result from the queue or for the training task to,
-                # presumably, raise an exception
-                done, _ = await asyncio.wait(
-                    [
-                        asyncio.create_task(self._state.results_queue.get()),
-                        self._train_task,
-                    ],
-                    return_when=asyncio.FIRST_COMPLETED,
+            if _config.get("precalculate_logprobs", False):
+                calculate_logprobs_in_place(
+                    self._state.trainer,
+                    self._state.peft_model,
+                    packed_tensors,
+                    "logprobs",
+                    config,
+                    _config,
                 )
-                if verbose:
-                    print(
-                        "Done waiting for a result from the queue or for the training task to, presumably, raise an exception"
+            # Queue the inputs of the next step before waiting for the result of the
+            # current one, so the trainer never waits on the event loop
+            num_pending_steps = 0
+            for step in micro_batches(
+                packed_tensors, micro_batch_size, gradient_accumulation_steps
+            ):
+                for micro_batch in step:
+                    await channel.put(
+                        TrainInputs(
+                            **micro_batch,  # type: ignore
+                            config=config,
+                            _config=_config,
+                            return_new_logprobs=False,
+                        )
                     )
-                for task in done:
-                    result = task.result()
-                    # If `result` is `None`, the training task finished somehow.
-                    assert result is not None, "The training task should never finish."
-                    self._state.results_queue.task_done()
-                    if warmup:
-                        gc_and_empty_cuda_cache()
-                        await asyncio.sleep(0.1)
-                        warmup = False
-                    else:
-                        yield result
+                num_pending_steps += 1
+                if num_pending_steps > 1:
+                    result = await channel.get_result(self._train_task)
+                    yield {**result, **warmup_metrics}
+                    warmup_metrics = {}
+                    num_pending_steps -= 1
+            for _ in range(num_pending_steps):
+                result = await channel.get_result(self._train_task)
+                yield {**result, **warmup_metrics}
+                warmup_metrics = {}
 
         if verbose:
             print("Saving new LoRA adapter...")
@@ -242,6 +263,8 @@ class DecoupledUnslothService:
 
     @cached_property
     def _state(self) -> UnslothState:
+        # Reuse compiled kernels of previous services, see `use_compile_cache`
+        use_compile_cache(self.output_dir)
         import unsloth
 
         # Initialize Unsloth model
@@ -275,30 +298,15 @@ class DecoupledUnslothService:
             processing_class=tokenizer,
         )
 
-        # Initialize queues
-        inputs_queue: asyncio.Queue[TrainInputs] = asyncio.Queue()
-        results_queue: asyncio.Queue[dict[str, float]] = asyncio.Queue()
-
-        # Patch trainer _prepare_inputs() to pull from queue
-        def _async_prepare_inputs(*_: Any, **__: Any) -> dict[str, torch.Tensor]:
-            async def get_inputs() -> TrainInputs:
-                return await inputs_queue.get()
-
-            # Force otherwise synchronous _prepare_inputs() to yield
-            # with nested asyncio.run() call
-            inputs = asyncio.run(get_inputs())
-
-            return cast(dict[str, torch.Tensor], inputs)
-
-        trainer._prepare_inputs = _async_prepare_inputs
+        # Inputs are prefetched to the training device while the previous step runs
+        trainer_channel = TrainerChannel[TrainInputs](device=trainer.accelerator.device)
 
         return UnslothState(
             model=model,
             tokenizer=tokenizer,
             peft_model=peft_model,
             trainer=trainer,
-            inputs_queue=inputs_queue,
-            results_queue=results_queue,
+            trainer_channel=trainer_channel,
         )
 
     @cached_property
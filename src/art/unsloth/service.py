@@ -1,10 +1,12 @@
 import asyncio
 import functools
 import os
+import time
 from dataclasses import dataclass
 from typing import TYPE_CHECKING, AsyncIterator
 
 import torch
+from typing_extensions import NotRequired
 
 from art.utils.get_model_step import get_step_from_dir
 
@@ -13,9 +15,16 @@ from ..local.checkpoints import get_last_checkpoint_dir
 from ..preprocessing.pack import (
     DiskPackedTensors,
     PackedTensors,
+    micro_batches,
     packed_tensors_from_dir,
 )
-from .train import train
+from .train import (
+    calculate_logprobs_in_place,
+    mark_warm,
+    needs_warmup,
+    train,
+    use_compile_cache,
+)
 
 if TYPE_CHECKING:
     from unsloth_zoo.vllm_lora_request import LoRARequest  # type: ignore
@@ -27,6 +36,8 @@ class TrainInputs(PackedTensors):
     config: types.TrainConfig
     _config: dev.TrainConfig
     return_new_logprobs: bool
+    return_ref_logprobs: NotRequired[bool]
+    loss_scale: NotRequired[torch.Tensor]
 
 
 @dataclass
@@ -40,14 +51,12 @@ class UnslothService:
 
     @functools.cached_property
     def state(self) -> "ModelState":
+        # Reuse compiled kernels of previous services, see `use_compile_cache`
+        use_compile_cache(self.output_dir)
         from .state import ModelState
 
         return ModelState(self.config)
 
-    @functools.cached_property
-    def results_queue(self) -> asyncio.Queue[dict[str, float]]:
-        return asyncio.Queue()
-
     async def start_openai_server(self, config: dev.OpenAIServerConfig | None) -> None:
         from ..vllm import openai_server_task
 
@@ -81,104 +90,118 @@ class UnslothService:
 
     async def train(
         self,
-        disk_packed_tensors: DiskPackedTensors,
+        disk_packed_tensors: list[DiskPackedTensors],
         config: types.TrainConfig,
         _config: dev.TrainConfig,
         verbose: bool = False,
     ) -> AsyncIterator[dict[str, float]]:
-        # Get the packed tensors from disk
-        packed_tensors = packed_tensors_from_dir(**disk_packed_tensors)
+        # Get the packed tensors of every sequence length bucket from disk, with a
+        # column for reference logprobs if the loss needs them
+        buckets = [
+            packed_tensors_from_dir(**bucket, ref_logprobs=config.beta > 0.0)
+            for bucket in disk_packed_tensors
+        ]
+        channel = self.state.trainer_channel
         # Wait for existing batches to finish
-        await self.results_queue.join()
+        await channel.results.join()
         # If we haven't already, start the training task
         if self._train_task is None:
             self._train_task = asyncio.create_task(
-                train(
-                    trainer=self.state.trainer,
-                    results_queue=self.results_queue,
-                )
+                train(trainer=self.state.trainer, channel=channel)
             )
-            warmup = True
+            warmup = needs_warmup(self.output_dir, _config.get("warmup", "auto"))
         else:
             warmup = False
-        precalculate_logprobs = _config.get("precalculate_logprobs", False)
+        warmup_metrics: dict[str, float] = {}
         # Enter training mode
         async with self.state.vllm.train_mode():
-            for offset in range(0, packed_tensors["tokens"].shape[0]):
-                for _ in range(2 if warmup else 1):
-                    if precalculate_logprobs and not warmup:
-                        packed_tensors["original_logprobs"] = packed_tensors["logprobs"]  # type: ignore
-                        packed_tensors["logprobs"] = torch.cat(
-                            [
-                                self.state.trainer.compute_loss(
-                                    self.state.peft_model,
-                                    TrainInputs(
-                                        **{
-                                            k: v[_offset : _offset + 1]
-                                            for k, v in packed_tensors.items()
-                                            if isinstance(v, torch.Tensor)
-                                        },
-                                        config=config,
-                                        _config=_config,
-                                        return_new_logprobs=True,
-                                    ),  # type: ignore
-                                )
-                                for _offset in range(
-                                    0, packed_tensors["tokens"].shape[0]
-                                )
-                            ]
-                        ).to("cpu")
-                        precalculate_logprobs = False
-                    self.state.inputs_queue.put_nowait(
-                        TrainInputs(
-                            **{
-                                k: (
-                                    v[offset : offset + 1, :1024]
-                                    if warmup and v.dim() > 1
-                                    else v[offset : offset + 1]
-                                )
-                                for k, v in packed_tensors.items()
-                                if isinstance(v, torch.Tensor)
-                            },
-                            config=(
-                                config.model_copy(
+            micro_batch_size = _config.get("micro_batch_size", 1)
+            gradient_accumulation_steps = (
+                self.state.trainer.args.gradient_accumulation_steps
+            )
+            for packed_tensors in buckets:
+                if warmup:
+                    # Warm up on a truncated first step with a negligible learning rate
+                    warmup_start = time.monotonic()
+                    for micro_batch in next(
+                        micro_batches(
+                            packed_tensors,
+                            micro_batch_size,
+                            gradient_accumulation_steps,
+                        )
+                    ):
+                        await channel.put(
+                            TrainInputs(
+                                **{
+                                    k: v[:1, :1024] if v.dim() > 1 else v
+                                    for k, v in micro_batch.items()
+                                },
+                                config=config.model_copy(
                                     update={"lr": 1e-9, "beta": 0.0, "kl_coef": 0.0}
-                                )
-                                if warmup
-                                else config
-                            ),
-                            _config=_config,
-                            return_new_logprobs=False,
+                                ),
+                                _config=_config,
+                                return_new_logprobs=False,
+                            )
                         )
+                    await channel.get_result(self._train_task)
+                    from .state import gc_and_empty_cuda_cache
+
+                    gc_and_empty_cuda_cache()
+                    await asyncio.sleep(0.1)
+                    warmup = False
+                    mark_warm(self.output_dir)
+                    warmup_metrics["warmup_time"] = time.monotonic() - warmup_start
+                if "ref_logprobs" in packed_tensors or _config.get(
+                    "precalculate_logprobs", False
+                ):
+                    # The trainer thread may still be finishing the last step
+                    await channel.wait_idle(self._train_task)
+                if "ref_logprobs" in packed_tensors:
+                    calculate_logprobs_in_place(
+                        self.state.trainer,
+                        self.state.peft_model,
+                        packed_tensors,
+                        "ref_logprobs",
+                        config,
+                        _config,
                     )
-                    # Wait for a result from the queue or for the training task to,
-                    # presumably, raise an exception
-                    done, _ = await asyncio.wait(
-                        [
-                            asyncio.create_task(self.results_queue.get()),
-                            self._train_task,
-                        ],
-                        return_when=asyncio.FIRST_COMPLETED,
+                if _config.get("precalculate_logprobs", False):
+                    packed_tensors["original_logprobs"] = packed_tensors[
+                        "logprobs"
+                    ].clone()  # type: ignore
+                    calculate_logprobs_in_place(
+                        self.state.trainer,
+                        self.state.peft_model,
+                        packed_tensors,
+                        "logprobs",
+                        config,
+                        _config,
                     )
-                    if verbose:
-                        print(
-                            "Done waiting for a result from the queue or for the training task to, presumably, raise an exception"
-                        )
-                    for task in done:
-                        result = task.result()
-                        # If `result` is `None`, the training task finished somehow.
-                        assert result is not None, (
-                            "The training task should never finish."
+                # Queue the inputs of the next step before waiting for the result of
+                # the current one, so the trainer never waits on the event loop
+                num_pending_steps = 0
+                for step in micro_batches(
+                    packed_tensors, micro_batch_size, gradient_accumulation_steps
+                ):
+                    for micro_batch in step:
+                        await channel.put(
+                            TrainInputs(
+                                **micro_batch,  # type: ignore
+                                config=config,
+                                _config=_config,
+                                return_new_logprobs=False,
+                            )
                         )
-                        self.results_queue.task_done()
-                        if warmup:
-                            from .state import gc_and_empty_cuda_cache
-
-                            gc_and_empty_cuda_cache()
-                            await asyncio.sleep(0.1)
-                            warmup = False
-                        else:
-                            yield result
+                    num_pending_steps += 1
+                    if num_pending_steps > 1:
+                        result = await channel.get_result(self._train_task)
+                        yield {**result, **warmup_metrics}
+                        warmup_metrics = {}
+                        num_pending_steps -= 1
+                for _ in range(num_pending_steps):
+                    result = await channel.get_result(self._train_task)
+                    yield {**result, **warmup_metrics}
+                    warmup_metrics = {}
             if verbose:
                 print("Saving new LoRA adapter...")
             # Save the new LoRA adapter
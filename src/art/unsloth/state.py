@@ -4,7 +4,6 @@ from contextlib import asynccontextmanager
 from dataclasses import replace
 from typing import TYPE_CHECKING, Any, AsyncGenerator, cast
 
-import nest_asyncio
 import peft
 import torch
 import unsloth  # type: ignore
@@ -21,13 +20,12 @@ from vllm.worker.multi_step_model_runner import MultiStepModelRunner
 from vllm.worker.worker_base import WorkerWrapperBase
 
 from ..dev.model import InternalModelConfig
+from ..utils.trainer_channel import TrainerChannel
 from .train import gc_and_empty_cuda_cache
 
 if TYPE_CHECKING:
     from .service import TrainInputs
 
-nest_asyncio.apply()
-
 
 class CausallLM(PreTrainedModel, GenerationMixin):
     vllm_engine: AsyncLLMEngine
@@ -102,20 +100,10 @@ class ModelState:
             train_dataset=Dataset.from_list([data for _ in range(10_000_000)]),
             processing_class=self.tokenizer,
         )
-        self.inputs_queue = asyncio.Queue["TrainInputs"]()
-
-        # Patch trainer _prepare_inputs()
-        def _async_prepare_inputs(*_, **__) -> dict[str, torch.Tensor]:
-            async def get_inputs() -> "TrainInputs":
-                return await self.inputs_queue.get()
-
-            # Force otherwise synchronous _prepare_inputs() to yield
-            # with nested asyncio.run() call
-            inputs = asyncio.run(get_inputs())
-
-            return cast(dict[str, torch.Tensor], inputs)
-
-        self.trainer._prepare_inputs = _async_prepare_inputs
+        # Inputs are prefetched to the training device while the previous step runs
+        self.trainer_channel = TrainerChannel["TrainInputs"](
+            device=self.trainer.accelerator.device
+        )
 
 
 class vLLMState:
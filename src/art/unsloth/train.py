@@ -1,33 +1,46 @@
 import asyncio
 import gc
+import math
 import os
 from collections import defaultdict
 from contextlib import nullcontext
-from typing import TYPE_CHECKING, Callable, cast
+from typing import TYPE_CHECKING, Callable, Literal, cast
 
-import nest_asyncio
 import torch
 from peft.peft_model import PeftModel
+from tqdm import auto as tqdm
 from trl import GRPOTrainer
 
 from .. import dev
+from ..preprocessing.pack import PackedTensors, upcast_packed_tensors
 from ..types import TrainConfig
-from ..utils.group_aggregate import group_aggregate
+from ..utils.group_aggregate import segment_aggregate, segment_ids
+from ..utils.logprobs import (
+    logprobs_at_positions,
+    mean_entropy,
+    vocab_chunked_logprobs,
+)
+from ..utils.segment_mask import SegmentMask
+from ..utils.trainer_channel import TrainerChannel
 
 if TYPE_CHECKING:
     from .service import TrainInputs
 
-nest_asyncio.apply()
-
 
 async def train(
     trainer: "GRPOTrainer",
-    results_queue: asyncio.Queue[dict[str, float]],
+    channel: TrainerChannel["TrainInputs"],
 ) -> None:
+    """
+    Runs the trainer in its own thread, taking inputs from and reporting the
+    results of every optimizer step to `channel`.
+    """
     _compute_loss = trainer.compute_loss
     _log = trainer.log
+    _prepare_inputs = trainer._prepare_inputs
     trainer.compute_loss = get_compute_loss_fn(trainer)
-    trainer.log = get_log_fn(trainer, results_queue)
+    trainer.log = get_log_fn(trainer, channel)
+    trainer._prepare_inputs = lambda *_, **__: channel.get()
     # Ensure we have a metrics container in the expected format
     try:
         is_dict = isinstance(getattr(trainer, "_metrics", None), dict)
@@ -37,10 +50,11 @@ async def train(
     if not is_train_dict:
         trainer._metrics = {"train": defaultdict(list)}
     try:
-        trainer.train()
+        await asyncio.to_thread(trainer.train)
     finally:
         trainer.compute_loss = _compute_loss
         trainer.log = _log
+        trainer._prepare_inputs = _prepare_inputs
 
 
 def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
@@ -53,11 +67,17 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
         config: TrainConfig = inputs.pop("config")  # type: ignore
         _config: dev.TrainConfig = inputs.pop("_config")  # type: ignore
         return_new_logprobs: bool = inputs.pop("return_new_logprobs", False)  # type: ignore
-
-        num_trajectories_learning_rate_multiplier = (
-            torch.unique(inputs["group_ids"]).numel()
-            - torch.unique(inputs["parent_ids"]).numel()
-        ) ** _config.get("num_trajectories_learning_rate_multiplier_power", 0.0)
+        return_ref_logprobs: bool = inputs.pop("return_ref_logprobs", False)  # type: ignore
+        # See `micro_batches`
+        loss_scale = inputs.pop("loss_scale", None)  # type: ignore
+
+        # Completion tokens are the only non-padding tokens with equal ids
+        num_trajectories_learning_rate_multiplier = torch.unique(
+            inputs["group_ids"][
+                (inputs["group_ids"] == inputs["parent_ids"])
+                & (inputs["group_ids"] >= 0)
+            ]
+        ).numel() ** _config.get("num_trajectories_learning_rate_multiplier_power", 0.0)
         if optimizer := trainer.optimizer:
             optimizer = getattr(optimizer, "optimizer", optimizer)
             if param_groups := getattr(optimizer, "param_groups"):
@@ -74,6 +94,7 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
             key: tensor.to(trainer.accelerator.device)  # type: ignore
             for key, tensor in inputs.items()
         }
+        upcast_packed_tensors(inputs)  # type: ignore
 
         accelerate_mixed_precision = os.environ.get("ACCELERATE_MIXED_PRECISION")
         force_float32 = os.environ.get("UNSLOTH_FORCE_FLOAT32")
@@ -104,11 +125,36 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
         )  # Shape [H, V]
         next_input_ids = shift_tensor(inputs["tokens"], 0)
         chunk_size = _config.get("logprob_calculation_chunk_size", 1024)
+        vocab_chunk_size = _config.get("logprob_calculation_vocab_chunk_size", 0)
         # Assert that sequence length is evenly divisible by the chunk size
         assert seq_len % chunk_size == 0, (
             f"Sequence length ({seq_len}) must be evenly divisible by chunk size ({chunk_size})"
         )
+        # Only apply the LM head where the loss is calculated, except when
+        # returning full-length logprobs
+        positions = None
+        if not return_new_logprobs:
+            positions = shift_tensor(inputs["assistant_mask"], False).bool()
+            if not positions.any():
+                # Keep one position so the loss stays connected to the model
+                positions[0, 0] = True
         os.environ["UNSLOTH_RETURN_HIDDEN_STATES"] = "1"
+        if return_ref_logprobs:
+            ref_logprobs, _ = calculate_logprobs(
+                dtype_for_autocasting,
+                trainer,
+                inputs["tokens"],
+                attn_bias,
+                next_input_ids,
+                lm_head_t,
+                chunk_size=chunk_size,
+                vocab_chunk_size=vocab_chunk_size,
+                inference_mode=True,
+                no_grad=True,
+                reference_logprobs=True,
+                positions=positions,
+            )
+            return torch.nn.functional.pad(ref_logprobs[:, :-1], (1, 0), value=0.0)
         new_logprobs, entropies = calculate_logprobs(
             dtype_for_autocasting,
             trainer,
@@ -117,13 +163,18 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
             next_input_ids,
             lm_head_t,
             chunk_size=chunk_size,
+            vocab_chunk_size=vocab_chunk_size,
             inference_mode=return_new_logprobs,
             no_grad=return_new_logprobs,
             reference_logprobs=False,
+            positions=positions,
         )
         if return_new_logprobs:
             return torch.nn.functional.pad(new_logprobs[:, :-1], (1, 0), value=0.0)
-        if config.beta > 0.0:
+        if config.beta > 0.0 and "ref_logprobs" in inputs:
+            # Reference logprobs cached for the batch by `calculate_logprobs_in_place`
+            ref_logprobs = shift_tensor(inputs["ref_logprobs"], 0.0)
+        elif config.beta > 0.0:
             ref_logprobs, _ = calculate_logprobs(
                 dtype_for_autocasting,
                 trainer,
@@ -132,9 +183,11 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
                 next_input_ids,
                 lm_head_t,
                 chunk_size=chunk_size,
+                vocab_chunk_size=vocab_chunk_size,
                 inference_mode=True,
                 no_grad=False,
                 reference_logprobs=True,
+                positions=positions,
             )
         else:
             ref_logprobs = None
@@ -155,11 +208,16 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
         )
         logprob_diff = new_logprobs - old_logprobs
         if _config.get("importance_sampling_level", "token") == "sequence":
+            # Packed trajectories are contiguous runs of group ids, so their
+            # assistant tokens can be averaged without sorting the ids
+            segments, num_segments = segment_ids(shift_tensor(inputs["group_ids"], 0))
             prob_ratio = torch.exp(
-                group_aggregate(
+                segment_aggregate(
                     logprob_diff,
-                    by=shift_tensor(inputs["group_ids"], 0) * assistant_mask,
+                    segment_ids=segments,
+                    num_segments=num_segments,
                     reduce="mean",
+                    mask=assistant_mask,
                 )
             )
         else:
@@ -203,24 +261,67 @@ def get_compute_loss_fn(trainer: "GRPOTrainer") -> Callable[..., torch.Tensor]:
         mean_policy_loss = policy_loss.sum() / (assistant_mask.sum() + 1e-6)
         mean_kl = kl_div.sum() / (assistant_mask.sum() + 1e-6)
 
-        # Compute mean entropy for the current step
-        shifted_entropies = shift_tensor(entropies, 0.0)
-        mean_entropy = (shifted_entropies * weights * assistant_mask).sum() / (
-            assistant_mask.sum() + 1e-6
-        )
-
-        trainer._metrics["train"]["learning_rate"].append(config.learning_rate)
-        trainer._metrics["train"]["policy_loss"].append(mean_policy_loss.item())
-        trainer._metrics["train"]["entropy"].append(mean_entropy.item())  # type: ignore
-        if config.beta > 0.0:
-            trainer._metrics["train"]["kl_div"].append(mean_kl.item())
-        return mean_policy_loss + config.beta * mean_kl
+        # Compute mean entropy for the current step, entropies are already
+        # aligned with the shifted inputs
+        step_entropy = mean_entropy(entropies, weights, assistant_mask)
+
+        # Micro-batches padding out a gradient accumulation step have no
+        # assistant tokens and don't count towards the metrics
+        if assistant_mask.any():
+            trainer._metrics["train"]["learning_rate"].append(config.learning_rate)
+            trainer._metrics["train"]["policy_loss"].append(mean_policy_loss.item())
+            trainer._metrics["train"]["entropy"].append(step_entropy.item())  # type: ignore
+            if config.beta > 0.0:
+                trainer._metrics["train"]["kl_div"].append(mean_kl.item())
+        loss = mean_policy_loss + config.beta * mean_kl
+        return loss * loss_scale if loss_scale is not None else loss
 
     return compute_loss
 
 
+def calculate_logprobs_in_place(
+    trainer: "GRPOTrainer",
+    model: "PeftModel",
+    packed_tensors: PackedTensors,
+    key: Literal["logprobs", "ref_logprobs"],
+    config: TrainConfig,
+    _config: dev.TrainConfig,
+) -> None:
+    """
+    Overwrites `packed_tensors[key]` with the current policy's ("logprobs") or
+    the reference model's ("ref_logprobs") logprobs of every sequence before
+    training on a batch.
+
+    Sequences are processed `precalculation_batch_size` at a time in inference
+    mode and the results are written into the existing (shared) tensor. Policy
+    logprobs are calculated at every position, reference logprobs only at
+    assistant positions and are 0 elsewhere.
+    """
+    batch_size = _config.get("precalculation_batch_size", 1)
+    num_sequences = packed_tensors["tokens"].shape[0]
+    for offset in tqdm.tqdm(
+        range(0, num_sequences, batch_size),
+        desc=key,
+        total=math.ceil(num_sequences / batch_size),
+    ):
+        packed_tensors[key][offset : offset + batch_size] = trainer.compute_loss(
+            model,
+            {
+                **{
+                    name: tensor[offset : offset + batch_size]
+                    for name, tensor in packed_tensors.items()
+                    if isinstance(tensor, torch.Tensor) and name != "ref_logprobs"
+                },
+                "config": config,
+                "_config": _config,
+                "return_new_logprobs": key == "logprobs",
+                "return_ref_logprobs": key == "ref_logprobs",
+            },  # type: ignore
+        ).to("cpu")
+
+
 def get_log_fn(
-    trainer: "GRPOTrainer", results_queue: asyncio.Queue[dict[str, float]]
+    trainer: "GRPOTrainer", channel: TrainerChannel["TrainInputs"]
 ) -> Callable[..., None]:
     def log(logs: dict[str, float], start_time: float | None = None) -> None:
         metrics = {
@@ -234,7 +335,7 @@ def get_log_fn(
 
         logs = {**logs, **metrics}
         logs.pop("learning_rate", None)
-        results_queue.put_nowait(logs)
+        channel.put_result(logs)
         trainer._metrics["train"].clear()
 
     return log
@@ -248,23 +349,9 @@ def calculate_attn_bias(
     parent_ids: torch.Tensor,
     dtype: torch.dtype,
 ) -> torch.Tensor:
-    mask = calculate_mask(batch_size, seq_len, device, group_ids, parent_ids)
+    assert group_ids.shape == (batch_size, seq_len)
     # Use the same dtype as autocast to save memory and avoid dtype conversions
-    attn_bias = torch.where(
-        mask,
-        torch.tensor(
-            0.0,
-            dtype=dtype,
-            device=device,
-        ),
-        torch.tensor(
-            float("-inf"),
-            dtype=dtype,
-            device=device,
-        ),
-    )
-    del mask
-    return attn_bias
+    return SegmentMask.from_ids(group_ids, parent_ids).to_attn_bias(dtype)
 
 
 def calculate_mask(
@@ -274,22 +361,8 @@ def calculate_mask(
     group_ids: torch.Tensor,
     parent_ids: torch.Tensor,
 ) -> torch.Tensor:
-    causal_mask = (
-        torch.tril(
-            torch.ones(
-                seq_len,
-                seq_len,
-                dtype=torch.bool,
-                device=device,
-            )
-        )
-        .unsqueeze(0)
-        .expand(batch_size, seq_len, seq_len)
-    )
-    group_mask = group_ids.unsqueeze(2) == group_ids.unsqueeze(1)
-    parent_mask = parent_ids.unsqueeze(2) == group_ids.unsqueeze(1)
-    mask = causal_mask & (group_mask | parent_mask)
-    return mask
+    assert group_ids.shape == (batch_size, seq_len)
+    return SegmentMask.from_ids(group_ids, parent_ids).mask()
 
 
 def calculate_logprobs(
@@ -303,9 +376,15 @@ def calculate_logprobs(
     inference_mode: bool,
     no_grad: bool,
     reference_logprobs: bool,
+    vocab_chunk_size: int = 0,
+    positions: torch.Tensor | None = None,
 ) -> tuple[
     torch.Tensor, torch.Tensor
 ]:  # Returns (log_probs, entropy) both shape [B, S]
+    """
+    If `positions` ([B, S] bool) is given, logprobs and entropies are only
+    calculated at those positions and are 0 elsewhere.
+    """
     with (
         torch.inference_mode() if inference_mode else nullcontext(),
         torch.no_grad() if no_grad else nullcontext(),
@@ -321,7 +400,14 @@ def calculate_logprobs(
         hidden_states = trainer.model(  # type: ignore
             input_ids=input_ids, causal_mask=causal_mask
         ).logits  # Shape [B, S, H]
-    return _calculate_logprobs(lm_head_t, hidden_states, next_input_ids, chunk_size)
+    return logprobs_at_positions(
+        lambda hidden_states, next_input_ids: _calculate_logprobs(
+            lm_head_t, hidden_states, next_input_ids, chunk_size, vocab_chunk_size
+        ),
+        hidden_states,
+        next_input_ids,
+        positions,
+    )
 
 
 def _calculate_logprobs(
@@ -329,9 +415,14 @@ def _calculate_logprobs(
     hidden_states: torch.Tensor,  # Shape [B, S, H]
     next_input_ids: torch.Tensor,  # Shape [B, S]
     chunk_size: int,
+    vocab_chunk_size: int = 0,
 ) -> tuple[
     torch.Tensor, torch.Tensor
 ]:  # Returns (log_probs, entropy) both shape [B, S]
+    if vocab_chunk_size > 0:
+        return vocab_chunked_logprobs(
+            lm_head_t, hidden_states, next_input_ids, chunk_size, vocab_chunk_size
+        )
     batch_size, seq_len, _ = hidden_states.shape
     # Output shape is [B, S]
     log_probs = torch.empty(
@@ -384,3 +475,45 @@ def shift_tensor(tensor: torch.Tensor, pad: int | float | bool) -> torch.Tensor:
 
 def gc_and_empty_cuda_cache(n: int = 3) -> None:
     [gc.collect() >= 0 and torch.cuda.empty_cache() for _ in range(n)]
+
+
+def use_compile_cache(output_dir: str) -> None:
+    """
+    Keeps torch.compile, Triton and Unsloth compilation artifacts in a cache
+    under `output_dir`, so that restarted services reuse compiled and autotuned
+    kernels. Must be called before Unsloth is imported. Cache locations set in
+    the environment take precedence.
+    """
+    cache_dir = f"{output_dir}/compile_cache"
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", f"{cache_dir}/inductor")
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    os.environ.setdefault("TRITON_CACHE_DIR", f"{cache_dir}/triton")
+    os.environ.setdefault("UNSLOTH_COMPILE_LOCATION", f"{cache_dir}/unsloth")
+
+
+def needs_warmup(output_dir: str, warmup: Literal["auto", "always", "never"]) -> bool:
+    """
+    Returns whether a service should run a warmup step before training, i.e.
+    always or never, or with "auto" if no previous service warmed up the
+    compile cache under `output_dir` with the same PyTorch version and GPU.
+    """
+    if warmup != "auto":
+        return warmup == "always"
+    try:
+        with open(f"{output_dir}/compile_cache/warm") as f:
+            return f.read() != _warm_state()
+    except FileNotFoundError:
+        return True
+
+
+def mark_warm(output_dir: str) -> None:
+    """Records that the compile cache under `output_dir` has been warmed up."""
+    os.makedirs(f"{output_dir}/compile_cache", exist_ok=True)
+    with open(f"{output_dir}/compile_cache/warm", "w") as f:
+        f.write(_warm_state())
+
+
+def _warm_state() -> str:
+    device_name = torch.cuda.get_device_name() if torch.cuda.is_available() else "cpu"
+    return f"torch {torch.__version__} on {device_name}"
@@ -144,3 +144,92 @@ def group_aggregate(
 
     # Return compact form: [B, num_groups, *F]
     return agg.reshape(B, num_groups, *feat_dims)
+
+
+def segment_ids(ids: torch.Tensor) -> tuple[torch.Tensor, int]:
+    """Dense ids of the runs of equal consecutive ids in each row.
+
+    Parameters
+    ----------
+    ids: Tensor of shape ``[B, S]``, e.g. packed ``group_ids``, where every
+        group is a single contiguous run within its row.
+
+    Returns
+    -------
+    Tuple of the ``[B, S]`` run ids, numbered ``0..N-1`` across the batch in
+    order, and the number of runs ``N``. Unlike ``torch.unique``, this needs
+    no sort, so it can be computed once and reused by `segment_aggregate`.
+    """
+    starts = torch.ones_like(ids, dtype=torch.bool)
+    starts[:, 1:] = ids[:, 1:] != ids[:, :-1]
+    dense_ids = starts.view(-1).cumsum(0).view_as(ids) - 1
+    return dense_ids, int(dense_ids[-1, -1].item()) + 1
+
+
+def segment_aggregate(
+    values: torch.Tensor,
+    *,
+    segment_ids: torch.Tensor,
+    num_segments: int,
+    reduce: Literal["sum", "mean", "count"] = "mean",
+    mask: torch.Tensor | None = None,
+    eps: float = 1e-8,
+    broadcast: bool = True,
+) -> torch.Tensor:
+    """Group-wise reduction over precomputed dense segment ids.
+
+    Fast path of `group_aggregate` for groups given by `segment_ids`: it
+    reduces into a ``[num_segments, P]`` buffer with ``index_add_`` instead of
+    mapping ids with ``torch.unique`` and scattering into a
+    ``[B, num_groups, P]`` buffer.
+
+    Parameters
+    ----------
+    values: Tensor of shape ``[B, S, *F]``.
+    segment_ids: ``[B, S]`` ids in ``0..num_segments-1``, e.g. from
+        `segment_ids`. Ids are global across the batch.
+    num_segments: Number of segments.
+    reduce: Which reduction to apply: "sum", "mean", "count".
+    mask: Optional ``[B, S]`` mask of the tokens to reduce over. Tokens outside
+        the mask still receive the statistic of their segment when
+        broadcasting.
+    eps: Numerical stability term used for mean.
+    broadcast: If True (default) the statistic is gathered back to the token
+        dimension, otherwise the ``[num_segments, *F]`` statistics are returned.
+
+    Examples
+    --------
+    >>> # Mean logprob difference of every packed trajectory's assistant tokens
+    >>> ids, n = segment_ids(group_ids)
+    >>> ratio = segment_aggregate(diff, segment_ids=ids, num_segments=n, mask=mask)
+    """
+    if segment_ids.shape != values.shape[:2]:
+        raise ValueError(
+            "`segment_ids` must match the first two dimensions of `values` (B, S)."
+        )
+    B, S, *feat_dims = values.shape
+    values_flat = values.reshape(B * S, -1)  # [B * S, P]
+    flat_ids = segment_ids.reshape(-1)
+    weights = None if mask is None else mask.reshape(B * S, 1).to(values.dtype)
+    if reduce == "count":
+        ones = torch.ones(B * S, 1, device=values.device, dtype=values.dtype)
+        agg = values_flat.new_zeros(num_segments, 1).index_add_(
+            0, flat_ids, ones if weights is None else weights
+        )
+        agg = agg.expand(-1, values_flat.shape[1])
+    else:
+        agg = values_flat.new_zeros(num_segments, values_flat.shape[1]).index_add_(
+            0, flat_ids, values_flat if weights is None else values_flat * weights
+        )
+        if reduce == "mean":
+            count = values_flat.new_zeros(num_segments, 1).index_add_(
+                0,
+                flat_ids,
+                torch.ones_like(values_flat[:, :1]) if weights is None else weights,
+            )
+            agg = agg / (count + eps)
+        elif reduce != "sum":
+            raise ValueError(f"Unsupported reduce type: {reduce}")
+    if broadcast:
+        return agg[flat_ids].reshape(values.shape)
+    return agg.reshape(num_segments, *feat_dims)
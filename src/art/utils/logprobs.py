@@ -0,0 +1,212 @@
+from typing import Callable
+
+import torch
+
+
+def logprobs_at_positions(
+    calculate_logprobs: Callable[
+        [torch.Tensor, torch.Tensor], tuple[torch.Tensor, torch.Tensor]
+    ],
+    hidden_states: torch.Tensor,  # Shape [B, S, H]
+    next_input_ids: torch.Tensor,  # Shape [B, S]
+    positions: torch.Tensor | None = None,  # Shape [B, S] bool
+) -> tuple[
+    torch.Tensor, torch.Tensor
+]:  # Returns (log_probs, entropy) both shape [B, S]
+    """
+    Calls `calculate_logprobs(hidden_states, next_input_ids)` on only the
+    selected `positions`, packed into a single row. The log probabilities and
+    entropies are 0 at every other position. Selects every position if
+    `positions` is `None`.
+    """
+    if positions is None:
+        return calculate_logprobs(hidden_states, next_input_ids)
+    selected_log_probs, selected_entropy = calculate_logprobs(
+        hidden_states[positions].unsqueeze(0),
+        next_input_ids[positions].unsqueeze(0),
+    )
+    log_probs = selected_log_probs.new_zeros(positions.shape)
+    entropy = selected_entropy.new_zeros(positions.shape)
+    log_probs[positions] = selected_log_probs[0]
+    entropy[positions] = selected_entropy[0]
+    return log_probs, entropy
+
+
+def mean_entropy(
+    entropy: torch.Tensor,  # Shape [B, S]
+    weights: torch.Tensor,  # Shape [B, S]
+    assistant_mask: torch.Tensor,  # Shape [B, S]
+) -> torch.Tensor:
+    """
+    Returns the weighted entropy averaged over assistant tokens. Like the log
+    probabilities, `entropy`, `weights` and `assistant_mask` are aligned with
+    the next input ids, i.e. the latter two are already shifted.
+    """
+    return (entropy * weights * assistant_mask).sum() / (assistant_mask.sum() + 1e-6)
+
+
+def vocab_chunked_logprobs(
+    lm_head_t: torch.Tensor,  # Shape [H, V]
+    hidden_states: torch.Tensor,  # Shape [B, S, H]
+    next_input_ids: torch.Tensor,  # Shape [B, S]
+    chunk_size: int,
+    vocab_chunk_size: int,
+) -> tuple[
+    torch.Tensor, torch.Tensor
+]:  # Returns (log_probs, entropy) both shape [B, S]
+    """
+    Computes the log probabilities of `next_input_ids` and the entropy of the
+    next token distribution without materializing the logits.
+
+    Logits are computed for `chunk_size` positions and `vocab_chunk_size`
+    tokens of the vocabulary at a time, and reduced with an online logsumexp.
+    The backward pass recomputes each tile, so with or without gradients only
+    `[B, chunk_size, vocab_chunk_size]` logits are held in memory at once.
+    Reductions are done in at least float32; results have the dtype of
+    `hidden_states`.
+    """
+    return _VocabChunkedLogprobs.apply(  # type: ignore
+        hidden_states,
+        lm_head_t.to(hidden_states.dtype),
+        next_input_ids,
+        chunk_size,
+        vocab_chunk_size,
+    )
+
+
+class _VocabChunkedLogprobs(torch.autograd.Function):
+    @staticmethod
+    def forward(
+        ctx: torch.autograd.function.FunctionCtx,
+        hidden_states: torch.Tensor,
+        lm_head_t: torch.Tensor,
+        next_input_ids: torch.Tensor,
+        chunk_size: int,
+        vocab_chunk_size: int,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        batch_size, seq_len, _ = hidden_states.shape
+        vocab_size = lm_head_t.shape[1]
+        shape, device = (batch_size, seq_len), hidden_states.device
+        dtype = torch.promote_types(hidden_states.dtype, torch.float32)
+        log_probs = torch.empty(shape, dtype=dtype, device=device)
+        entropy = torch.empty(shape, dtype=dtype, device=device)
+        logsumexp = torch.empty(shape, dtype=dtype, device=device)
+        for i in range(0, seq_len, chunk_size):
+            chunk_hs = hidden_states[:, i : i + chunk_size]
+            chunk_input_ids = next_input_ids[:, i : i + chunk_size]
+            # Running max, sum of exp(logits - max) and of exp(logits - max) * (logits - max)
+            chunk_max = torch.full(
+                chunk_input_ids.shape, float("-inf"), dtype=dtype, device=device
+            )
+            chunk_sum = torch.zeros_like(chunk_max)
+            chunk_weighted_sum = torch.zeros_like(chunk_max)
+            chunk_selected_logits = torch.zeros_like(chunk_max)
+            for j in range(0, vocab_size, vocab_chunk_size):
+                logits = torch.matmul(
+                    chunk_hs, lm_head_t[:, j : j + vocab_chunk_size]
+                ).to(dtype)  # [B, chunk_size, vocab_chunk_size]
+                new_max = torch.maximum(chunk_max, logits.amax(-1))
+                scale = torch.exp(chunk_max - new_max)
+                shifted_logits = logits - new_max.unsqueeze(-1)
+                exp_logits = torch.exp(shifted_logits)
+                # Rebase the previous sum from the old max onto the new one
+                chunk_weighted_sum = scale * (
+                    chunk_weighted_sum
+                    + torch.where(chunk_sum > 0, (chunk_max - new_max) * chunk_sum, 0.0)
+                ) + (exp_logits * shifted_logits).sum(-1)
+                chunk_sum = chunk_sum * scale + exp_logits.sum(-1)
+                chunk_max = new_max
+                selected, in_tile = _select(logits, chunk_input_ids, j)
+                chunk_selected_logits = torch.where(
+                    in_tile, selected, chunk_selected_logits
+                )
+                del logits, shifted_logits, exp_logits
+            chunk_logsumexp = chunk_max + torch.log(chunk_sum)
+            log_probs[:, i : i + chunk_size] = chunk_selected_logits - chunk_logsumexp
+            # H = -sum(p * log(p)) = log(sum) - sum(exp(logits - max) * (logits - max)) / sum
+            entropy[:, i : i + chunk_size] = (
+                torch.log(chunk_sum) - chunk_weighted_sum / chunk_sum
+            )
+            logsumexp[:, i : i + chunk_size] = chunk_logsumexp
+        ctx.save_for_backward(
+            hidden_states, lm_head_t, next_input_ids, logsumexp, entropy
+        )
+        ctx.chunk_size = chunk_size  # type: ignore
+        ctx.vocab_chunk_size = vocab_chunk_size  # type: ignore
+        return log_probs.to(hidden_states.dtype), entropy.to(hidden_states.dtype)
+
+    @staticmethod
+    def backward(  # type: ignore
+        ctx: torch.autograd.function.FunctionCtx,
+        grad_log_probs: torch.Tensor | None,
+        grad_entropy: torch.Tensor | None,
+    ) -> tuple[torch.Tensor | None, torch.Tensor | None, None, None, None]:
+        hidden_states, lm_head_t, next_input_ids, logsumexp, entropy = ctx.saved_tensors  # type: ignore
+        chunk_size: int = ctx.chunk_size  # type: ignore
+        vocab_chunk_size: int = ctx.vocab_chunk_size  # type: ignore
+        needs_hs_grad, needs_lm_head_grad = ctx.needs_input_grad[:2]  # type: ignore
+        grad_log_probs = (
+            torch.zeros_like(logsumexp)
+            if grad_log_probs is None
+            else grad_log_probs.to(logsumexp.dtype)
+        )
+        grad_entropy = (
+            torch.zeros_like(logsumexp)
+            if grad_entropy is None
+            else grad_entropy.to(logsumexp.dtype)
+        )
+        grad_hs = torch.zeros_like(hidden_states) if needs_hs_grad else None
+        grad_lm_head_t = torch.zeros_like(lm_head_t) if needs_lm_head_grad else None
+        seq_len, vocab_size = hidden_states.shape[1], lm_head_t.shape[1]
+        for i in range(0, seq_len, chunk_size):
+            chunk = slice(i, i + chunk_size)
+            chunk_hs = hidden_states[:, chunk]
+            chunk_input_ids = next_input_ids[:, chunk]
+            chunk_logsumexp = logsumexp[:, chunk].unsqueeze(-1)
+            chunk_entropy = entropy[:, chunk].unsqueeze(-1)
+            chunk_grad_log_probs = grad_log_probs[:, chunk]
+            chunk_grad_entropy = grad_entropy[:, chunk].unsqueeze(-1)
+            for j in range(0, vocab_size, vocab_chunk_size):
+                tile_lm_head_t = lm_head_t[:, j : j + vocab_chunk_size]
+                log_p = (
+                    torch.matmul(chunk_hs, tile_lm_head_t).to(logsumexp.dtype)
+                    - chunk_logsumexp
+                )
+                p = torch.exp(log_p)
+                # d log_p[y] / d logits = onehot(y) - p
+                # d H / d logits = -p * (log_p + H)
+                grad_logits = -p * (
+                    chunk_grad_log_probs.unsqueeze(-1)
+                    + chunk_grad_entropy * (log_p + chunk_entropy)
+                )
+                index = chunk_input_ids - j
+                in_tile = (index >= 0) & (index < log_p.shape[-1])
+                grad_logits.scatter_add_(
+                    -1,
+                    index.clamp(0, log_p.shape[-1] - 1).unsqueeze(-1),
+                    torch.where(in_tile, chunk_grad_log_probs, 0.0).unsqueeze(-1),
+                )
+                grad_logits = grad_logits.to(hidden_states.dtype)
+                if grad_hs is not None:
+                    grad_hs[:, chunk] += torch.matmul(grad_logits, tile_lm_head_t.t())
+                if grad_lm_head_t is not None:
+                    grad_lm_head_t[:, j : j + vocab_chunk_size] += torch.matmul(
+                        chunk_hs.flatten(0, 1).t(), grad_logits.flatten(0, 1)
+                    )
+                del log_p, p, grad_logits
+        return grad_hs, grad_lm_head_t, None, None, None
+
+
+def _select(
+    logits: torch.Tensor, input_ids: torch.Tensor, vocab_start: int
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the logits of `input_ids` in a vocabulary tile starting at
+    `vocab_start` and whether each id falls into the tile.
+    """
+    index = input_ids - vocab_start
+    in_tile = (index >= 0) & (index < logits.shape[-1])
+    selected = torch.gather(
+        logits, dim=-1, index=index.clamp(0, logits.shape[-1] - 1).unsqueeze(-1)
+    ).squeeze(-1)
+    return selected, in_tile
@@ -0,0 +1,165 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import torch
+
+if TYPE_CHECKING:
+    from torch.nn.attention.flex_attention import BlockMask
+
+EMPTY = 0
+PARTIAL = 1
+FULL = 2
+
+
+@dataclass
+class SegmentMask:
+    """
+    Compact attention mask of packed sequences.
+
+    A query may attend to an earlier or equal key if
+    `group_ids[kv] <= group_ids[q] <= parent_ids[kv]` (see `PackedTensors`).
+    Instead of a dense `[B, S, S]` mask, this keeps the `[B, S]` ids and the
+    state of every `block_size` x `block_size` tile of the mask: `EMPTY` if
+    no query in the tile may attend to any key, `FULL` if every query may
+    attend to every key and `PARTIAL` otherwise. Tile states are derived from
+    per-block id bounds, so some `PARTIAL` tiles may turn out to be empty or
+    full, but `EMPTY` and `FULL` tiles are exact.
+    """
+
+    # Ids padded with -1 to whole blocks, padded tokens only attend to padding
+    group_ids: torch.Tensor  # [B, S + padding]
+    parent_ids: torch.Tensor  # [B, S + padding]
+    seq_len: int
+    block_size: int
+    block_states: torch.Tensor  # [B, S / block_size, S / block_size], int8
+
+    @classmethod
+    def from_ids(
+        cls, group_ids: torch.Tensor, parent_ids: torch.Tensor, block_size: int = 128
+    ) -> "SegmentMask":
+        batch_size, seq_len = group_ids.shape
+        pad = -seq_len % block_size
+        group_ids = torch.nn.functional.pad(group_ids, (0, pad), value=-1)
+        parent_ids = torch.nn.functional.pad(parent_ids, (0, pad), value=-1)
+        blocks = (seq_len + pad) // block_size
+        group_blocks = group_ids.view(batch_size, blocks, block_size)
+        parent_blocks = parent_ids.view(batch_size, blocks, block_size)
+        # Query bounds along dim 1, key bounds along dim 2
+        q_min = group_blocks.amin(-1).unsqueeze(2)
+        q_max = group_blocks.amax(-1).unsqueeze(2)
+        kv_group_min = group_blocks.amin(-1).unsqueeze(1)
+        kv_group_max = group_blocks.amax(-1).unsqueeze(1)
+        kv_parent_min = parent_blocks.amin(-1).unsqueeze(1)
+        kv_parent_max = parent_blocks.amax(-1).unsqueeze(1)
+        block_index = torch.arange(blocks, device=group_ids.device)
+        block_states = torch.full(
+            (batch_size, blocks, blocks),
+            PARTIAL,
+            dtype=torch.int8,
+            device=group_ids.device,
+        )
+        full = (
+            (block_index.unsqueeze(0) < block_index.unsqueeze(1))
+            & (kv_group_max <= q_min)
+            & (q_max <= kv_parent_min)
+        )
+        empty = (
+            (block_index.unsqueeze(0) > block_index.unsqueeze(1))
+            | (kv_group_min > q_max)
+            | (kv_parent_max < q_min)
+        )
+        block_states[full] = FULL
+        block_states[empty] = EMPTY
+        return cls(group_ids, parent_ids, seq_len, block_size, block_states)
+
+    def mask(
+        self,
+        q_start: int = 0,
+        q_end: int | None = None,
+        kv_start: int = 0,
+        kv_end: int | None = None,
+    ) -> torch.Tensor:
+        """Returns the dense `[B, Q, K]` mask of a range of queries and keys."""
+        q_end = self.seq_len if q_end is None else q_end
+        kv_end = self.seq_len if kv_end is None else kv_end
+        device = self.group_ids.device
+        q_group_ids = self.group_ids[:, q_start:q_end].unsqueeze(2)
+        kv_group_ids = self.group_ids[:, kv_start:kv_end].unsqueeze(1)
+        kv_parent_ids = self.parent_ids[:, kv_start:kv_end].unsqueeze(1)
+        causal_mask = torch.arange(q_start, q_end, device=device).unsqueeze(
+            1
+        ) >= torch.arange(kv_start, kv_end, device=device)
+        return (
+            causal_mask & (kv_group_ids <= q_group_ids) & (q_group_ids <= kv_parent_ids)
+        )
+
+    def to_attn_bias(self, dtype: torch.dtype) -> torch.Tensor:
+        """
+        Returns a dense additive `[B, S, S]` attention bias of 0 and -inf for
+        attention implementations that need one, e.g. SDPA.
+
+        The bias is filled one block of query rows at a time and only tiles
+        that are not `EMPTY` are computed, so no `[B, S, S]` boolean mask is
+        materialized on the way.
+        """
+        seq_len = self.seq_len
+        batch_size = self.group_ids.shape[0]
+        attn_bias = torch.full(
+            (batch_size, seq_len, seq_len),
+            float("-inf"),
+            dtype=dtype,
+            device=self.group_ids.device,
+        )
+        # Key blocks that are not empty for any row of each query block
+        visible = (self.block_states != EMPTY).any(0).cpu()
+        for q_block in range(visible.shape[0]):
+            kv_blocks = visible[q_block].nonzero()
+            if not len(kv_blocks):
+                continue
+            q_start = q_block * self.block_size
+            q_end = min(q_start + self.block_size, seq_len)
+            kv_start = int(kv_blocks[0]) * self.block_size
+            kv_end = min((int(kv_blocks[-1]) + 1) * self.block_size, seq_len)
+            attn_bias[:, q_start:q_end, kv_start:kv_end].masked_fill_(
+                self.mask(q_start, q_end, kv_start, kv_end), 0.0
+            )
+        return attn_bias
+
+    def to_block_mask(self) -> "BlockMask":
+        """
+        Returns a FlexAttention `BlockMask` built directly from the tile states,
+        without evaluating the mask for every query and key.
+        """
+        from torch.nn.attention.flex_attention import BlockMask
+
+        group_ids, parent_ids = self.group_ids, self.parent_ids
+
+        def mask_mod(b, h, q_idx, kv_idx):  # type: ignore
+            return (
+                (kv_idx <= q_idx)
+                & (group_ids[b, kv_idx] <= group_ids[b, q_idx])
+                & (group_ids[b, q_idx] <= parent_ids[b, kv_idx])
+            )
+
+        def kv_blocks(state: int) -> tuple[torch.Tensor, torch.Tensor]:
+            selected = self.block_states == state
+            # Stable sort moves the selected blocks first, in increasing order
+            indices = torch.argsort((~selected).to(torch.int8), dim=-1, stable=True).to(
+                torch.int32
+            )
+            return (
+                selected.sum(-1).to(torch.int32).unsqueeze(1),
+                indices.unsqueeze(1),
+            )
+
+        kv_num_blocks, kv_indices = kv_blocks(PARTIAL)
+        full_kv_num_blocks, full_kv_indices = kv_blocks(FULL)
+        return BlockMask.from_kv_blocks(
+            kv_num_blocks,
+            kv_indices,
+            full_kv_num_blocks,
+            full_kv_indices,
+            BLOCK_SIZE=self.block_size,
+            mask_mod=mask_mod,
+            seq_lengths=(self.seq_len, self.seq_len),
+        )
@@ -0,0 +1,139 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Generic, Mapping, TypeVar, cast
+
+import torch
+
+InputsT = TypeVar("InputsT", bound=Mapping[str, Any])
+
+
+class TrainerChannelClosed(Exception):
+    """Raised in the trainer thread when it asks a closed channel for inputs."""
+
+
+_CLOSED = object()
+
+
+class TrainerChannel(Generic[InputsT]):
+    """
+    Hands training inputs from an async service to a trainer that runs in its
+    own thread, and training results back.
+
+    The service awaits `put` for each micro-batch, which waits while `maxsize`
+    inputs are already queued, and `get_result` for each optimizer step. The
+    trainer thread blocks on `get` and reports results with `put_result`.
+    Before using the model outside of the trainer, the service awaits
+    `wait_idle`.
+
+    If a `device` is given, the next queued inputs are moved to it in a
+    background thread while the trainer runs the current step. CUDA copies are
+    made from pinned memory on a side stream, so they overlap with compute.
+    """
+
+    def __init__(self, maxsize: int = 8, device: torch.device | None = None) -> None:
+        self.results: asyncio.Queue[dict[str, float]] = asyncio.Queue()
+        self._inputs: queue.Queue[Any] = queue.Queue(maxsize)
+        self._device = device
+        self._stream: torch.cuda.Stream | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._prefetcher = ThreadPoolExecutor(1, thread_name_prefix="trainer-prefetch")
+        self._prefetched: Future[InputsT] | None = None
+        # Set while the trainer thread waits for inputs in `get`
+        self._idle = threading.Event()
+
+    async def put(self, inputs: InputsT) -> None:
+        """Queues inputs for the trainer, waiting while the channel is full."""
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._inputs.put_nowait(inputs)
+        except queue.Full:
+            await asyncio.to_thread(self._inputs.put, inputs)
+
+    async def get_result(self, trainer_task: asyncio.Future[Any]) -> dict[str, float]:
+        """
+        Waits for the result of the next optimizer step, or re-raises the
+        exception of `trainer_task` if the trainer stops first.
+        """
+        get_task = asyncio.create_task(self.results.get())
+        await asyncio.wait(
+            [get_task, trainer_task], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not get_task.done():
+            get_task.cancel()
+            trainer_task.result()
+            raise RuntimeError("The training task should never finish.")
+        self.results.task_done()
+        return get_task.result()
+
+    async def wait_idle(self, trainer_task: asyncio.Future[Any]) -> None:
+        """
+        Waits until the trainer thread has finished the last queued inputs and
+        waits for more, or re-raises the exception of `trainer_task` if the
+        trainer stops first.
+
+        Results are reported while the trainer is still finishing an optimizer
+        step, so await this before running forward passes on the model from
+        another thread.
+        """
+        while not await asyncio.to_thread(self._idle.wait, 0.1):
+            if trainer_task.done():
+                trainer_task.result()
+                raise RuntimeError("The training task should never finish.")
+
+    def close(self) -> None:
+        """Makes `get` raise `TrainerChannelClosed` once the queued inputs are consumed."""
+        self._inputs.put(_CLOSED)
+
+    def get(self) -> InputsT:
+        """Returns the next inputs in the trainer thread, blocking until there are some."""
+        if self._prefetched is None:
+            self._prefetched = self._prefetcher.submit(self._next)
+        prefetched, self._prefetched = self._prefetched, None
+        self._idle.set()
+        try:
+            inputs = prefetched.result()
+        finally:
+            self._idle.clear()
+        # Start preparing the next inputs while these are trained on
+        self._prefetched = self._prefetcher.submit(self._next)
+        return inputs
+
+    def put_result(self, result: dict[str, float]) -> None:
+        """Reports the result of an optimizer step from the trainer thread."""
+        assert self._loop is not None, "Results must follow inputs"
+        self._loop.call_soon_threadsafe(self.results.put_nowait, result)
+
+    def _next(self) -> InputsT:
+        inputs = self._inputs.get()
+        if inputs is _CLOSED:
+            raise TrainerChannelClosed()
+        if self._device is None:
+            return inputs
+        return self._to_device(inputs, self._device)
+
+    def _to_device(self, inputs: InputsT, device: torch.device) -> InputsT:
+        if device.type != "cuda":
+            return cast(
+                InputsT,
+                {
+                    key: value.to(device) if isinstance(value, torch.Tensor) else value
+                    for key, value in inputs.items()
+                },
+            )
+        if self._stream is None:
+            self._stream = torch.cuda.Stream(device)
+        compute_stream = torch.cuda.default_stream(device)
+        moved = {}
+        with torch.cuda.stream(self._stream):
+            for key, value in inputs.items():
+                if isinstance(value, torch.Tensor) and value.device != device:
+                    if value.device.type == "cpu":
+                        value = value.pin_memory()
+                    value = value.to(device, non_blocking=True)
+                    # Don't reuse the memory before the training step is done with it
+                    value.record_stream(compute_stream)
+                moved[key] = value
+        self._stream.synchronize()
+        return cast(InputsT, moved)
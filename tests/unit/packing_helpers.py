@@ -0,0 +1,197 @@
+"""
+Helpers for testing and benchmarking packing: random tokenized results and the
+list-based reference packer.
+"""
+
+import random
+
+import torch
+
+from art.preprocessing.pack import PackedTensors, _prompt_intervals
+from art.preprocessing.tokenize import (
+    CompactTokenizedResult,
+    TokenizedResult,
+    assign_prompts,
+)
+
+
+def reference_packed_tensors(
+    tokenized_results: list[TokenizedResult],
+    seq_len: int,
+    pad_token_id: int = -100,
+    truncate_long_results: bool = True,
+    advantage_balance: float = 0.0,
+) -> PackedTensors:
+    """The list-based packer that the vectorized implementation replaced."""
+    token_ids: list[list[int]] = [[]]
+    group_ids: list[list[int]] = [[]]
+    parent_ids: list[list[int]] = [[]]
+    input_pos: list[list[int]] = [[]]
+    assistant_mask: list[list[int]] = [[]]
+    logprobs: list[list[float]] = [[]]
+    advantages: list[list[float]] = [[]]
+    weights: list[list[float]] = [[]]
+
+    prompt_intervals, result_ids = _prompt_intervals(tokenized_results)
+    # Prompts already packed into each sequence
+    prompt_ids: list[set[int]] = [set()]
+
+    for result, result_id in zip(tokenized_results, result_ids):
+        if len(result.token_ids) > seq_len and not truncate_long_results:
+            continue
+        if not any(result.assistant_mask[result.prompt_length :]):
+            continue
+        prompts = result.prompts()
+        # Skip the prompts already packed into the current sequence
+        offset = 0
+        for prompt_id, prompt_length in prompts:
+            if prompt_id not in prompt_ids[-1]:
+                break
+            offset = prompt_length
+        if len(token_ids[-1]) + len(result.token_ids) - offset > seq_len:
+            token_ids.append([])
+            group_ids.append([])
+            parent_ids.append([])
+            input_pos.append([])
+            assistant_mask.append([])
+            logprobs.append([])
+            advantages.append([])
+            weights.append([])
+            prompt_ids.append(set())
+            offset = 0
+        # Each prompt's tokens get the ids of its interval, see `PackedTensors`
+        start = offset
+        for prompt_id, prompt_length in prompts:
+            if prompt_length <= offset:
+                continue
+            first_id, last_id = prompt_intervals[prompt_id]
+            group_ids[-1].extend([first_id] * (prompt_length - start))
+            parent_ids[-1].extend([last_id] * (prompt_length - start))
+            prompt_ids[-1].add(prompt_id)
+            start = prompt_length
+        group_ids[-1].extend([result_id] * (len(result.token_ids) - start))
+        parent_ids[-1].extend([result_id] * (len(result.token_ids) - start))
+        if offset:
+            result = result.without_prompt(offset)
+        token_ids[-1].extend(result.token_ids)
+        input_pos[-1].extend(result.input_pos)
+        assistant_mask[-1].extend(result.assistant_mask)
+        logprobs[-1].extend(result.logprobs)
+        advantages[-1].extend([result.advantage] * len(result.token_ids))
+        weights[-1].extend([result.weight] * len(result.token_ids))
+        if truncate_long_results:
+            token_ids[-1] = token_ids[-1][:seq_len]
+            group_ids[-1] = group_ids[-1][:seq_len]
+            parent_ids[-1] = parent_ids[-1][:seq_len]
+            input_pos[-1] = input_pos[-1][:seq_len]
+            assistant_mask[-1] = assistant_mask[-1][:seq_len]
+            logprobs[-1] = logprobs[-1][:seq_len]
+            advantages[-1] = advantages[-1][:seq_len]
+            weights[-1] = weights[-1][:seq_len]
+
+    permutation = list(range(len(token_ids)))
+    random.shuffle(permutation)
+    token_ids = [token_ids[i] for i in permutation]
+    group_ids = [group_ids[i] for i in permutation]
+    parent_ids = [parent_ids[i] for i in permutation]
+    input_pos = [input_pos[i] for i in permutation]
+    assistant_mask = [assistant_mask[i] for i in permutation]
+    logprobs = [logprobs[i] for i in permutation]
+    advantages = [advantages[i] for i in permutation]
+    weights = [weights[i] for i in permutation]
+
+    def pad(values: list[list], pad_value) -> list[list]:
+        max_len = seq_len
+        for value in values:
+            value.extend([pad_value] * (max_len - len(value)))
+        return values
+
+    assistant_mask_tensor = torch.tensor(pad(assistant_mask, 0), dtype=torch.bool)
+    weights_tensor = torch.tensor(pad(weights, 0.0))
+    weights_tensor = torch.where(
+        assistant_mask_tensor, weights_tensor, torch.zeros_like(weights_tensor)
+    )
+    weights_tensor[assistant_mask_tensor] /= weights_tensor[
+        assistant_mask_tensor
+    ].mean()
+    advantages_tensor = torch.tensor(pad(advantages, 0.0))
+    advantages_tensor = torch.where(
+        assistant_mask_tensor, advantages_tensor, torch.zeros_like(advantages_tensor)
+    )
+    if advantage_balance > 0.0:
+        advantages_tensor = torch.where(
+            advantages_tensor > 0,
+            advantages_tensor,
+            advantages_tensor * (1 - advantage_balance),
+        )
+    elif advantage_balance < 0.0:
+        advantages_tensor = torch.where(
+            advantages_tensor < 0,
+            advantages_tensor,
+            advantages_tensor * (1 + advantage_balance),
+        )
+    advantages_tensor[assistant_mask_tensor] /= (
+        advantages_tensor[assistant_mask_tensor].abs()
+        * weights_tensor[assistant_mask_tensor]
+    ).mean()
+
+    return {
+        "tokens": torch.tensor(pad(token_ids, pad_token_id)),
+        "group_ids": torch.tensor(pad(group_ids, -1)),
+        "parent_ids": torch.tensor(pad(parent_ids, -1)),
+        "input_pos": torch.tensor(pad(input_pos, 0)),
+        "assistant_mask": assistant_mask_tensor,
+        "logprobs": torch.tensor(pad(logprobs, float("nan"))),
+        "advantages": advantages_tensor,
+        "weights": weights_tensor,
+    }
+
+
+def random_tokenized_results(
+    rng: random.Random, num_groups: int, max_length: int
+) -> list[TokenizedResult]:
+    results = []
+    for _ in range(num_groups):
+        prompt = [rng.randrange(100) for _ in range(rng.randrange(max_length // 2))]
+        branches = [
+            prompt + [rng.randrange(100) for _ in range(rng.randrange(max_length // 4))]
+            for _ in range(rng.randint(1, 3))
+        ]
+        group_results = []
+        for _ in range(rng.randint(1, 6)):
+            token_ids = rng.choice(branches) + [
+                rng.randrange(100) for _ in range(rng.randrange(1, max_length // 2))
+            ]
+            group_results.append(
+                TokenizedResult(
+                    advantage=rng.uniform(-1, 1),
+                    chat="",
+                    tokens=[str(token_id) for token_id in token_ids],
+                    token_ids=token_ids,
+                    input_pos=list(range(len(token_ids))),
+                    assistant_mask=[int(rng.random() < 0.5) for _ in token_ids],
+                    logprobs=[
+                        rng.uniform(-5, 0) if rng.random() < 0.5 else float("nan")
+                        for _ in token_ids
+                    ],
+                    weight=rng.random(),
+                )
+            )
+        assign_prompts(group_results, rng)
+        results.extend(group_results)
+    return results
+
+
+def compact_result(result: TokenizedResult) -> CompactTokenizedResult:
+    compact = CompactTokenizedResult.from_lists(
+        result.advantage,
+        result.chat,
+        result.token_ids,
+        result.assistant_mask,
+        result.logprobs,
+    )
+    compact.weight = result.weight
+    compact.prompt_id = result.prompt_id
+    compact.prompt_length = result.prompt_length
+    compact.parent_prompts = result.parent_prompts
+    return compact
@@ -0,0 +1,83 @@
+import os
+import random
+import socket
+from pathlib import Path
+
+from openai import AsyncOpenAI
+
+import art
+from art.cpu.service import CpuReferenceService
+from art.cpu.tokenizer import reference_tokenizer
+from art.preprocessing.pack import disk_packed_tensors_from_tokenized_results
+from art.preprocessing.tokenize import tokenize_trajectory_groups
+from art.utils.output_dirs import get_step_checkpoint_dir
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def test_cpu_reference_service(tmp_path: Path) -> None:
+    tokenizer = reference_tokenizer()
+    tokenizer.save_pretrained(tmp_path / "tokenizer")
+    service = CpuReferenceService(
+        model_name="test",
+        base_model=str(tmp_path / "tokenizer"),
+        config={},
+        output_dir=str(tmp_path / "model"),
+    )
+    port = _free_port()
+    await service.start_openai_server(
+        {"server_args": {"host": "127.0.0.1", "port": port}}
+    )
+    try:
+        client = AsyncOpenAI(base_url=f"http://127.0.0.1:{port}/v1", api_key="none")
+        messages: art.Messages = [{"role": "user", "content": "Say hi"}]
+        chat_completion = await client.chat.completions.create(
+            model="test", messages=messages, max_tokens=8, n=4, logprobs=True
+        )
+        groups = [
+            art.TrajectoryGroup(
+                art.Trajectory(
+                    messages_and_choices=[*messages, choice],
+                    reward=random.random(),
+                )
+                for choice in chat_completion.choices
+            )
+        ]
+        results = list(
+            tokenize_trajectory_groups(
+                service.tokenizer,
+                groups,
+                allow_training_without_logprobs=False,
+                scale_rewards=True,
+            )
+        )
+        assert results
+        disk_packed_tensors = disk_packed_tensors_from_tokenized_results(
+            results,
+            seq_len=64,
+            dir=str(tmp_path / "tensors"),
+            pad_token_id=tokenizer.eos_token_id,  # type: ignore
+        )
+        train_results = [
+            result
+            async for result in service.train(
+                [disk_packed_tensors],
+                art.TrainConfig(learning_rate=1e-3),
+                {},
+            )
+        ]
+        assert train_results and all(
+            result["grad_norm"] > 0 for result in train_results
+        )
+        assert os.path.exists(get_step_checkpoint_dir(service.output_dir, 1))
+        # The reloaded checkpoint is served
+        completion = await client.completions.create(
+            model="test", prompt="hi", max_tokens=4
+        )
+        assert completion.choices
+    finally:
+        await service.stop_openai_server()
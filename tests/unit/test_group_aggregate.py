@@ -0,0 +1,62 @@
+import random
+
+import pytest
+import torch
+from packing_helpers import random_tokenized_results
+
+from art.preprocessing.pack import packed_tensors_from_tokenized_results
+from art.utils.group_aggregate import group_aggregate, segment_aggregate, segment_ids
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("reduce", ["sum", "mean", "count"])
+def test_segment_aggregate_matches_group_aggregate(seed: int, reduce) -> None:
+    results = random_tokenized_results(random.Random(seed), num_groups=8, max_length=96)
+    packed_tensors = packed_tensors_from_tokenized_results(results, seq_len=128)
+    group_ids = packed_tensors["group_ids"]
+    mask = packed_tensors["assistant_mask"]
+    values = torch.randn(*group_ids.shape, dtype=torch.float64, requires_grad=True)
+    segments, num_segments = segment_ids(group_ids)
+    assert num_segments == (group_ids[:, 1:] != group_ids[:, :-1]).sum() + len(
+        group_ids
+    )
+    # Groups are runs, so every id in a row maps to a single segment
+    for row_ids, row_segments in zip(group_ids, segments):
+        assert len(row_ids.unique()) == len(row_segments.unique())
+
+    # Without a mask, all tokens of a group are reduced
+    expected = group_aggregate(values, by=group_ids, reduce=reduce)
+    actual = segment_aggregate(
+        values, segment_ids=segments, num_segments=num_segments, reduce=reduce
+    )
+    assert torch.allclose(actual, expected)
+
+    # With a mask, as in the sequence-level importance ratio of the loss
+    expected = group_aggregate(values, by=(group_ids + 1) * mask, reduce=reduce)
+    actual = segment_aggregate(
+        values,
+        segment_ids=segments,
+        num_segments=num_segments,
+        reduce=reduce,
+        mask=mask,
+    )
+    assert torch.allclose(actual[mask], expected[mask])
+    if reduce != "count":
+        (expected_grad,) = torch.autograd.grad(expected[mask].sum(), values)
+        (actual_grad,) = torch.autograd.grad(actual[mask].sum(), values)
+        assert torch.allclose(actual_grad, expected_grad)
+
+
+def test_segment_aggregate_compact() -> None:
+    ids = torch.tensor([[3, 3, 5, 5, 5, -1], [3, 3, 3, 7, -1, -1]])
+    segments, num_segments = segment_ids(ids)
+    assert segments.tolist() == [[0, 0, 1, 1, 1, 2], [3, 3, 3, 4, 5, 5]]
+    values = torch.arange(12.0).view(2, 6, 1)
+    sums = segment_aggregate(
+        values,
+        segment_ids=segments,
+        num_segments=num_segments,
+        reduce="sum",
+        broadcast=False,
+    )
+    assert sums.tolist() == [[1.0], [9.0], [5.0], [21.0], [9.0], [21.0]]
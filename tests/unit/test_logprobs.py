@@ -0,0 +1,110 @@
+import pytest
+import torch
+
+from art.utils.logprobs import (
+    logprobs_at_positions,
+    mean_entropy,
+    vocab_chunked_logprobs,
+)
+
+
+def reference_logprobs(
+    lm_head_t: torch.Tensor,
+    hidden_states: torch.Tensor,
+    next_input_ids: torch.Tensor,
+    chunk_size: int,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """`art.unsloth.train._calculate_logprobs`, which chunks over the sequence only."""
+    batch_size, seq_len, _ = hidden_states.shape
+    log_probs = torch.empty((batch_size, seq_len), dtype=hidden_states.dtype)
+    entropy = torch.empty((batch_size, seq_len), dtype=hidden_states.dtype)
+    lm_head_t = lm_head_t.to(hidden_states.dtype)
+    for i in range(0, seq_len, chunk_size):
+        chunk_logits = torch.matmul(hidden_states[:, i : i + chunk_size], lm_head_t)
+        chunk_selected_logits = torch.gather(
+            chunk_logits,
+            dim=-1,
+            index=next_input_ids[:, i : i + chunk_size].unsqueeze(-1),
+        ).squeeze(-1)
+        chunk_logsumexp = torch.logsumexp(chunk_logits, dim=-1)
+        log_probs[:, i : i + chunk_size] = chunk_selected_logits - chunk_logsumexp
+        log_probs_full = chunk_logits - chunk_logsumexp.unsqueeze(-1)
+        entropy[:, i : i + chunk_size] = (
+            -torch.exp(log_probs_full) * log_probs_full
+        ).sum(dim=-1)
+    return log_probs, entropy
+
+
+@pytest.mark.parametrize("vocab_chunk_size", [7, 32, 1000])
+def test_vocab_chunked_logprobs_match_reference(vocab_chunk_size: int) -> None:
+    torch.manual_seed(0)
+    hidden_states = torch.randn(2, 24, 16, dtype=torch.float64) * 3
+    lm_head_t = torch.randn(16, 100, dtype=torch.float64)
+    next_input_ids = torch.randint(0, 100, (2, 24))
+    grad_log_probs, grad_entropy = torch.randn(2, 2, 24, dtype=torch.float64)
+    outputs, grads = [], []
+    for fn, args in (
+        (reference_logprobs, ()),
+        (vocab_chunked_logprobs, (vocab_chunk_size,)),
+    ):
+        inputs = (
+            lm_head_t.clone().requires_grad_(),
+            hidden_states.clone().requires_grad_(),
+        )
+        log_probs, entropy = fn(*inputs, next_input_ids, 8, *args)
+        ((log_probs * grad_log_probs).sum() + (entropy * grad_entropy).sum()).backward()
+        outputs.append((log_probs.detach(), entropy.detach()))
+        grads.append(tuple(input.grad for input in inputs))
+    for expected, actual in zip(outputs[0] + grads[0], outputs[1] + grads[1]):
+        assert torch.allclose(actual, expected)  # type: ignore
+
+
+def test_vocab_chunked_logprobs_without_grad() -> None:
+    torch.manual_seed(0)
+    hidden_states = torch.randn(1, 16, 8)
+    lm_head_t = torch.randn(8, 50)
+    next_input_ids = torch.randint(0, 50, (1, 16))
+    with torch.inference_mode():
+        log_probs, entropy = vocab_chunked_logprobs(
+            lm_head_t, hidden_states, next_input_ids, 16, 16
+        )
+    expected = reference_logprobs(lm_head_t, hidden_states, next_input_ids, 16)
+    assert torch.allclose(log_probs, expected[0], atol=1e-5)
+    assert torch.allclose(entropy, expected[1], atol=1e-5)
+
+
+def test_entropy_at_assistant_positions() -> None:
+    torch.manual_seed(0)
+    hidden_states = torch.randn(2, 16, 8, dtype=torch.float64)
+    lm_head_t = torch.randn(8, 50, dtype=torch.float64)
+    next_input_ids = torch.randint(0, 50, (2, 16))
+    assistant_mask = torch.zeros(2, 16, dtype=torch.bool)
+    assistant_mask[0, 3:7] = assistant_mask[1, 9:15] = True
+    weights = torch.rand(2, 16, dtype=torch.float64)
+    # Like `compute_loss`, calculate logprobs where the next token is an
+    # assistant token
+    shifted_assistant_mask = torch.nn.functional.pad(
+        assistant_mask[:, 1:], (0, 1), value=False
+    )
+
+    def calculate_logprobs(
+        hidden_states: torch.Tensor, next_input_ids: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        return reference_logprobs(lm_head_t, hidden_states, next_input_ids, 8)
+
+    log_probs, entropy = logprobs_at_positions(
+        calculate_logprobs, hidden_states, next_input_ids
+    )
+    selected_log_probs, selected_entropy = logprobs_at_positions(
+        calculate_logprobs, hidden_states, next_input_ids, shifted_assistant_mask
+    )
+    assert torch.allclose(
+        selected_log_probs, torch.where(shifted_assistant_mask, log_probs, 0.0)
+    )
+    assert torch.allclose(
+        selected_entropy, torch.where(shifted_assistant_mask, entropy, 0.0)
+    )
+    assert torch.allclose(
+        mean_entropy(selected_entropy, weights, shifted_assistant_mask),
+        mean_entropy(entropy, weights, shifted_assistant_mask),
+    )
@@ -0,0 +1,433 @@
+import asyncio
+import os
+import random
+
+import pytest
+import torch
+from packing_helpers import (
+    compact_result,
+    random_tokenized_results,
+    reference_packed_tensors,
+)
+
+from art.preprocessing.pack import (
+    StagingBuffers,
+    bucketed_disk_packed_tensors_from_tokenized_results,
+    count_gradient_steps,
+    disk_packed_tensors_from_tokenized_results,
+    micro_batches,
+    packed_tensors_from_dir,
+    packed_tensors_from_tokenized_results,
+    packing_stats,
+    pad_varlen_packed_tensors,
+    unpad_packed_tensors,
+    upcast_packed_tensors,
+    varlen_packed_tensors_from_tokenized_results,
+)
+from art.preprocessing.tokenize import (
+    TokenizedResult,
+    _shuffle_prompt_tree,
+    assign_prompts,
+)
+
+
+def tokenized_result(
+    token_ids: list[int], advantage: float, num_prompt_tokens: int = 2
+) -> TokenizedResult:
+    return TokenizedResult(
+        advantage=advantage,
+        chat="",
+        tokens=[str(token_id) for token_id in token_ids],
+        token_ids=token_ids,
+        input_pos=list(range(len(token_ids))),
+        assistant_mask=[0] * num_prompt_tokens
+        + [1] * (len(token_ids) - num_prompt_tokens),
+        logprobs=[float("nan")] * len(token_ids),
+        weight=1.0,
+    )
+
+
+def attention_mask(group_ids: torch.Tensor, parent_ids: torch.Tensor) -> torch.Tensor:
+    seq_len = group_ids.shape[1]
+    causal_mask = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool))
+    return causal_mask & (
+        (group_ids.unsqueeze(1) <= group_ids.unsqueeze(2))
+        & (group_ids.unsqueeze(2) <= parent_ids.unsqueeze(1))
+    )
+
+
+def test_nested_prompts_are_packed_once() -> None:
+    results = [
+        tokenized_result([1, 2, 3, 4, 5, 6], 1.0, num_prompt_tokens=5),
+        tokenized_result([1, 2, 3, 4, 5, 7], -1.0, num_prompt_tokens=5),
+        tokenized_result([1, 2, 3, 8, 9], 1.0, num_prompt_tokens=4),
+        tokenized_result([1, 2, 3, 8, 10, 11], -1.0, num_prompt_tokens=4),
+        tokenized_result([1, 2, 12], 0.5),
+    ]
+    assign_prompts(results, random.Random(0))
+    assert [
+        [prompt_length for _, prompt_length in result.prompts()] for result in results
+    ] == [[2, 3, 5], [2, 3, 5], [2, 3, 4], [2, 3, 4], [2]]
+
+    packed_tensors = packed_tensors_from_tokenized_results(results, seq_len=32)
+    assert packed_tensors["tokens"].shape[0] == 1
+    # Shared prefixes are packed once: 1 2 | 3 | 4 5 | 6 | 7 | 8 | 9 | 10 11 | 12
+    assert (packed_tensors["group_ids"] >= 0).sum() == 12
+
+    # Every completion attends to exactly its own trajectory's tokens
+    tokens = packed_tensors["tokens"][0]
+    group_ids = packed_tensors["group_ids"][0]
+    mask = attention_mask(packed_tensors["group_ids"], packed_tensors["parent_ids"])[0]
+    completion_ids = group_ids[
+        (group_ids == packed_tensors["parent_ids"][0]) & (group_ids >= 0)
+    ].unique()
+    contexts = sorted(
+        tokens[mask[(group_ids == completion_id).nonzero().max()]].tolist()
+        for completion_id in completion_ids
+    )
+    assert contexts == sorted(result.token_ids for result in results)
+
+
+@pytest.mark.parametrize("packing_strategy", ["greedy", "first_fit_decreasing"])
+def test_equal_and_prefix_completions_are_trained_separately(
+    packing_strategy,
+) -> None:
+    results = [
+        tokenized_result([1, 2, 3, 10], 1.0, num_prompt_tokens=3),
+        tokenized_result([1, 2, 3, 10], 1.0, num_prompt_tokens=3),
+        # The completion of the results above is a prefix of this completion
+        tokenized_result([1, 2, 3, 10, 11], -1.0, num_prompt_tokens=3),
+        tokenized_result([1, 2, 3, 12], -1.0, num_prompt_tokens=3),
+        # The completion of the result above is part of this result's prompt
+        tokenized_result([1, 2, 3, 12, 13, 14], -1.0, num_prompt_tokens=5),
+    ]
+    assign_prompts(results, random.Random(0))
+    for result in results:
+        assert result.prompt_length <= 3
+    packed_tensors = packed_tensors_from_tokenized_results(
+        results, seq_len=32, packing_strategy=packing_strategy
+    )
+    # Every result is packed with its own completion and advantage
+    assistant_mask = packed_tensors["assistant_mask"]
+    advantages = packed_tensors["advantages"][assistant_mask]
+    assert (advantages > 0).sum() == 2
+    assert (advantages < 0).sum() == 4
+    assert (packed_tensors["group_ids"] >= 0).sum() == 3 + 1 + 1 + 2 + 1 + 3
+
+
+def test_history_prefix_trees_stay_together() -> None:
+    rng = random.Random(0)
+    results = []
+    for advantage in (1.0, -1.0, 0.5, -0.5):
+        main = [rng.randrange(100, 1000) for _ in range(30)]
+        results.append(tokenized_result(main, advantage, num_prompt_tokens=25))
+        # Additional histories branching off the main history
+        for length in (10, 20):
+            results.append(
+                tokenized_result(
+                    main[:length] + [len(results)],
+                    advantage,
+                    num_prompt_tokens=length,
+                )
+            )
+    assign_prompts(results, rng)
+    shuffled = list(results)
+    _shuffle_prompt_tree(shuffled, rng)
+    assert sorted(map(id, shuffled)) == sorted(map(id, results))
+    # The results below every prompt are contiguous
+    for prompt_id in {prompt_id for r in results for prompt_id, _ in r.prompts()}:
+        indices = [
+            i
+            for i, result in enumerate(shuffled)
+            if prompt_id in dict(result.prompts())
+        ]
+        assert indices == list(range(indices[0], indices[-1] + 1))
+    # Each history's prompts are nested: 10 tokens shared by all three, 20 by two
+    assert sorted(
+        [prompt_length for _, prompt_length in result.prompts()]
+        for result in results[:3]
+    ) == [[10], [10, 20], [10, 20]]
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("truncate_long_results", [True, False])
+@pytest.mark.parametrize("compact", [False, True])
+def test_packed_tensors_match_reference(
+    seed: int, truncate_long_results: bool, compact: bool
+) -> None:
+    rng = random.Random(seed)
+    results = random_tokenized_results(rng, num_groups=20, max_length=96)
+    kwargs = dict(
+        seq_len=64,
+        pad_token_id=0,
+        truncate_long_results=truncate_long_results,
+        advantage_balance=rng.uniform(-1, 1),
+    )
+    random.seed(seed)
+    expected = reference_packed_tensors(results, **kwargs)
+    random.seed(seed)
+    packed_tensors = packed_tensors_from_tokenized_results(
+        [compact_result(result) for result in results] if compact else results,
+        **kwargs,
+    )
+    for key, tensor in expected.items():
+        assert packed_tensors[key].dtype == tensor.dtype, key
+        assert torch.equal(
+            packed_tensors[key].nan_to_num(1e9), tensor.nan_to_num(1e9)
+        ), key
+
+
+def test_first_fit_decreasing_packs_fewer_sequences() -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=50, max_length=96)
+    greedy = packed_tensors_from_tokenized_results(results, seq_len=128)
+    packed_tensors = packed_tensors_from_tokenized_results(
+        results, seq_len=128, packing_strategy="first_fit_decreasing"
+    )
+    greedy_stats = packing_stats(greedy)
+    stats = packing_stats(packed_tensors)
+    assert stats["num_sequences"] == packed_tensors["tokens"].shape[0]
+    assert stats["num_sequences"] < greedy_stats["num_sequences"]
+    assert stats["padding_fraction"] < greedy_stats["padding_fraction"]
+    assert stats["duplicated_prompt_tokens"] < greedy_stats["duplicated_prompt_tokens"]
+
+    # Every completion still attends to exactly its own trajectory's tokens
+    mask = attention_mask(packed_tensors["group_ids"], packed_tensors["parent_ids"])
+    contexts = []
+    for tokens, group_ids, parent_ids, row_mask in zip(
+        packed_tensors["tokens"],
+        packed_tensors["group_ids"],
+        packed_tensors["parent_ids"],
+        mask,
+    ):
+        completion_ids = group_ids[(group_ids == parent_ids) & (group_ids >= 0)]
+        for completion_id in completion_ids.unique():
+            last = (group_ids == completion_id).nonzero().max()
+            contexts.append(tokens[row_mask[last]].tolist())
+    assert sorted(contexts) == sorted(
+        result.token_ids
+        for result in results
+        if any(result.assistant_mask[result.prompt_length :])
+    )
+
+
+@pytest.mark.parametrize("packing_strategy", ["greedy", "first_fit_decreasing"])
+def test_varlen_packed_tensors_match_padded(packing_strategy) -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=20, max_length=96)
+    kwargs = dict(seq_len=128, pad_token_id=0, packing_strategy=packing_strategy)
+    random.seed(0)
+    packed_tensors = packed_tensors_from_tokenized_results(results, **kwargs)
+    random.seed(0)
+    varlen_packed_tensors = varlen_packed_tensors_from_tokenized_results(
+        results, **kwargs
+    )
+    cu_seqlens = varlen_packed_tensors["cu_seqlens"]
+    assert cu_seqlens.dtype == torch.int32
+    assert int(cu_seqlens[-1]) == (packed_tensors["group_ids"] >= 0).sum()
+
+    for expected, actual in [
+        (packed_tensors, pad_varlen_packed_tensors(varlen_packed_tensors, 128, 0)),
+        (varlen_packed_tensors, unpad_packed_tensors(packed_tensors)),
+    ]:
+        for key, tensor in expected.items():
+            assert actual[key].dtype == tensor.dtype, key
+            assert torch.equal(actual[key].nan_to_num(1e9), tensor.nan_to_num(1e9)), key
+
+
+@pytest.mark.parametrize("advantage_balance", [0.0, 0.5])
+@pytest.mark.parametrize("bf16", [False, True])
+def test_disk_packed_tensors_match_in_memory(
+    tmp_path, advantage_balance: float, bf16: bool
+) -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=20, max_length=96)
+    kwargs = dict(seq_len=128, pad_token_id=0, advantage_balance=advantage_balance)
+    random.seed(0)
+    expected = packed_tensors_from_tokenized_results(results, **kwargs)
+    # Leave stale values from a larger previous batch in the files
+    packed_tensors_from_dir(dir=str(tmp_path), num_sequences=32, sequence_length=256)[
+        "tokens"
+    ].fill_(7)
+    random.seed(0)
+    disk_packed_tensors = disk_packed_tensors_from_tokenized_results(
+        results, str(tmp_path), **kwargs, bf16=bf16
+    )
+    packed_tensors = packed_tensors_from_dir(**disk_packed_tensors)
+    assert packed_tensors["tokens"].dtype == torch.int32
+    assert packed_tensors["weights"].dtype == (
+        torch.bfloat16 if bf16 else torch.float32
+    )
+    upcast_packed_tensors(packed_tensors)
+    for key, tensor in expected.items():
+        assert packed_tensors[key].dtype == tensor.dtype, key
+        if key in ("advantages", "weights"):
+            assert torch.allclose(
+                packed_tensors[key], tensor, rtol=1e-2 if bf16 else 1e-5
+            ), key
+        else:
+            assert torch.equal(
+                packed_tensors[key].nan_to_num(1e9), tensor.nan_to_num(1e9)
+            ), key
+
+
+def test_packed_tensors_from_dir_reads_version_1(tmp_path) -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=4, max_length=96)
+    expected = packed_tensors_from_tokenized_results(results, seq_len=128)
+    num_sequences, sequence_length = expected["tokens"].shape
+    for key, tensor in expected.items():
+        tensor.numpy().tofile(tmp_path / f"{key}.pt")
+    packed_tensors = packed_tensors_from_dir(
+        dir=str(tmp_path), num_sequences=num_sequences, sequence_length=sequence_length
+    )
+    for key, tensor in expected.items():
+        assert packed_tensors[key].dtype == tensor.dtype, key
+        assert torch.equal(
+            packed_tensors[key].nan_to_num(1e9), tensor.nan_to_num(1e9)
+        ), key
+
+
+def test_ref_logprobs_column(tmp_path) -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=4, max_length=96)
+    disk_packed_tensors = disk_packed_tensors_from_tokenized_results(
+        results, str(tmp_path), seq_len=128
+    )
+    assert "ref_logprobs" not in packed_tensors_from_dir(**disk_packed_tensors)
+    # The column is written through to disk by whoever fills it in
+    packed_tensors_from_dir(**disk_packed_tensors, ref_logprobs=True)[
+        "ref_logprobs"
+    ].fill_(-1.5)
+    packed_tensors = packed_tensors_from_dir(**disk_packed_tensors, ref_logprobs=True)
+    assert packed_tensors["ref_logprobs"].dtype == torch.float32
+    assert packed_tensors["ref_logprobs"].shape == packed_tensors["tokens"].shape
+    assert (packed_tensors["ref_logprobs"] == -1.5).all()
+
+
+@pytest.mark.parametrize(
+    "micro_batch_size,gradient_accumulation_steps", [(1, 1), (3, 1), (2, 4), (4, 3)]
+)
+def test_micro_batches(micro_batch_size: int, gradient_accumulation_steps: int) -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=8, max_length=96)
+    packed_tensors = packed_tensors_from_tokenized_results(results, seq_len=128)
+    num_sequences = packed_tensors["tokens"].shape[0]
+    steps = list(
+        micro_batches(packed_tensors, micro_batch_size, gradient_accumulation_steps)
+    )
+    assert len(steps) == count_gradient_steps(
+        num_sequences, micro_batch_size, gradient_accumulation_steps
+    )
+    rows = []
+    for step in steps:
+        assert len(step) == gradient_accumulation_steps
+        num_real_micro_batches = 0
+        for micro_batch in step:
+            assert 1 <= micro_batch["tokens"].shape[0] <= micro_batch_size
+            if micro_batch["assistant_mask"].any():
+                rows.append(micro_batch["tokens"])
+                num_real_micro_batches += 1
+            else:
+                # Padding doesn't contribute to the loss
+                assert not micro_batch["weights"].any()
+        # Losses are rescaled as if only the real micro-batches were averaged
+        assert all(
+            micro_batch["loss_scale"] * num_real_micro_batches
+            == gradient_accumulation_steps
+            for micro_batch in step
+        )
+    # Every sequence is trained on exactly once, in order
+    assert torch.equal(torch.cat(rows), packed_tensors["tokens"])
+    assert packed_tensors["assistant_mask"].any(-1).all()
+
+
+def test_bucketed_disk_packed_tensors(tmp_path) -> None:
+    results = random_tokenized_results(random.Random(0), num_groups=20, max_length=96)
+    buckets = bucketed_disk_packed_tensors_from_tokenized_results(
+        results, str(tmp_path), bucket_lengths=[128, 40, 64], length_multiple=16
+    )
+    # Each bucket is as long as its longest result rounded up to a multiple of 16
+    assert [bucket["sequence_length"] for bucket in buckets] == [40, 64, 112]
+    assert [bucket["dir"] for bucket in buckets] == [
+        f"{tmp_path}/{bucket_length}" for bucket_length in [40, 64, 128]
+    ]
+    contexts = []
+    assistant_mask, advantages, weights = [], [], []
+    for bucket in buckets:
+        packed_tensors = packed_tensors_from_dir(**bucket)
+        upcast_packed_tensors(packed_tensors)
+        mask = attention_mask(packed_tensors["group_ids"], packed_tensors["parent_ids"])
+        for tokens, group_ids, parent_ids, row_mask in zip(
+            packed_tensors["tokens"],
+            packed_tensors["group_ids"],
+            packed_tensors["parent_ids"],
+            mask,
+        ):
+            completion_ids = group_ids[(group_ids == parent_ids) & (group_ids >= 0)]
+            for completion_id in completion_ids.unique():
+                last = (group_ids == completion_id).nonzero().max()
+                context = tokens[row_mask[last]].tolist()
+                # Results only go into the shortest bucket they fit into
+                assert len(context) > 40 or bucket["sequence_length"] == 40
+                contexts.append(context)
+        assistant_mask.append(packed_tensors["assistant_mask"].flatten())
+        advantages.append(packed_tensors["advantages"].flatten())
+        weights.append(packed_tensors["weights"].flatten())
+    assert sorted(contexts) == sorted(
+        result.token_ids
+        for result in results
+        if any(result.assistant_mask[result.prompt_length :])
+    )
+    # Advantages and weights are normalized across buckets
+    assistant_mask = torch.cat(assistant_mask)
+    advantages = torch.cat(advantages)[assistant_mask]
+    weights = torch.cat(weights)[assistant_mask]
+    assert torch.isclose(weights.mean(), torch.tensor(1.0))
+    assert torch.isclose((advantages.abs() * weights).mean(), torch.tensor(1.0))
+
+    # Shorter results reuse the directories (and files) of their buckets
+    short_results = [result for result in results if len(result.token_ids) <= 48]
+    short_buckets = bucketed_disk_packed_tensors_from_tokenized_results(
+        short_results, str(tmp_path), bucket_lengths=[128, 40, 64], length_multiple=16
+    )
+    assert short_buckets[-1]["sequence_length"] == 48
+    assert short_buckets[-1]["dir"] == f"{tmp_path}/64"
+    assert sorted(os.listdir(tmp_path)) == ["128", "40", "64"]
+
+
+def test_staging_buffers_are_reused(tmp_path) -> None:
+    staging_buffers = StagingBuffers(str(tmp_path), num_buffers=2)
+
+    async def stage() -> None:
+        first = await staging_buffers.acquire()
+        second = await staging_buffers.acquire()
+        assert first != second
+        # The ring is empty until a buffer is released
+        third = asyncio.ensure_future(staging_buffers.acquire())
+        await asyncio.sleep(0)
+        assert not third.done()
+        await staging_buffers.release(first)
+        assert await third == first
+
+    asyncio.run(stage())
+    rng = random.Random(0)
+    dir = f"{tmp_path}/0"
+    large = disk_packed_tensors_from_tokenized_results(
+        random_tokenized_results(rng, num_groups=20, max_length=48), dir, seq_len=64
+    )
+    size = os.path.getsize(f"{dir}/tokens.pt")
+    # Files are grown to a power of two of sequences
+    assert size == 4 * 64 * (1 << (large["num_sequences"] - 1).bit_length())
+    results = random_tokenized_results(rng, num_groups=5, max_length=48)
+    random.seed(0)
+    expected = packed_tensors_from_tokenized_results(results, seq_len=64)
+    random.seed(0)
+    small = disk_packed_tensors_from_tokenized_results(results, dir, seq_len=64)
+    assert small["num_sequences"] < large["num_sequences"]
+    assert os.path.getsize(f"{dir}/tokens.pt") == size
+    packed_tensors = packed_tensors_from_dir(**small)
+    upcast_packed_tensors(packed_tensors)
+    for key, tensor in expected.items():
+        if key in ("advantages", "weights"):
+            assert torch.allclose(packed_tensors[key], tensor), key
+        else:
+            assert torch.equal(
+                packed_tensors[key].nan_to_num(1e9), tensor.nan_to_num(1e9)
+            ), key
+    staging_buffers.remove()
+    assert not os.path.exists(tmp_path)
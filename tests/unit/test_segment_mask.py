@@ -0,0 +1,82 @@
+import random
+
+import pytest
+import torch
+
+from art.preprocessing.pack import packed_tensors_from_tokenized_results
+from art.preprocessing.tokenize import TokenizedResult, assign_prompts
+from art.utils.segment_mask import EMPTY, FULL, SegmentMask
+
+
+def packed_ids(seed: int, seq_len: int) -> tuple[torch.Tensor, torch.Tensor]:
+    rng = random.Random(seed)
+    results = []
+    for _ in range(12):
+        prompt = [rng.randrange(50) for _ in range(rng.randrange(1, 40))]
+        group_results = []
+        for _ in range(rng.randint(1, 4)):
+            token_ids = prompt + [
+                rng.randrange(50) for _ in range(rng.randrange(1, 30))
+            ]
+            group_results.append(
+                TokenizedResult(
+                    advantage=1.0,
+                    chat="",
+                    tokens=[str(token_id) for token_id in token_ids],
+                    token_ids=token_ids,
+                    input_pos=list(range(len(token_ids))),
+                    assistant_mask=[1] * len(token_ids),
+                    logprobs=[float("nan")] * len(token_ids),
+                    weight=1.0,
+                )
+            )
+        assign_prompts(group_results, rng)
+        results.extend(group_results)
+    packed_tensors = packed_tensors_from_tokenized_results(results, seq_len=seq_len)
+    return packed_tensors["group_ids"], packed_tensors["parent_ids"]
+
+
+def dense_mask(group_ids: torch.Tensor, parent_ids: torch.Tensor) -> torch.Tensor:
+    seq_len = group_ids.shape[1]
+    causal_mask = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool))
+    return causal_mask & (
+        (group_ids.unsqueeze(1) <= group_ids.unsqueeze(2))
+        & (group_ids.unsqueeze(2) <= parent_ids.unsqueeze(1))
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("seq_len,block_size", [(96, 16), (100, 16), (64, 64)])
+def test_segment_mask_matches_dense_mask(
+    seed: int, seq_len: int, block_size: int
+) -> None:
+    group_ids, parent_ids = packed_ids(seed, seq_len)
+    expected = dense_mask(group_ids, parent_ids)
+    segment_mask = SegmentMask.from_ids(group_ids, parent_ids, block_size)
+    assert torch.equal(segment_mask.mask(), expected)
+    attn_bias = segment_mask.to_attn_bias(torch.bfloat16)
+    assert attn_bias.dtype == torch.bfloat16
+    assert torch.equal(attn_bias == 0, expected)
+    # Tiles marked empty or full are exactly that, including padding to whole blocks
+    tiles = dense_mask(segment_mask.group_ids, segment_mask.parent_ids)
+    blocks = tiles.shape[1] // block_size
+    tiles = tiles.view(-1, blocks, block_size, blocks, block_size)
+    tile_any = tiles.any(-1).any(-2)
+    tile_all = tiles.all(-1).all(-2)
+    assert not tile_any[segment_mask.block_states == EMPTY].any()
+    assert tile_all[segment_mask.block_states == FULL].all()
+    if blocks > 1:
+        assert (segment_mask.block_states == EMPTY).any()
+        assert (segment_mask.block_states == FULL).any()
+
+
+def test_segment_block_mask_matches_dense_mask() -> None:
+    flex_attention = pytest.importorskip("torch.nn.attention.flex_attention")
+    group_ids, parent_ids = packed_ids(0, 256)
+    block_mask = SegmentMask.from_ids(group_ids, parent_ids).to_block_mask()
+    query, key, value = torch.randn(3, group_ids.shape[0], 2, 256, 16).unbind(0)
+    expected = torch.nn.functional.scaled_dot_product_attention(
+        query, key, value, attn_mask=dense_mask(group_ids, parent_ids).unsqueeze(1)
+    )
+    output = flex_attention.flex_attention(query, key, value, block_mask=block_mask)
+    assert torch.allclose(output, expected, atol=1e-5)  # type: ignore
@@ -0,0 +1,457 @@
+import math
+import os
+import random
+import struct
+import zlib
+from concurrent.futures import Future
+from dataclasses import replace
+from pathlib import Path
+from typing import cast
+
+import numpy as np
+import pytest
+from openai.types.chat.chat_completion import Choice, ChoiceLogprobs
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import (
+    ChatCompletionMessageToolCall,
+    Function,
+)
+from openai.types.chat.chat_completion_token_logprob import ChatCompletionTokenLogprob
+from tokenizers import pre_tokenizers
+from transformers import PreTrainedTokenizerBase
+
+import art
+from art.cpu.tokenizer import CHAT_TEMPLATE, reference_tokenizer
+from art.preprocessing.tokenize import (
+    CompactTokenizedResult,
+    DiskTokenizationCache,
+    TokenizedResult,
+    TokenizerCache,
+    get_histories,
+    get_pretokenized_histories,
+    get_tokenize_executor,
+    pretokenize_trajectory_group,
+    tokenize_trajectory,
+    tokenize_trajectory_group,
+    tokenize_trajectory_groups,
+    tokenize_trajectory_groups_in_parallel,
+    tokenize_trajectory_histories,
+)
+from art.trajectories import History
+
+# Renders tools and tool calls, unlike the reference tokenizer's template
+TOOL_CHAT_TEMPLATE = (
+    "{% if tools %}<|im_start|>system\n"
+    "{% for tool in tools %}<tools>{{ tool | tojson }}</tools>{% endfor %}"
+    "<|im_end|>\n{% endif %}"
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\\n' + message['content'] }}"
+    "{% for tool_call in message.get('tool_calls') or [] %}"
+    "{{ '<tool_call>' + tool_call['function'] | tojson + '</tool_call>' }}"
+    "{% endfor %}"
+    "{{ '<|im_end|>\\n' }}"
+    "{% endfor %}"
+)
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "lookup",
+            "parameters": {"type": "object", "properties": {"query": {}}},
+        },
+    }
+]
+
+
+def tool_tokenizer(
+    pre_tokenizer: pre_tokenizers.PreTokenizer | None = None,
+) -> PreTrainedTokenizerBase:
+    tokenizer = reference_tokenizer()
+    tokenizer.add_tokens(["<tool_call>", "</tool_call>"])
+    tokenizer.chat_template = TOOL_CHAT_TEMPLATE
+    if pre_tokenizer is not None:
+        tokenizer.backend_tokenizer.pre_tokenizer = pre_tokenizer
+    return tokenizer
+
+
+def choice(
+    tokenizer: PreTrainedTokenizerBase, content: str, query: str | None = None
+) -> Choice:
+    tool_calls = (
+        [
+            ChatCompletionMessageToolCall(
+                id=f"call_{query}",
+                type="function",
+                function=Function(name="lookup", arguments=f'{{"query": "{query}"}}'),
+            )
+        ]
+        if query is not None
+        else None
+    )
+    token_ids = tokenizer.encode(content, add_special_tokens=False)
+    if tool_calls:
+        token_ids += tokenizer.encode(
+            f"<tool_call>{tool_calls[0].function.model_dump_json()}</tool_call>",
+            add_special_tokens=False,
+        )
+    return Choice(
+        finish_reason="tool_calls" if tool_calls else "stop",
+        index=0,
+        message=ChatCompletionMessage(
+            role="assistant", content=content, tool_calls=tool_calls
+        ),
+        logprobs=ChoiceLogprobs(
+            content=[
+                ChatCompletionTokenLogprob(
+                    token=f"token_id:{token_id}",
+                    logprob=-0.01 * (i + 1),
+                    bytes=list(tokenizer.decode(token_id).encode()),
+                    top_logprobs=[],
+                )
+                for i, token_id in enumerate(token_ids)
+            ]
+        ),
+    )
+
+
+def trajectory_groups(tokenizer: PreTrainedTokenizerBase) -> list[art.TrajectoryGroup]:
+    """
+    Groups whose trajectories share system and user prompts, call tools and
+    have additional histories that share their prefixes.
+    """
+    groups = []
+    for topic in ["cats", "dogs"]:
+        prompt: art.Messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"Tell me about {topic}, please."},
+        ]
+        trajectories = []
+        for i in range(3):
+            messages_and_choices: art.MessagesAndChoices = [
+                *prompt,
+                choice(tokenizer, f"Looking up {topic} ({i})", f"{topic} {i}"),
+                {
+                    "role": "tool",
+                    "tool_call_id": f"call_{topic} {i}",
+                    "content": f"{topic} are great, fact #{i}",
+                },
+                choice(tokenizer, f"{topic.title()} are great! 😺 ×{i}"),
+            ]
+            trajectories.append(
+                art.Trajectory(
+                    messages_and_choices=messages_and_choices,
+                    tools=TOOLS,  # type: ignore
+                    additional_histories=[
+                        History(
+                            messages_and_choices=[
+                                *prompt,
+                                {"role": "assistant", "content": "Sure."},
+                                {"role": "user", "content": "Be brief."},
+                                choice(tokenizer, f"{topic}: ok {i}"),
+                            ]
+                        )
+                    ],
+                    reward=float(i),
+                )
+            )
+        groups.append(art.TrajectoryGroup(trajectories))
+    return groups
+
+
+def test_tokenizer_cache() -> None:
+    tokenizer = reference_tokenizer()
+    tokenizer.add_tokens(["<tool_call>", "</tool_call>"])
+    tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+    # Single ids decode like the tokenizer, including added and special tokens
+    for token_id in range(len(tokenizer)):
+        assert tokenizer_cache.decode(token_id) == tokenizer.decode(token_id)
+    assert tokenizer_cache.decode(tokenizer.eos_token_id) == "<|im_end|>"  # type: ignore
+    assert tokenizer_cache.decode(len(tokenizer) - 1) == "</tool_call>"
+
+    # The sentinel is the largest unused id of the base vocabulary
+    vocab_size = tokenizer.vocab_size
+    assert tokenizer_cache.sentinel_token_id([]) == vocab_size - 1
+    assert tokenizer_cache.sentinel_token_id([vocab_size - 1]) == vocab_size - 2
+
+    # The decoded vocabulary is built once per tokenizer object
+    assert (
+        TokenizerCache.from_tokenizer(tokenizer).decoded_tokens
+        is tokenizer_cache.decoded_tokens
+    )
+    other_tokenizer = reference_tokenizer()
+    other_tokenizer_cache = TokenizerCache.from_tokenizer(other_tokenizer)
+    assert other_tokenizer_cache.decoded_tokens is not tokenizer_cache.decoded_tokens
+    assert len(other_tokenizer_cache.decoded_tokens) == len(tokenizer) - 2
+
+    # The fingerprint only changes with what affects tokenization
+    assert (
+        TokenizerCache.from_tokenizer(reference_tokenizer()).fingerprint
+        == other_tokenizer_cache.fingerprint
+    )
+    assert tokenizer_cache.fingerprint != other_tokenizer_cache.fingerprint
+    other_tokenizer.chat_template = "{{ messages }}"
+    assert (
+        TokenizerCache.from_tokenizer(other_tokenizer).fingerprint
+        != other_tokenizer_cache.fingerprint
+    )
+
+
+def assert_same_results(
+    results: list[TokenizedResult], expected: list[TokenizedResult]
+) -> None:
+    assert len(results) == len(expected)
+    for result, expected_result in zip(results, expected):
+        assert result.token_ids == expected_result.token_ids
+        assert result.assistant_mask == expected_result.assistant_mask
+        assert all(
+            a == b or math.isnan(a) and math.isnan(b)
+            for a, b in zip(result.logprobs, expected_result.logprobs, strict=True)
+        )
+        assert result.advantage == expected_result.advantage
+        assert result.weight == expected_result.weight
+        assert result.prompt_id == expected_result.prompt_id
+        assert result.prompt_length == expected_result.prompt_length
+
+
+@pytest.mark.parametrize(
+    "pre_tokenizer",
+    [
+        None,
+        # Prepends a space to the first split only, so encoding the text between
+        # added tokens separately changes the output and the probe check fails
+        pre_tokenizers.Sequence(
+            [
+                pre_tokenizers.Metaspace(prepend_scheme="first"),
+                pre_tokenizers.ByteLevel(add_prefix_space=False),
+            ]
+        ),
+    ],
+)
+def test_incremental_tokenization(
+    pre_tokenizer: pre_tokenizers.PreTokenizer | None,
+) -> None:
+    tokenizer = tool_tokenizer(pre_tokenizer)
+    tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+    assert (tokenizer_cache.segment_pattern is None) == (pre_tokenizer is not None)
+    groups = trajectory_groups(tokenizer)
+    results = {}
+    for incremental in [False, True]:
+        random.seed(0)
+        results[incremental] = list(
+            tokenize_trajectory_groups(
+                tokenizer,
+                groups,
+                allow_training_without_logprobs=False,
+                scale_rewards=True,
+                incremental=incremental,
+            )
+        )
+    assert len(results[False]) == 8
+    assert_same_results(results[True], results[False])  # type: ignore
+    # Tool calls are rendered with their added tokens and trained on
+    tool_call_id = tokenizer.convert_tokens_to_ids("<tool_call>")
+    assert any(
+        token_id == tool_call_id and trained
+        for result in results[False]
+        for token_id, trained in zip(result.token_ids, result.assistant_mask)
+    )
+
+
+def test_parallel_tokenization() -> None:
+    tokenizer = tool_tokenizer()
+    groups = trajectory_groups(tokenizer)
+    random.seed(0)
+    expected = list(
+        tokenize_trajectory_groups(
+            tokenizer,
+            groups,
+            allow_training_without_logprobs=False,
+            scale_rewards=True,
+        )
+    )
+    # Prompt ids and shuffling come from per-group seeds, so the results do not
+    # depend on whether or across how many processes the groups are tokenized
+    for num_workers in [1, 2]:
+        with get_tokenize_executor(tokenizer, num_workers) as executor:
+            random.seed(0)
+            results, _ = tokenize_trajectory_groups_in_parallel(
+                executor,
+                groups,
+                allow_training_without_logprobs=False,
+                scale_rewards=True,
+            )
+        assert_same_results(results, expected)  # type: ignore
+
+
+def test_pretokenized_histories() -> None:
+    tokenizer = tool_tokenizer()
+    tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+    (group, _) = trajectory_groups(tokenizer)
+
+    def pretokenize(
+        group: art.TrajectoryGroup, exception: Exception | None = None
+    ) -> None:
+        histories: Future[list[list[TokenizedResult | None]]] = Future()
+        if exception is None:
+            histories.set_result(
+                tokenize_trajectory_histories(  # type: ignore
+                    tokenizer, list(group), False, tokenizer_cache
+                )
+            )
+        else:
+            histories.set_exception(exception)
+        pretokenize_trajectory_group(
+            group,
+            tokenizer.name_or_path,
+            False,
+            histories,  # type: ignore
+        )
+
+    def tokenize(group: art.TrajectoryGroup) -> list[TokenizedResult]:
+        return tokenize_trajectory_group(  # type: ignore
+            tokenizer, group, False, True, True, tokenizer_cache, rng=random.Random(0)
+        )
+
+    def copy(group: art.TrajectoryGroup) -> art.TrajectoryGroup:
+        return art.TrajectoryGroup(
+            trajectory.model_copy(deep=True) for trajectory in group
+        )
+
+    pretokenize(group)
+    histories = get_pretokenized_histories(group, tokenizer_cache, False)
+    assert histories is not None
+    assert_same_results(tokenize(group), tokenize(copy(group)))
+    # Settings that change tokenization invalidate the histories
+    assert get_pretokenized_histories(group, tokenizer_cache, True) is None
+    assert get_pretokenized_histories(group, tokenizer_cache, False, True) is None
+
+    # Editing a message after pretokenizing re-tokenizes the group
+    message = group.trajectories[0].messages_and_choices[1]
+    assert isinstance(message, dict)
+    message["content"] = "Tell me about birds instead."
+    assert get_pretokenized_histories(group, tokenizer_cache, False) is None
+    assert_same_results(tokenize(group), tokenize(copy(group)))
+
+    # So does replacing a trajectory
+    pretokenize(group)
+    group.trajectories[1] = group.trajectories[1].model_copy(deep=True)
+    assert get_pretokenized_histories(group, tokenizer_cache, False) is None
+    assert_same_results(tokenize(group), tokenize(copy(group)))
+
+    # And pretokenization failing
+    pretokenize(group, ValueError("Failed to pretokenize"))
+    assert get_pretokenized_histories(group, tokenizer_cache, False) is None
+    assert_same_results(tokenize(group), tokenize(copy(group)))
+
+
+def test_disk_tokenization_cache(tmp_path: Path) -> None:
+    tokenizer = tool_tokenizer()
+    tokenizer_cache = TokenizerCache.from_tokenizer(tokenizer)
+    histories = [
+        history
+        for group in trajectory_groups(tokenizer)
+        for trajectory in group
+        for history in get_histories(trajectory)
+    ]
+    disk_cache = DiskTokenizationCache(str(tmp_path), max_size=1 << 20)
+    keys = [disk_cache.key(history, tokenizer_cache, False) for history in histories]
+    results = [
+        cast(TokenizedResult, tokenize_trajectory(tokenizer, history, 1.0, False))
+        for history in histories
+    ]
+    for key, result in zip(keys, results):
+        assert disk_cache.get(key, 1.0, tokenizer_cache) is None
+        disk_cache.put(key, result)
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+    # Entries are a header followed by the zlib-compressed token ids, bit-packed
+    # assistant mask, float32 logprobs and chat
+    path = tmp_path / keys[0][:2] / keys[0]
+    data = path.read_bytes()
+    magic, num_tokens, chat_length = struct.unpack_from("<4sII", data)
+    assert (magic, num_tokens) == (b"ART1", len(results[0].token_ids))
+    body = zlib.decompress(data[12:])
+    chat = results[0].chat.encode()
+    assert chat_length == len(chat)
+    assert body == b"".join(
+        (
+            np.array(results[0].token_ids, "<i4").tobytes(),
+            np.packbits(np.array(results[0].assistant_mask, bool)).tobytes(),
+            np.array(results[0].logprobs, "<f4").tobytes(),
+            chat,
+        )
+    )
+
+    # Entries round-trip with the advantage they are read with
+    for key, result in zip(keys, results):
+        cached = disk_cache.get(key, 2.0, tokenizer_cache)
+        assert isinstance(cached, TokenizedResult)
+        assert cached.advantage == 2.0
+        assert cached.chat == result.chat
+        assert cached.tokens == result.tokens
+        assert cached.input_pos == result.input_pos
+        result.logprobs = np.float32(result.logprobs).tolist()
+        assert_same_results([cached], [replace(result, advantage=2.0)])
+        compact = disk_cache.get(key, 2.0, tokenizer_cache, compact=True)
+        assert isinstance(compact, CompactTokenizedResult)
+        assert compact.token_ids.tolist() == result.token_ids
+
+    # Keys change with anything that affects tokenization
+    history = histories[0]
+    assert (
+        disk_cache.key(history.model_copy(deep=True), tokenizer_cache, False)
+        == (keys[0])
+    )
+    assert disk_cache.key(history, tokenizer_cache, True) != keys[0]
+    assert disk_cache.key(histories[1], tokenizer_cache, False) != keys[0]
+    edited_history = history.model_copy(deep=True)
+    cast(dict, edited_history.messages_and_choices[0])["content"] = "Be terse."
+    assert disk_cache.key(edited_history, tokenizer_cache, False) != keys[0]
+    edited_history = history.model_copy(update={"tools": None})
+    assert disk_cache.key(edited_history, tokenizer_cache, False) != keys[0]
+    other_tokenizer = tool_tokenizer()
+    other_tokenizer.add_tokens(["<tools>"])
+    assert (
+        disk_cache.key(history, TokenizerCache.from_tokenizer(other_tokenizer), False)
+        != keys[0]
+    )
+    other_tokenizer = tool_tokenizer()
+    other_tokenizer.chat_template = CHAT_TEMPLATE
+    assert (
+        disk_cache.key(history, TokenizerCache.from_tokenizer(other_tokenizer), False)
+        != keys[0]
+    )
+
+    # Corrupted and truncated entries are misses that `put` overwrites
+    for corrupted in [
+        b"",
+        data[:8],
+        b"ART0" + data[4:],
+        data[:-4],
+        data[:12] + zlib.compress(body[:-1]),
+        data[:12] + bytes(len(data) - 12),
+    ]:
+        path.write_bytes(corrupted)
+        assert disk_cache.get(keys[0], 1.0, tokenizer_cache) is None
+    disk_cache.put(keys[0], results[0])
+    assert disk_cache.get(keys[0], 1.0, tokenizer_cache) is not None
+
+    # Eviction removes the least recently used entries, skipping entries that
+    # are still being written
+    paths = [tmp_path / key[:2] / key for key in keys]
+    for i, path in enumerate(paths):
+        os.utime(path, (i, i))
+    assert disk_cache.get(keys[0], 1.0, tokenizer_cache) is not None
+    tmp_file = tmp_path / "00" / "entry.tmp"
+    tmp_file.parent.mkdir(exist_ok=True)
+    tmp_file.write_bytes(bytes(1 << 16))
+    sizes = [path.stat().st_size for path in paths]
+    disk_cache.max_size = sum(sizes) - 1
+    disk_cache.evict()
+    assert tmp_file.exists()
+    assert paths[0].exists() and not paths[1].exists()
+    remaining = [path for path in paths if path.exists()]
+    assert sum(path.stat().st_size for path in remaining) <= disk_cache.max_size * 0.8
+    # The most recently used entries are kept
+    assert remaining == [paths[0], *paths[len(paths) - len(remaining) + 1 :]]
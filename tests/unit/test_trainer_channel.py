@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import torch
+
+from art.utils.trainer_channel import TrainerChannel, TrainerChannelClosed
+
+
+class StubTrainer:
+    """Pulls `gradient_accumulation_steps` inputs per step, like the HF trainer loop."""
+
+    def __init__(
+        self,
+        channel: TrainerChannel[dict[str, torch.Tensor]],
+        steps: int,
+        events: list[str] | None = None,
+    ) -> None:
+        self.channel = channel
+        self.gradient_accumulation_steps = steps
+        self.thread_ids: set[int] = set()
+        self.events = events if events is not None else []
+
+    def train(self) -> None:
+        while True:
+            loss = 0.0
+            for _ in range(self.gradient_accumulation_steps):
+                inputs = self.channel.get()
+                self.thread_ids.add(threading.get_ident())
+                loss += float(inputs["tokens"].float().sum())
+            self.channel.put_result({"loss": loss})
+            # Like the HF trainer, keep working on the step after logging it
+            time.sleep(0.05)
+            self.events.append("step")
+
+
+async def test_trainer_channel_round_trip() -> None:
+    channel = TrainerChannel[dict[str, torch.Tensor]](
+        maxsize=2, device=torch.device("cpu")
+    )
+    trainer = StubTrainer(channel, steps=3)
+    train_task = asyncio.create_task(asyncio.to_thread(trainer.train))
+    results = []
+    for step in range(4):
+        # More inputs than fit into the channel at once
+        for micro_batch in range(3):
+            await channel.put({"tokens": torch.full((1, 4), step * 3 + micro_batch)})
+        results.append(await channel.get_result(train_task))
+    assert [result["loss"] for result in results] == [
+        4.0 * sum(range(step * 3, step * 3 + 3)) for step in range(4)
+    ]
+    assert trainer.thread_ids and threading.get_ident() not in trainer.thread_ids
+    await channel.results.join()
+    channel.close()
+    with pytest.raises(TrainerChannelClosed):
+        await channel.get_result(train_task)
+
+
+async def test_trainer_channel_wait_idle() -> None:
+    channel = TrainerChannel[dict[str, torch.Tensor]]()
+    events: list[str] = []
+    trainer = StubTrainer(channel, steps=1, events=events)
+    train_task = asyncio.create_task(asyncio.to_thread(trainer.train))
+    for _ in range(2):
+        await channel.put({"tokens": torch.ones(1, 4)})
+        await channel.get_result(train_task)
+        # Forward passes between steps wait for the trainer to finish the step
+        await channel.wait_idle(train_task)
+        events.append("precalculate")
+    assert events == ["step", "precalculate", "step", "precalculate"]
+    channel.close()
+    with pytest.raises(TrainerChannelClosed):
+        await channel.wait_idle(train_task)